@@ -14,6 +14,7 @@ from yass.util import absolute_path_to_asset
 from yass.empty import empty
 from yass.geometry import n_steps_neigh_channels
 from yass.template import align_get_shifts_with_ref, shift_chans
+from yass.spike_train import spike_train_unit_index
 
 def make_CONFIG2(CONFIG):
     ''' Makes a copy of several attributes of original config parameters
@@ -360,6 +361,9 @@ def load_align_waveforms_parallel(labels_in,
         split_labels = spike_index[:, 1]
     else:
         split_labels = np.load(fname_splits)
+
+    # index spikes by label once
+    label_order, label_offsets = spike_train_unit_index(split_labels)
     
     # minimum number of spikes per cluster
     rec_len_sec = np.ptp(spike_index[:,0])
@@ -393,7 +397,7 @@ def load_align_waveforms_parallel(labels_in,
         if os.path.exists(fname_out):
             continue
 
-        idx_ = np.where(split_labels == id_)[0]
+        idx_ = label_order[label_offsets[id_]:label_offsets[id_+1]]
         
         # spike times
         spike_times = spike_index[idx_, 0]
@@ -559,6 +563,9 @@ def load_waveforms_parallel(labels_in,
     else:
         split_labels = np.load(fname_splits)
 
+    # index spikes by label once
+    label_order, label_offsets = spike_train_unit_index(split_labels)
+
     # minimum number of spikes per cluster
     rec_len_sec = np.ptp(spike_index[:,0])
     min_spikes = int(rec_len_sec*CONFIG.cluster.min_fr/CONFIG.recordings.sampling_rate)
@@ -586,7 +593,7 @@ def load_waveforms_parallel(labels_in,
         if os.path.exists(fname_out):
             continue
 
-        idx_ = np.where(split_labels == id_)[0]
+        idx_ = label_order[label_offsets[id_]:label_offsets[id_+1]]
         
         # spike times
         spike_times = spike_index[idx_, 0]
@@ -1,5 +1,6 @@
 import numpy as np
 import scipy
+from scipy import fft
 import time, os
 import parmap
 import copy
@@ -11,17 +12,15 @@ import logging
 # ********************************************************
 # ********************************************************
 
-def parallel_conv_filter(data_in,
+def parallel_conv_filter(units,
                          n_time,
-                         up_up_map,
+                         unit_offsets,
                          unit_overlap,
                          up_factor,
                          vis_chan,
                          approx_rank,
-                         deconv_dir):
-
-    proc_index = data_in[0]
-    unit_array = data_in[1]
+                         deconv_dir,
+                         fname_out):
 
     # Cat: must load these structures from disk for multiprocessing step; 
     #       where there are many templates; due to multiproc 4gb limit 
@@ -32,8 +31,9 @@ def parallel_conv_filter(data_in,
     singular = data['singular']
     spatial = data['spatial']
 
-    pairwise_conv_array = []
-    for unit2 in unit_array:
+    # rows of each unit are written in place, see SparsePairwiseConv
+    pairwise_conv_all = np.load(fname_out, mmap_mode='r+')
+    for unit2 in units:
         conv_res_len = n_time * 2 - 1
         n_overlap = np.sum(unit_overlap[unit2, :])
         pairwise_conv = np.zeros([n_overlap, conv_res_len], dtype=np.float32)
@@ -52,11 +52,42 @@ def parallel_conv_filter(data_in,
                 pairwise_conv[j, :] += np.convolve(
                         mat_mul_res[:, i],
                         s[i] * u[:, i].flatten(), 'full')
-    
-        pairwise_conv_array.append(pairwise_conv)
-        
-    np.save(deconv_dir+'/temp_temp_chunk_'+str(proc_index), 
-                                                pairwise_conv_array)
+
+        pairwise_conv_all[
+            unit_offsets[unit2]:unit_offsets[unit2+1]] = pairwise_conv
+
+    pairwise_conv_all.flush()
+    del pairwise_conv_all
+
+
+class SparsePairwiseConv(object):
+    """Pairwise convolutions of templates, only of overlapping units.
+
+    Rows of unit k, one per unit that overlaps with it, are
+    data[offsets[k]:offsets[k+1]]. The rows of all units are one float32
+    array saved in save_dir and memory-mapped read only, so worker
+    processes share it instead of loading their own copy.
+    """
+
+    def __init__(self, save_dir):
+        self.save_dir = save_dir
+        self.data = np.load(
+            os.path.join(save_dir, 'pairwise_conv_data.npy'), mmap_mode='r')
+        self.offsets = np.load(
+            os.path.join(save_dir, 'pairwise_conv_offsets.npy'))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, unit):
+        return self.data[self.offsets[unit]:self.offsets[unit+1]]
+
+    # pickle the location, not the data
+    def __getstate__(self):
+        return {'save_dir': self.save_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state['save_dir'])
 
 
 class MatchPursuit_objectiveUpsample(object):
@@ -295,60 +326,51 @@ class MatchPursuit_objectiveUpsample(object):
             self.spatial = data['spatial']
 
 
-    # Cat: TODO: Parallelize this function
     def pairwise_filter_conv_parallel(self):
-    
-        # Cat: TODO: this may still crash memory in some cases; can split into additional bits
-        units = np.array_split(np.unique(self.up_up_map), self.n_processors)
+
+        # row offsets of each unit, only units in up_up_map are computed
+        units_all = np.unique(self.up_up_map)
+        n_rows = np.zeros(self.n_unit, 'int64')
+        n_rows[units_all] = np.sum(self.unit_overlap[units_all], axis=1)
+        unit_offsets = np.hstack((0, np.cumsum(n_rows)))
+
+        # workers write their rows into one file
+        fname_data = os.path.join(self.deconv_dir, "pairwise_conv_data.npy")
+        fname_tmp = os.path.join(self.deconv_dir, "pairwise_conv_data_tmp.npy")
+        pairwise_conv = np.lib.format.open_memmap(
+            fname_tmp, mode='w+', dtype='float32',
+            shape=(int(unit_offsets[-1]), self.n_time * 2 - 1))
+        del pairwise_conv
+
         if self.multi_processing:
+            units = np.array_split(units_all, self.n_processors)
             parmap.map(parallel_conv_filter, 
-                            list(zip(np.arange(len(units)),units)), 
+                            units,
                             self.n_time,
-                            self.up_up_map,
+                            unit_offsets,
                             self.unit_overlap,
                             self.up_factor,
                             self.vis_chan,
                             self.approx_rank,
                             self.deconv_dir,
+                            fname_tmp,
                             processes=self.n_processors,
                             pm_pbar=True)
         else:
-            units = np.unique(self.up_up_map)
-
-            for k in range(len(units)):
-                parallel_conv_filter( 
-                            [k,[units[k]]],
+            parallel_conv_filter(
+                            units_all,
                             self.n_time,
-                            self.up_up_map,
+                            unit_offsets,
                             self.unit_overlap,
                             self.up_factor,
                             self.vis_chan,
                             self.approx_rank,
-                            self.deconv_dir)
-        
-        # load temp_temp saved files from disk due to memory overload otherwise
-        temp_array = []
-        for i in range(len(units)):
-            fname = os.path.join(self.deconv_dir, 'temp_temp_chunk_'+str(i)+'.npy')
-            temp_pairwise_conv = np.load(fname)
-            temp_array.extend(temp_pairwise_conv)
-            os.remove(fname)
-
-        # initialize empty list and fill only correct locations
-        pairwise_conv=[]
-        for i in range(self.n_unit):
-            pairwise_conv.append(None)
-
-        ctr=0
-        for unit2 in np.unique(self.up_up_map):
-            pairwise_conv[unit2] = temp_array[ctr]
-            ctr+=1
-        
-        pairwise_conv = np.array(pairwise_conv)
-        
-        # save to disk, don't keep in memory
-        np.save(os.path.join(self.deconv_dir, "pairwise_conv.npy"), pairwise_conv)
+                            self.deconv_dir,
+                            fname_tmp)
 
+        np.save(os.path.join(self.deconv_dir, "pairwise_conv_offsets.npy"),
+                unit_offsets)
+        os.rename(fname_tmp, fname_data)
 
 
     # Cat: TODO: Parallelize this function
@@ -356,7 +378,7 @@ class MatchPursuit_objectiveUpsample(object):
         """Computes pairwise convolution of templates using SVD approximation."""
 
         if os.path.exists(
-            os.path.join(self.deconv_dir, "pairwise_conv.npy")) == False:
+            os.path.join(self.deconv_dir, "pairwise_conv_data.npy")) == False:
 
             # Cat: TODO: original temp_temp computation, do not erase it, keep
             #           it for debugging and testing pursposes
@@ -538,22 +560,54 @@ class MatchPursuit_objectiveUpsample(object):
         correct_spt[correct_spt[:, 1] % self.up_factor > 0, 0] += 1
         return correct_spt
 
+    def objective_filters(self, n_fft):
+        """Spatial filters and spectra of the temporal filters of all units
+        used by compute_objective. Computed once and reused for every
+        chunk."""
+        if (getattr(self, 'filters_fft', None) is None or
+            self.filters_fft.shape[2] != n_fft//2 + 1):
+            # (rank, unit, chan)
+            self.spatial_scaled = np.transpose(
+                self.spatial * self.singular[:, :, None],
+                (1, 0, 2)).astype(np.float32)
+            # (rank, unit, freq)
+            self.filters_fft = fft.rfft(
+                np.transpose(self.temporal, (2, 0, 1)).astype(np.float32),
+                n=n_fft, axis=2)
+
+        return self.spatial_scaled, self.filters_fft
+
     def compute_objective(self):
-        """Computes the objective given current state of recording."""
+        """Computes the objective given current state of recording.
+
+        All unit and rank convolutions are done at once by overlap-add
+        with ffts of fixed length n_fft over blocks of the recording.
+        """
         if self.obj_computed:
             return self.obj
 
-        conv_result = np.zeros(
-                [self.orig_n_unit, self.data_len + self.n_time - 1], dtype=np.float32)
-        for rank in range(self.approx_rank):
+        n_fft = fft.next_fast_len(max(1024, 4*self.n_time))
+        block_len = n_fft - self.n_time + 1
+        obj_len = self.data_len + self.n_time - 1
+
+        spatial, filters_fft = self.objective_filters(n_fft)
+        n_rank, n_unit, n_chan = spatial.shape
+        spatial = spatial.reshape(-1, n_chan)
+
+        conv_result = np.zeros([n_unit, obj_len], dtype=np.float32)
+        for start in range(0, self.data_len, block_len):
             matmul_result = np.matmul(
-                    self.spatial[:, rank] * self.singular[:, [rank]],
-                    self.data.T)
+                spatial, self.data[start:start+block_len].T)
+            matmul_fft = fft.rfft(
+                matmul_result.reshape(n_rank, n_unit, -1), n=n_fft, axis=2)
+
+            # sum over rank in frequency domain
+            conv_block = fft.irfft(
+                np.sum(matmul_fft*filters_fft, axis=0), n=n_fft, axis=1)
+
+            end = min(start + n_fft, obj_len)
+            conv_result[:, start:end] += conv_block[:, :end-start]
 
-            filters = self.temporal[:, :, rank]
-            for unit in range(self.orig_n_unit):
-                conv_result[unit, :] += np.convolve(
-                        matmul_result[unit, :], filters[unit], mode='full')
         self.obj = 2 * conv_result - self.norm
         # Set indicator to true so that it no longer is run
         # for future iterations in case subtractions are done
@@ -710,10 +764,9 @@ class MatchPursuit_objectiveUpsample(object):
             if os.path.exists(fname_out):
                 continue
             
-            # load pairwise conv filter only once per core:
+            # map pairwise conv filter only once per core:
             if self.pairwise_conv is None:
-                self.pairwise_conv = np.load(os.path.join(
-                    self.deconv_dir, "pairwise_conv.npy"))
+                self.pairwise_conv = SparsePairwiseConv(self.deconv_dir)
                 
             start_time = time.time()
             
@@ -0,0 +1,254 @@
+import os
+import numpy as np
+import torch
+from torch import nn
+
+from yass.deconvolve.match_pursuit_gpu_new import deconvGPU
+from yass.deconvolve.utils import reverse_shifts
+
+
+def bspline_basis(offsets, order=3):
+    ''' Values of the order+1 uniform b-spline bases that overlap a point
+        at fractional offset in [0, 1); same recursion as splineSubKernel
+        Input: [n_events] offsets
+        Output: [n_events, order+1]
+    '''
+    basis = torch.zeros((len(offsets), order+1), dtype=offsets.dtype,
+                        device=offsets.device)
+    for path in range(2**order):
+        id_, split, imj = path, 2**order, 0
+        coef = torch.ones_like(offsets)
+        for m in range(1, order+1):
+            split //= 2
+            if id_ < split:
+                coef = coef*(m - imj - offsets)/m
+                imj += 1
+            else:
+                coef = coef*(offsets + imj)/m
+            id_ = id_ % split
+        basis[:, order-imj] += coef
+
+    return basis
+
+
+def shift_splines(coefficients, temp_ids, shifts, scales, order=3):
+    ''' Templates at sub-sample shifts, scaled, evaluated from their
+        b-spline coefficients; what deconv.subtract_splines subtracts
+        from an objective of zeros, with the opposite sign
+        Input: [n_units, n_chans, n_times+order+1] coefficients,
+               [n_events] temp_ids, shifts and scales
+        Output: [n_events, n_times, n_chans]
+    '''
+
+    n_times = coefficients.shape[2] - order - 1
+
+    # negative offsets move to the next time step
+    offsets = -shifts.float()
+    idx_neg = offsets < 0
+    offsets[idx_neg] += 1
+
+    basis = bspline_basis(offsets, order)[:, None]
+    coefs = coefficients[temp_ids]
+    vals = coefs[:, :, :n_times]*basis[:, :, :1]
+    for k in range(1, order+1):
+        vals += coefs[:, :, k:k+n_times]*basis[:, :, k:k+1]
+    vals *= scales[:, None, None]
+
+    shifted = torch.zeros_like(vals)
+    shifted[~idx_neg] = vals[~idx_neg]
+    shifted[idx_neg, :, 1:] = vals[idx_neg, :, :-1]
+
+    return shifted.transpose(1, 2)
+
+
+class deconvCPU(deconvGPU):
+    ''' Cpu version of deconvGPU
+
+        Same objective, peak finding, superresolution shifts, height fit
+        and scd as deconvGPU. The cuda extensions are replaced by torch
+        cpu operations: rowshift by shifted matrix products when making
+        the objective and cudaSpline by batched b-spline evaluation and
+        index_add_ into the objective.
+    '''
+
+    # number of spikes subtracted at once in subtract_splines
+    spline_batch_size = 512
+
+    def data_to_gpu(self):
+        ''' keeps everything on the cpu; name kept for run_core_deconv
+        '''
+
+        self.peak_pts = torch.arange(-1,+2)
+
+        #norm
+        norm = np.sum(np.square(self.temps), (0, 1))
+        self.norms = torch.from_numpy(norm).float()
+
+        # spatial and temporal component of svd
+        self.spat_comp = torch.from_numpy(self.spat_comp).float()
+        self.temp_comp = torch.from_numpy(self.temp_comp).float()
+
+        # load vis units
+        fname_vis_units = os.path.join(self.init_dir, 'vis_units.npy')
+        vis_units = np.load(fname_vis_units, allow_pickle=True)
+
+        # spline coefficients of all units stacked by row (like
+        # deconv.BatchedTemplates): rows of unit k are
+        # coef_offsets[k]:coef_offsets[k+1], subtracted from
+        # objective rows coef_rows
+        n_rows = np.array([len(vis_units[p]) for p in range(len(vis_units))])
+        self.coef_offsets = torch.from_numpy(
+            np.hstack((0, np.cumsum(n_rows)))).long()
+        self.coef_counts = torch.from_numpy(n_rows).long()
+        self.coef_rows = torch.from_numpy(
+            np.hstack(vis_units).astype('int64'))
+        self.coefficients = torch.from_numpy(
+            np.vstack(self.coefficients)).float()
+
+        if self.fit_height:
+            self.large_units = torch.from_numpy(self.large_units)
+
+    def synchronize(self):
+        pass
+
+    def load_data(self, chunk_id):
+        '''  Function to load raw data
+        '''
+
+        # read dat using reader class
+        self.data_cpu = self.reader.read_data_batch(
+            chunk_id, add_buffer=True).T
+
+        self.offset = self.reader.idx_list[chunk_id, 0] - self.reader.buffer
+        # copy, make_objective_shifted_svd modifies it
+        self.data = torch.tensor(self.data_cpu, dtype=torch.float32)
+
+    def make_objective_shifted_svd(self):
+
+        n_chan, n_times = self.data.shape
+        self.obj_gpu = torch.zeros(
+            (self.K, n_times+self.STIME-1 + 2 * self.jitter_diff))
+        n_zeroed = np.zeros(n_chan, 'int64')
+        for unit in range(self.K):
+            # Do the shifts that was required for aligning template
+            shifts = reverse_shifts(self.align_shifts[unit])
+
+            # multiplication step on shifted data,
+            # one product per distinct shift
+            mm = torch.zeros((self.RANK, n_times))
+            spat_comp = self.spat_comp[unit]
+            vis_chan = np.where(np.any(spat_comp.numpy() != 0, 0))[0]
+            for shift in np.unique(shifts[vis_chan]):
+                chans = torch.from_numpy(vis_chan[shifts[vis_chan] == shift])
+                mm[:, shift:] += torch.mm(spat_comp[:, chans],
+                                          self.data[chans, :n_times-shift])
+
+            # Sum over Rank
+            self.obj_gpu[unit] = nn.functional.conv1d(
+                mm[None], self.temp_comp[unit][None],
+                padding=self.STIME-1)[0, 0]
+
+            # rowshift.backward drops the last samples of each shifted
+            # row, do the same to keep the objective identical
+            for c in np.where(shifts > n_zeroed)[0]:
+                self.data[c, n_times-shifts[c]:] = 0
+                n_zeroed[c] = shifts[c]
+
+        self.obj_gpu = 2 * self.obj_gpu - self.norms[:,None]
+
+    def subtract_cpp(self):
+
+        spike_times = self.spike_times.view(-1)-self.subtraction_offset
+        spike_temps = self.neuron_ids.view(-1)
+
+        # zero out shifts if superres shift turned off
+        if self.superres_shift==False:
+            self.xshifts = self.xshifts*0
+
+        self.subtract_splines(spike_times,
+                              self.xshifts.view(-1),
+                              spike_temps,
+                              self.tempScaling*self.heights.view(-1))
+
+        # also fill in self-convolution traces with low energy so the
+        #   spikes cannot be detected again (i.e. enforcing refractoriness)
+        if self.refractoriness:
+            self.refrac_fill(spike_times, spike_temps, -self.fill_value)
+
+    def add_cpp_allspikes(self):
+
+        # select all spikes from a previous iteration
+        (spike_times, spike_temps,
+         spike_shifts, spike_heights) = self.sample_spikes_allspikes()
+
+        if self.refractoriness:
+            self.refrac_fill(spike_times, spike_temps, self.fill_value)
+
+        # Add spikes back in;
+        self.subtract_splines(spike_times, spike_shifts, spike_temps,
+                              -self.tempScaling*spike_heights)
+
+    def subtract_splines(self, spike_times, spike_shifts,
+                         spike_temps, spike_scales):
+        ''' Subtract temp_temp of each spike, shifted by spike_shifts and
+            scaled by spike_scales, from the objective
+            (cpu version of deconv.subtract_splines)
+        '''
+
+        order = 3
+        n_coefs = self.coefficients.shape[1]
+        n_vals = n_coefs - order - 1
+        t_range = torch.arange(n_vals)
+        obj_len = self.obj_gpu.shape[1]
+        obj_flat = self.obj_gpu.view(-1)
+
+        # negative offsets move to the next time step
+        offsets = -spike_shifts.float()
+        idx_neg = offsets < 0
+        offsets[idx_neg] += 1
+        spike_times = spike_times + idx_neg.long()
+
+        basis = bspline_basis(offsets, order)
+
+        for j in range(0, len(spike_times), self.spline_batch_size):
+            batch = slice(j, j+self.spline_batch_size)
+            temps_ = spike_temps[batch]
+
+            # one row per spike and visible unit of its template
+            counts = self.coef_counts[temps_]
+            event_ids = torch.repeat_interleave(
+                torch.arange(len(temps_)), counts)
+            row_ids = (torch.arange(len(event_ids)) -
+                       torch.repeat_interleave(
+                           torch.cumsum(counts, 0) - counts, counts) +
+                       self.coef_offsets[temps_][event_ids])
+
+            # evaluate shifted splines
+            coefs = self.coefficients[row_ids]
+            basis_ = basis[batch][event_ids]
+            vals = coefs[:, :n_vals]*basis_[:, :1]
+            for k in range(1, order+1):
+                vals += coefs[:, k:k+n_vals]*basis_[:, k:k+1]
+            vals *= spike_scales[batch][event_ids][:, None]
+
+            # drop values that fall outside of the objective
+            times_ = spike_times[batch][event_ids][:, None] + t_range
+            valid = (times_ >= 0) & (times_ < obj_len)
+            index = self.coef_rows[row_ids][:, None]*obj_len + times_
+            obj_flat.index_add_(0, index[valid], -vals[valid])
+
+    def refrac_fill(self, spike_times, spike_temps, fill_value):
+        ''' add fill_value to the objective of the spiking unit around
+            each spike (cpu version of deconv.refrac_fill)
+        '''
+
+        fill_length = self.refractory*2+1
+        fill_offset = self.subtraction_offset-2-self.refractory
+
+        times = (spike_times[:, None] + fill_offset +
+                 torch.arange(fill_length))
+        units = spike_temps[:, None].expand_as(times)
+        valid = (times >= 0) & (times < self.obj_gpu.shape[1])
+        self.obj_gpu.index_put_(
+            (units[valid], times[valid]),
+            torch.full((int(valid.sum()),), fill_value), accumulate=True)
@@ -13,8 +13,13 @@ from torch import nn
 #from torch.autograd import Variable
 
 # cuda package to do GPU based spline interpolation and subtraction
-import cudaSpline as deconv
-import rowshift as rowshift
+# (not needed by the cpu backend, deconvolve.match_pursuit_cpu)
+try:
+    import cudaSpline as deconv
+    import rowshift as rowshift
+except ImportError:
+    deconv = None
+    rowshift = None
 
 from yass.postprocess.duplicate import abs_max_dist
 from yass.deconvolve.util import WaveForms
@@ -336,6 +341,9 @@ class deconvGPU(object):
         # gather results (and move to cpu)
         self.gather_results()
 
+    def synchronize(self):
+        torch.cuda.synchronize()
+
     def gather_results(self):
 
         # make spike train
@@ -440,7 +448,7 @@ class deconvGPU(object):
         del mm
         #del temp_out
         torch.cuda.empty_cache()
-        torch.cuda.synchronize()
+        self.synchronize()
         
 
     def save_spikes(self):
@@ -616,7 +624,7 @@ class deconvGPU(object):
             self.heights = height
             
         else:
-            self.heights = torch.ones(len(self.xshifts)).cuda()
+            self.heights = torch.ones_like(self.xshifts)
 
         return (dt.datetime.now().timestamp()- start1)
 
@@ -651,9 +659,9 @@ class deconvGPU(object):
         #       output:  n_times (i.e. the max energy function value at each point in time)
         #       note: windows are padded
         start = dt.datetime.now().timestamp()
-        torch.cuda.synchronize()
+        self.synchronize()
         self.gpu_max, self.neuron_ids = torch.max(self.obj_gpu, 0)
-        torch.cuda.synchronize()
+        self.synchronize()
         end_max = dt.datetime.now().timestamp()-start
 
         #np.save('/media/cat/2TB/liam/49channels/data1_allset_shifted_svd/tmp/block_2/deconv/neuron_ids_'+
@@ -707,7 +715,7 @@ class deconvGPU(object):
         
         start = dt.datetime.now().timestamp()
         
-        torch.cuda.synchronize()
+        self.synchronize()
         
         if False:
             self.spike_times = self.spike_times[:1]
@@ -793,7 +801,7 @@ class deconvGPU(object):
                     self.coefficients,
                     self.tempScaling*self.heights)
                                
-        torch.cuda.synchronize()
+        self.synchronize()
         
         # also fill in self-convolution traces with low energy so the
         #   spikes cannot be detected again (i.e. enforcing refractoriness)
@@ -808,7 +816,7 @@ class deconvGPU(object):
                                   fill_offset=self.subtraction_offset-2-self.refractory,
                                   fill_value=-self.fill_value)
 
-        torch.cuda.synchronize()
+        self.synchronize()
             
         return (dt.datetime.now().timestamp()-start)
 
@@ -828,12 +836,12 @@ class deconvGPU(object):
     def add_cpp_allspikes(self):
         #start = dt.datetime.now().timestamp()
         
-        torch.cuda.synchronize()
+        self.synchronize()
                         
         # select all spikes from a previous iteration
         spike_times, spike_temps, spike_shifts, spike_heights = self.sample_spikes_allspikes()
 
-        torch.cuda.synchronize()
+        self.synchronize()
 
         # also fill in self-convolution traces with low energy so the
         #   spikes cannot be detected again (i.e. enforcing refractoriness)
@@ -846,7 +854,7 @@ class deconvGPU(object):
                               fill_offset=self.subtraction_offset-2-self.refractory,
                               fill_value=self.fill_value)
 
-        torch.cuda.synchronize()
+        self.synchronize()
 
         # Add spikes back in;
         deconv.subtract_splines(
@@ -857,6 +865,6 @@ class deconvGPU(object):
                             self.coefficients,
                             -self.tempScaling*spike_heights)
 
-        torch.cuda.synchronize()
+        self.synchronize()
 
         return 
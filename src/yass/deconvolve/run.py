@@ -12,6 +12,7 @@ import torch.multiprocessing as mp
 from yass import read_config
 from yass.reader import READER
 from yass.deconvolve.match_pursuit_gpu_new import deconvGPU
+from yass.deconvolve.match_pursuit_cpu import deconvCPU
 from yass.deconvolve.util import make_CONFIG2
 
 def run(fname_templates_in,
@@ -123,7 +124,11 @@ def deconv_ONgpu(fname_templates_in,
                  run_chunk_sec):
 
     # **************** MAKE DECONV OBJECT *****************
-    d_gpu = deconvGPU(CONFIG, fname_templates_in, output_directory)
+    # same algorithm on cpu when gpu deconv is off or there is no gpu
+    if CONFIG.deconvolution.deconv_gpu and torch.cuda.is_available():
+        d_gpu = deconvGPU(CONFIG, fname_templates_in, output_directory)
+    else:
+        d_gpu = deconvCPU(CONFIG, fname_templates_in, output_directory)
 
     # Cat: TODO: read from CONFIG
     d_gpu.max_iter = 1000
@@ -270,15 +275,28 @@ def run_core_deconv(d_gpu, CONFIG):
     start_sec = int(d_gpu.reader.start/d_gpu.reader.sampling_rate)
     end_sec = int(start_sec + d_gpu.reader.n_sec_chunk*d_gpu.reader.n_batches)
     print ("running deconv from {} to {} seconds".format(start_sec, end_sec))
+    # one worker per gpu or, for the cpu version, per processor
+    if isinstance(d_gpu, deconvCPU):
+        n_workers = 1
+        if CONFIG.resources.multi_processing:
+            n_workers = CONFIG.resources.n_processors
+        devices = [torch.device('cpu')]*n_workers
+    else:
+        devices = CONFIG.torch_devices
+
+    # cpu workers split the cores among them
+    n_threads = max(torch.get_num_threads()//len(devices), 1)
+
     processes = []
-    if len(CONFIG.torch_devices) == 1:
-        run_core_deconv_parallel(d_gpu, chunk_ids, CONFIG.torch_devices[0].index)
+    if len(devices) == 1:
+        run_core_deconv_parallel(d_gpu, chunk_ids, devices[0])
     else:
         chunk_ids_split_gpu = np.array_split(
-             chunk_ids, len(CONFIG.torch_devices))
-        for ii, device in enumerate(CONFIG.torch_devices):
+             chunk_ids, len(devices))
+        for ii, device in enumerate(devices):
             p = mp.Process(target=run_core_deconv_parallel,
-                           args=(d_gpu, chunk_ids_split_gpu[ii], device.index))
+                           args=(d_gpu, chunk_ids_split_gpu[ii], device,
+                                 n_threads))
             p.start()
             processes.append(p)
         for p in processes:
@@ -287,9 +305,12 @@ def run_core_deconv(d_gpu, CONFIG):
     return d_gpu
 
 
-def run_core_deconv_parallel(d_gpu, chunk_ids, device):
+def run_core_deconv_parallel(d_gpu, chunk_ids, device, n_threads=None):
 
-    torch.cuda.set_device(device)
+    if device.type == 'cuda':
+        torch.cuda.set_device(device)
+    elif n_threads is not None:
+        torch.set_num_threads(n_threads)
     d_gpu.data_to_gpu()
 
     for chunk_id in chunk_ids:
@@ -32,21 +32,74 @@ def deduplicate_gpu(spike_index_torch, energy_torch,
 def deduplicate(spike_index, energy,
                 recording_shape, channel_index,
                 max_window=5):
+    """Sparse deduplication on CPU
 
-    # initialize energy train
-    energy_train = np.zeros(recording_shape)
-    energy_train[spike_index[:,0], spike_index[:, 1]] = energy
-    energy_train = torch.from_numpy(energy_train).float()
+    Keeps the spikes whose energy is the largest among all spikes within
+    max_window time samples on neighboring channels (channel_index).
+    Same output as deduplicate_gpu but without building a dense
+    (T, C) energy train: spikes are sorted by time and every spike is only
+    compared to the spikes in its time window, so cost and memory scale
+    with the number of spikes
 
-    maxpool = torch.nn.MaxPool2d(kernel_size=[max_window*2+1, 1],
-                                 stride=1, padding=[max_window, 0])
-    max_energy = maxpool(energy_train[None, None])[0, 0]
-    max_energy = torch.cat(
-        (max_energy,
-         torch.zeros([max_energy.shape[0], 1]).float()),
-        1)
-    max_energy = torch.max(max_energy[:, channel_index], 2)[0] - 1e-8
-    spike_train_dedup = torch.nonzero(
-        (energy_train >= max_energy) & (energy_train > 2)).data.numpy()
+    Parameters
+    ----------
+    spike_index: numpy.ndarray (n_spikes, 2)
+        time and channel of every spike
+    energy: numpy.ndarray (n_spikes,)
+    recording_shape: tuple
+        (T, C) shape of the recording spikes were detected on
+    channel_index: numpy.ndarray (C, n_neighbors)
+        neighbors of every channel, padded with C
+    max_window: int
 
-    return spike_index_dedup
+    Returns
+    -------
+    spike_index_dedup: numpy.ndarray (n_spikes_dedup, 2)
+        sorted by time and then channel
+    """
+    n_channels = recording_shape[1]
+
+    # spikes without energy are never kept
+    idx_keep = energy > 0
+    spike_index = spike_index[idx_keep]
+    energy = energy[idx_keep]
+
+    # sort by time, then channel and keep one entry per location
+    idx_sort = np.lexsort((spike_index[:, 1], spike_index[:, 0]))
+    spike_index = spike_index[idx_sort]
+    energy = energy[idx_sort]
+    if len(spike_index) > 0:
+        is_new = np.hstack((True, np.any(
+            spike_index[1:] != spike_index[:-1], axis=1)))
+        spike_index = spike_index[is_new]
+        energy = energy[is_new]
+
+    n_spikes = len(spike_index)
+    if n_spikes == 0:
+        return np.zeros((0, 2), spike_index.dtype)
+    times = spike_index[:, 0]
+    channels = spike_index[:, 1]
+
+    # neighbors[c, j] is True if j is a neighbor of c
+    neighbors = np.zeros((n_channels, n_channels + 1), 'bool')
+    neighbors[np.arange(n_channels)[:, None], channel_index] = True
+    neighbors = neighbors[:, :n_channels]
+
+    # spikes within max_window of each spike
+    window_start = np.searchsorted(times, times - max_window, side='left')
+    window_end = np.searchsorted(times, times + max_window, side='right')
+    n_pairs = window_end - window_start
+    pair_start = np.cumsum(n_pairs) - n_pairs
+
+    # all (spike, other spike) pairs in the windows, grouped by spike
+    idx_spike = np.repeat(np.arange(n_spikes), n_pairs)
+    idx_other = (np.arange(n_pairs.sum()) - np.repeat(pair_start, n_pairs) +
+                 np.repeat(window_start, n_pairs))
+
+    # largest energy among neighboring spikes
+    pair_energy = np.where(
+        neighbors[channels[idx_spike], channels[idx_other]],
+        energy[idx_other], 0)
+    max_energy = np.maximum.reduceat(pair_energy, pair_start)
+
+    return spike_index[energy >= max_energy - 1e-8]
@@ -2,58 +2,125 @@ import logging
 import os
 import numpy as np
 
-def gather_result(fname_save, batch_files_dir):
+def save_batch_result(fname, spike_index_list, spike_index_dedup_list,
+                      minibatch_loc):
+    """Save the spikes detected in a batch
+
+    Spikes outside of their minibatch (in the buffer) are removed and the
+    rest are sorted by time and saved as a single int32 array, so batches
+    are gathered without pickle and without sorting everything again
+
+    Parameters
+    ----------
+    fname: str
+        .npz file to save to
+    spike_index_list: list
+        spike index of every minibatch before deduplication
+    spike_index_dedup_list: list
+        spike index of every minibatch after deduplication
+    minibatch_loc: numpy.ndarray (n_minibatches, 2)
+        start and end of every minibatch (excluding buffer)
+    """
+    # kill edge spikes
+    spike_index = [np.zeros((0, 2), 'int32')]
+    for ctr in range(len(spike_index_dedup_list)):
+
+        t_start, t_end = minibatch_loc[ctr]
+        spike_index_temp = spike_index_dedup_list[ctr]
+
+        idx_keep = np.where(np.logical_and(
+            spike_index_temp[:, 0] >= t_start,
+            spike_index_temp[:, 0] < t_end))[0]
+        spike_index.append(spike_index_temp[idx_keep].astype('int32'))
 
-    logger = logging.getLogger(__name__)
-    logger.info('gather detected spikes')
+    spike_index = np.vstack(spike_index)
+    spike_index = spike_index[np.argsort(spike_index[:, 0], kind='mergesort')]
 
-    fnames = os.listdir(batch_files_dir)
-    spike_index = []
-    spike_index_prekill = []
-    n_spikes_prekill = 0
-    n_spikes_postkill = 0
-    for batch_id in range(len(fnames)):
-
-        # detection index
-        fname = os.path.join(batch_files_dir, fnames[batch_id])
-        detect_data =  np.load(fname, allow_pickle=True)
-        spike_index_prekill_list = detect_data['spike_index']
-        spike_index_list = detect_data['spike_index_dedup']
+    n_spikes_prekill = sum(len(s) for s in spike_index_list)
+
+    np.savez(fname,
+             spike_index=spike_index,
+             n_spikes=len(spike_index),
+             n_spikes_prekill=n_spikes_prekill)
+
+
+def _rewrite_old_batch_result(fname):
+    """Rewrite a batch saved by older versions (pickled lists of minibatch
+    spike indexes) in the format of save_batch_result
+    """
+    with np.load(fname, allow_pickle=True) as detect_data:
+        spike_index_list = list(detect_data['spike_index'])
+        spike_index_dedup_list = list(detect_data['spike_index_dedup'])
         minibatch_loc = detect_data['minibatch_loc']
 
-        # kill edge spikes and gather results
-        for ctr in range(len(spike_index_list)):
+    save_batch_result(fname, spike_index_list, spike_index_dedup_list,
+                      minibatch_loc)
 
-            t_start, t_end = minibatch_loc[ctr]
-            spike_index_temp = spike_index_list[ctr]
 
-            idx_keep = np.where(np.logical_and(
-                spike_index_temp[:, 0] >= t_start,
-                spike_index_temp[:, 0] < t_end))[0]
-            spike_index.append(spike_index_temp[idx_keep].astype('int32'))
+def gather_result(fname_save, batch_files_dir):
+    """Merge the spikes of every batch into a single spike index
+
+    Batches are already sorted, so they are copied one by one into a
+    memory-mapped output (sized from the number of spikes saved with
+    every batch) and only the spikes where consecutive batches overlap
+    in time are sorted again
+    """
+
+    logger = logging.getLogger(__name__)
+    logger.info('gather detected spikes')
 
-            spike_index_prekill.append(spike_index_prekill_list[ctr].astype('int32'))
+    fnames = sorted(fname for fname in os.listdir(batch_files_dir)
+                    if fname.startswith('detect_'))
+    fnames = [os.path.join(batch_files_dir, fname) for fname in fnames]
 
-            n_spikes_prekill += spike_index_prekill_list[ctr].shape[0]
-            n_spikes_postkill += len(idx_keep)
+    # batch offset table
+    n_spikes = np.zeros(len(fnames), 'int64')
+    n_spikes_prekill = 0
+    for ctr, fname in enumerate(fnames):
+        with np.load(fname) as detect_data:
+            old_format = 'n_spikes' not in detect_data.files
+        if old_format:
+            logger.info('rewriting {} saved in the old format'.format(fname))
+            _rewrite_old_batch_result(fname)
+
+        with np.load(fname) as detect_data:
+            n_spikes[ctr] = detect_data['n_spikes']
+            n_spikes_prekill += int(detect_data['n_spikes_prekill'])
+    offsets = np.hstack((0, np.cumsum(n_spikes)))
 
     logger.info('Total {} spikes detected'.format(
         n_spikes_prekill))
     logger.info('Total {} spikes survived after deduplication'.format(
-        n_spikes_postkill))
+        offsets[-1]))
 
-    spike_index = np.vstack(spike_index)
-    #spike_index_prekill = np.vstack(spike_index_prekill)
-    
-    idx_sort = np.argsort(spike_index[:,0])
-    spike_index = spike_index[idx_sort]
+    if offsets[-1] == 0:
+        np.save(fname_save, np.zeros((0, 2), 'int32'))
+        return
+
+    spike_index = np.lib.format.open_memmap(
+        fname_save, mode='w+', dtype='int32', shape=(int(offsets[-1]), 2))
+
+    for ctr, fname in enumerate(fnames):
+        if n_spikes[ctr] == 0:
+            continue
+
+        with np.load(fname) as detect_data:
+            spike_index_batch = detect_data['spike_index']
+
+        start, end = offsets[ctr], offsets[ctr+1]
+        spike_index[start:end] = spike_index_batch
 
-    #idx_sort = np.argsort(spike_index_prekill[:,0])
-    #spike_index_prekill = spike_index_prekill[idx_sort]
+        # merge with the spikes of previous batches that come later
+        first_time = spike_index_batch[0, 0]
+        if start > 0 and spike_index[start-1, 0] > first_time:
+            merge_start = np.searchsorted(spike_index[:start, 0],
+                                          first_time, side='right')
+            merged = spike_index[merge_start:end]
+            spike_index[merge_start:end] = merged[
+                np.argsort(merged[:, 0], kind='mergesort')]
 
-    np.save(fname_save, spike_index)
-    #np.save(fname_save[:fname_save.rfind('.')]+'_prekill.npy',
-    #        spike_index_prekill)
+    spike_index.flush()
+    del spike_index
 
 
 def gather_result_orig(fname_save, batch_files_dir, dedup_dir, output_directory):
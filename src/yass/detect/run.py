@@ -1,6 +1,7 @@
 """
 Detection pipeline
 """
+import copy
 import logging
 import os
 try:
@@ -19,9 +20,12 @@ from yass.neuralnetwork import Detect, Denoise
 from yass.util import file_loader
 from yass.threshold.detect import voltage_threshold
 from yass.detect.deduplication import deduplicate_gpu, deduplicate
-from yass.detect.output import gather_result
+from yass.detect.output import gather_result, save_batch_result
 from yass.geometry import make_channel_index
 
+# torch.inference_mode is only available in recent versions of torch
+inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
 
 def run(standardized_path, standardized_dtype,
         output_directory, run_chunk_sec='full'):
@@ -127,7 +131,14 @@ def run_neural_network(standardized_path, standardized_dtype,
 
     CONFIG = read_config()
 
-    os.environ["CUDA_VISIBLE_DEVICES"] = str(CONFIG.resources.gpu_id)
+    # devices to run on: every gpu or, on cpu only hosts,
+    # one cpu worker per processor
+    devices = CONFIG.torch_devices
+    if devices[0].type == 'cpu' and CONFIG.resources.multi_processing:
+        devices = [torch.device('cpu')]*CONFIG.resources.n_processors
+
+    if len(devices) == 1:
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(CONFIG.resources.gpu_id)
 
     # load NN detector
     detector = Detect(CONFIG.neuralnetwork.detect.n_filters,
@@ -168,22 +179,90 @@ def run_neural_network(standardized_path, standardized_dtype,
 
     # loop over each chunk
     batch_ids = np.arange(reader.n_batches)
-    if False:
-        batch_ids_split = np.split_array(batch_ids, len(CONFIG.torch_devices))
-        processes = []
-        for ii, device in enumerate(CONFIG.torch_devices):
-            p = mp.Process(target=run_nn_detction_batch,
-                           args=(batch_ids_split[ii], output_directory, reader, n_sec_chunk,
-                                 detector, denoiser, channel_index_dedup,
-                                 detect_threshold, device))
-            p.start()
-            processes.append(p)
-        for p in processes:
-            p.join()
+    if len(devices) > 1:
+        run_nn_detection_scheduler(batch_ids, devices, output_directory,
+                                   reader, n_sec_chunk, detector, denoiser,
+                                   channel_index_dedup, detect_threshold,
+                                   n_prefetch=CONFIG.resources.n_prefetch,
+                                   cpu_batch_size=CONFIG.neuralnetwork.cpu_batch_size,
+                                   cpu_quantize=CONFIG.neuralnetwork.cpu_quantize)
     else:
+        if devices[0].type == 'cuda':
+            device = CONFIG.resources.gpu_id
+        else:
+            device = devices[0]
         run_nn_detction_batch(batch_ids, output_directory, reader, n_sec_chunk,
                                  detector, denoiser, channel_index_dedup,
-                                 detect_threshold, device=CONFIG.resources.gpu_id)
+                                 detect_threshold, device=device,
+                                 n_prefetch=CONFIG.resources.n_prefetch,
+                                 cpu_batch_size=CONFIG.neuralnetwork.cpu_batch_size,
+                                 cpu_quantize=CONFIG.neuralnetwork.cpu_quantize)
+
+
+def run_nn_detection_scheduler(batch_ids, devices, output_directory,
+                               reader, n_sec_chunk,
+                               detector, denoiser,
+                               channel_index_dedup,
+                               detect_threshold,
+                               n_prefetch=2, cpu_batch_size=8,
+                               cpu_quantize=False):
+    """Run detection with one worker process per device
+
+    Batches are handed out through a shared queue, so each worker takes
+    a new batch as soon as it is done with the previous one. Batches that
+    already have a detect_XXXXX.npz file are skipped
+    """
+
+    # skip if the file exists
+    batch_ids = [batch_id for batch_id in batch_ids
+                 if not os.path.exists(os.path.join(
+                     output_directory,
+                     "detect_" + str(batch_id).zfill(5) + '.npz'))]
+
+    batch_queue = mp.Queue()
+    for batch_id in batch_ids:
+        batch_queue.put(batch_id)
+    # one stop signal per worker
+    for device in devices:
+        batch_queue.put(None)
+
+    # cpu workers split the cores among them
+    n_cpu_workers = sum(device.type == 'cpu' for device in devices)
+    n_threads = max(torch.get_num_threads()//max(n_cpu_workers, 1), 1)
+
+    processes = []
+    for device in devices:
+        p = mp.Process(target=run_nn_detection_worker,
+                       args=(batch_queue, output_directory, reader,
+                             n_sec_chunk, detector, denoiser,
+                             channel_index_dedup, detect_threshold,
+                             device, n_prefetch, n_threads,
+                             cpu_batch_size, cpu_quantize))
+        p.start()
+        processes.append(p)
+    for p in processes:
+        p.join()
+
+
+def run_nn_detection_worker(batch_queue, output_directory,
+                            reader, n_sec_chunk,
+                            detector, denoiser,
+                            channel_index_dedup,
+                            detect_threshold,
+                            device, n_prefetch=2, n_threads=None,
+                            cpu_batch_size=8, cpu_quantize=False):
+    """Run detection on batches taken from batch_queue until it gets None
+    """
+
+    if device.type == 'cuda':
+        torch.cuda.set_device(device)
+    elif n_threads is not None:
+        torch.set_num_threads(n_threads)
+
+    run_nn_detction_batch(iter(batch_queue.get, None), output_directory,
+                          reader, n_sec_chunk, detector, denoiser,
+                          channel_index_dedup, detect_threshold,
+                          device, n_prefetch, cpu_batch_size, cpu_quantize)
 
 
 def run_nn_detction_batch(batch_ids, output_directory,
@@ -191,87 +270,125 @@ def run_nn_detction_batch(batch_ids, output_directory,
                           detector, denoiser,
                           channel_index_dedup,
                           detect_threshold,
-                          device):
+                          device, n_prefetch=2,
+                          cpu_batch_size=8, cpu_quantize=False):
+    """Run detection and denoising on batches and save the spikes of
+    each batch to detect_XXXXX.npz
+
+    On gpu, minibatches go through the networks one at a time. On cpu,
+    cpu_batch_size minibatches are stacked into a single forward pass and
+    the linear layers are optionally quantized to int8 (cpu_quantize)
+    """
 
+    device = torch.device(device)
     detector = detector.to(device)
     denoiser = denoiser.to(device)
 
-    for batch_id in batch_ids:
-        # skip if the file exists
+    if device.type == 'cpu':
+        n_stacked = cpu_batch_size
+        if cpu_quantize:
+            detector = quantize_output_layer(detector)
+            denoiser = quantize_output_layer(denoiser)
+    else:
+        n_stacked = 1
+
+    # skip if the file exists. batch_ids can be an iterator that hands
+    # out batches on demand, so it is not consumed here
+    batch_ids = (batch_id for batch_id in batch_ids
+                 if not os.path.exists(os.path.join(
+                     output_directory,
+                     "detect_" + str(batch_id).zfill(5) + '.npz')))
+
+    # get a bach of size n_sec_chunk
+    # but partioned into smaller minibatches of 
+    # size n_sec_chunk_gpu. next batches are read while
+    # the current one is processed
+    batches = reader.prefetch(batch_ids, n_prefetch,
+                              n_sec_chunk, add_buffer=True)
+    for batch_id, (batched_recordings, minibatch_loc_rel) in batches:
         fname = os.path.join(
             output_directory,
             "detect_" + str(batch_id).zfill(5) + '.npz')
 
-        if os.path.exists(fname):
-            continue
-
-
-        # get a bach of size n_sec_chunk
-        # but partioned into smaller minibatches of 
-        # size n_sec_chunk_gpu
-        batched_recordings, minibatch_loc_rel = reader.read_data_batch_batch(
-            batch_id,
-            #CONFIG.detect.n_sec_chunk,
-            n_sec_chunk,
-            add_buffer=True)
-
         # offset for big batch
         batch_offset = reader.idx_list[batch_id, 0] - reader.buffer
         # location of each minibatch (excluding buffer)
         minibatch_loc = minibatch_loc_rel + batch_offset
         spike_index_list = []
         spike_index_dedup_list = []
-        for j in range(batched_recordings.shape[0]):
-            # detect spikes and get wfs
-            spike_index, wfs = detector.get_spike_times(
-                torch.FloatTensor(batched_recordings[j]).to(device),
-                threshold=detect_threshold)
-
-            # denoise and take ptp as energy
-            if len(spike_index) == 0:
-                del spike_index, wfs
-                continue
-
-            wfs_denoised = denoiser(wfs)[0].data
-            energy = (torch.max(wfs_denoised, 1)[0] - torch.min(wfs_denoised, 1)[0])
-
-            # deduplicate
-            spike_index_dedup = deduplicate_gpu(
-                spike_index, energy,
-                batched_recordings[j].shape,
-                channel_index_dedup)
-
-            # convert to numpy
-            spike_index_cpu = spike_index.cpu().data.numpy()
-            spike_index_dedup_cpu = spike_index_dedup.cpu().data.numpy()
-
-            # update the location relative to the whole recording
-            spike_index_cpu[:, 0] += (minibatch_loc[j, 0] - reader.buffer)
-            spike_index_dedup_cpu[:, 0] += (minibatch_loc[j, 0] - reader.buffer)
-            spike_index_list.append(spike_index_cpu)
-            spike_index_dedup_list.append(spike_index_dedup_cpu)
-
-            del wfs
-            del wfs_denoised
-            del energy
+        for j in range(0, batched_recordings.shape[0], n_stacked):
+            recordings = torch.FloatTensor(
+                batched_recordings[j:j+n_stacked]).to(device)
+
+            with inference_mode():
+                # detect spikes and get wfs
+                spike_index, wfs = detector.get_spike_times_batched(
+                    recordings, threshold=detect_threshold)
+
+                # denoise and take ptp as energy
+                if len(spike_index) > 0:
+                    wfs_denoised = denoiser(wfs)[0].data
+                    energy = (torch.max(wfs_denoised, 1)[0] -
+                              torch.min(wfs_denoised, 1)[0])
+
+            for k in range(recordings.shape[0]):
+                # spikes of this minibatch
+                idx_minibatch = spike_index[:, 0] == k
+                if len(spike_index) == 0 or not torch.any(idx_minibatch):
+                    spike_index_list.append(np.zeros((0, 2), 'int64'))
+                    spike_index_dedup_list.append(np.zeros((0, 2), 'int64'))
+                    continue
+                spike_index_k = spike_index[idx_minibatch][:, 1:]
+
+                # deduplicate
+                spike_index_dedup = deduplicate_gpu(
+                    spike_index_k, energy[idx_minibatch],
+                    recordings.shape[1:],
+                    channel_index_dedup)
+
+                # convert to numpy
+                spike_index_cpu = spike_index_k.cpu().data.numpy()
+                spike_index_dedup_cpu = spike_index_dedup.cpu().data.numpy()
+
+                # update the location relative to the whole recording
+                spike_index_cpu[:, 0] += (minibatch_loc[j+k, 0] - reader.buffer)
+                spike_index_dedup_cpu[:, 0] += (minibatch_loc[j+k, 0] - reader.buffer)
+                spike_index_list.append(spike_index_cpu)
+                spike_index_dedup_list.append(spike_index_dedup_cpu)
+
+            del recordings
             del spike_index
-            del spike_index_dedup
-
-            torch.cuda.empty_cache()
+            if device.type == 'cuda':
+                torch.cuda.empty_cache()
 
         #if processing_ctr%100==0:
         print('batch : {}'.format(batch_id))
 
         # save result
-        np.savez(fname,
-                 spike_index=spike_index_list,
-                 spike_index_dedup=spike_index_dedup_list,
-                 minibatch_loc=minibatch_loc)
+        save_batch_result(fname,
+                          spike_index_list,
+                          spike_index_dedup_list,
+                          minibatch_loc)
         
     del detector
     del denoiser
 
 
+def quantize_output_layer(model):
+    """Copy of model with its output (linear) layer dynamically quantized
+    to int8 for cpu inference
+
+    quantize_dynamic is not called on the whole model since Detect and
+    Denoise override nn.Module.train, which quantize_dynamic relies on
+    """
+    model = copy.deepcopy(model)
+    model.out = torch.quantization.quantize_dynamic(
+        torch.nn.Sequential(model.out), {torch.nn.Linear},
+        dtype=torch.qint8)[0]
+
+    return model
+
+
 def run_voltage_treshold(standardized_path, standardized_dtype,
                          output_directory, run_chunk_sec='full'):
                            
@@ -309,80 +426,81 @@ def run_voltage_treshold(standardized_path, standardized_dtype,
     channel_index = make_channel_index(
         CONFIG.neigh_channels, CONFIG.geom, steps=2)
     
+    # each process reads its own set of batches
+    if CONFIG.resources.multi_processing:
+        n_processors = CONFIG.resources.n_processors
+    else:
+        n_processors = 1
+    batch_ids = np.array_split(np.arange(reader.n_batches), n_processors)
+
     if CONFIG.resources.multi_processing:
-        parmap.starmap(run_voltage_threshold_parallel, 
-                       list(zip(np.arange(reader.n_batches))),
-                       reader,
-                       n_sec_chunk,
-                       CONFIG.detect.threshold,
-                       channel_index,
-                       output_directory,
-                       processes=CONFIG.resources.n_processors,
-                       pm_pbar=True)                
+        parmap.map(run_voltage_threshold_parallel,
+                   batch_ids,
+                   reader,
+                   n_sec_chunk,
+                   CONFIG.detect.threshold,
+                   channel_index,
+                   output_directory,
+                   CONFIG.resources.n_prefetch,
+                   processes=n_processors,
+                   pm_pbar=True)
     else:
-        for batch_id in range(reader.n_batches):
-            run_voltage_threshold_parallel(
-                batch_id,
-                reader,
-                n_sec_chunk,
-                CONFIG.detect.threshold,
-                channel_index,
-                output_directory)
+        run_voltage_threshold_parallel(
+            batch_ids[0],
+            reader,
+            n_sec_chunk,
+            CONFIG.detect.threshold,
+            channel_index,
+            output_directory,
+            CONFIG.resources.n_prefetch)
 
 
-def run_voltage_threshold_parallel(batch_id, reader, n_sec_chunk,
+def run_voltage_threshold_parallel(batch_ids, reader, n_sec_chunk,
                                    threshold, channel_index,
-                                   output_directory):
+                                   output_directory, n_prefetch=2):
 
     # skip if the file exists
-    fname = os.path.join(
-        output_directory,
-        "detect_" + str(batch_id).zfill(5) + '.npz')
-
-    if os.path.exists(fname):
-        return
+    batch_ids = [batch_id for batch_id in batch_ids
+                 if not os.path.exists(os.path.join(
+                     output_directory,
+                     "detect_" + str(batch_id).zfill(5) + '.npz'))]
 
     # get a bach of size n_sec_chunk
     # but partioned into smaller minibatches of 
-    # size n_sec_chunk_gpu
-    batched_recordings, minibatch_loc_rel = reader.read_data_batch_batch(
-        batch_id,
-        n_sec_chunk,
-        add_buffer=True)
-
-    # offset for big batch
-    batch_offset = reader.idx_list[batch_id, 0] - reader.buffer
-    # location of each minibatch (excluding buffer)
-    minibatch_loc = minibatch_loc_rel + batch_offset
-    spike_index_list = []
-    spike_index_dedup_list = []
-    for j in range(batched_recordings.shape[0]):
-        spike_index, energy = voltage_threshold(
-            batched_recordings[j], 
-            threshold)
-
-        # move to gpu
-        spike_index = torch.from_numpy(spike_index)
-        energy = torch.from_numpy(energy)
-
-        # deduplicate
-        spike_index_dedup = deduplicate_gpu(
-            spike_index, energy,
-            batched_recordings[j].shape,
-            channel_index)
-
-        # convert to numpy
-        spike_index = spike_index.cpu().data.numpy()
-        spike_index_dedup = spike_index_dedup.cpu().data.numpy()
-        
-        # update the location relative to the whole recording
-        spike_index[:, 0] += (minibatch_loc[j, 0] - reader.buffer)
-        spike_index_dedup[:, 0] += (minibatch_loc[j, 0] - reader.buffer)
-        spike_index_list.append(spike_index)
-        spike_index_dedup_list.append(spike_index_dedup)
-
-    # save result
-    np.savez(fname,
-             spike_index=spike_index_list,
-             spike_index_dedup=spike_index_dedup_list,
-             minibatch_loc=minibatch_loc)
+    # size n_sec_chunk_gpu. next batches are read while
+    # the current one is processed
+    batches = reader.prefetch(batch_ids, n_prefetch,
+                              n_sec_chunk, add_buffer=True)
+    for batch_id, (batched_recordings, minibatch_loc_rel) in batches:
+        fname = os.path.join(
+            output_directory,
+            "detect_" + str(batch_id).zfill(5) + '.npz')
+
+        # offset for big batch
+        batch_offset = reader.idx_list[batch_id, 0] - reader.buffer
+        # location of each minibatch (excluding buffer)
+        minibatch_loc = minibatch_loc_rel + batch_offset
+        spike_index_list = []
+        spike_index_dedup_list = []
+        for j in range(batched_recordings.shape[0]):
+            spike_index, energy = voltage_threshold(
+                batched_recordings[j], 
+                threshold)
+
+            # deduplicate
+            spike_index_dedup = deduplicate(
+                spike_index, energy,
+                batched_recordings[j].shape,
+                channel_index)
+
+            # update the location relative to the whole recording
+            spike_index[:, 0] += (minibatch_loc[j, 0] - reader.buffer)
+            spike_index_dedup[:, 0] += (minibatch_loc[j, 0] - reader.buffer)
+            spike_index_list.append(spike_index)
+            spike_index_dedup_list.append(spike_index_dedup)
+
+        # save result
+        save_batch_result(fname,
+                          spike_index_list,
+                          spike_index_dedup_list,
+                          minibatch_loc)
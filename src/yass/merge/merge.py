@@ -4,20 +4,32 @@ import tqdm
 import parmap
 import scipy
 import logging
+from collections import OrderedDict
 
 from diptest import diptest as dp
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis as LDA
-from sklearn.metrics import pairwise_distances
 import networkx as nx
+from scipy.spatial import cKDTree
 from scipy.spatial.distance import pdist, squareform
 from sklearn.cluster import AgglomerativeClustering
 
 from yass.template import shift_chans, align_get_shifts_with_ref
+from yass.spike_train import SpikeTrain
 from yass.correlograms_phy import compute_correlogram_v2
 from yass.merge.notch import notch_finder
 
 class TemplateMerge(object):
 
+    # max number of spikes per pair used in the merge test
+    n_samples = 2000
+    # bytes of clean waveforms kept in memory (per process)
+    waveform_cache_bytes = 2**28
+    # number of spatial whiteners kept in memory
+    whitener_cache_size = 256
+    # per spike arrays saved in save_dir and memory mapped, in
+    # worker processes too
+    shared_arrays = ['spike_train', 'shifts', 'scales', 'soft_assignment']
+
     def __init__(self, 
                  save_dir,
                  reader_residual,
@@ -50,7 +62,8 @@ class TemplateMerge(object):
         self.reader_residual = reader_residual
 
         # templates
-        self.templates = np.load(fname_templates)
+        self.fname_templates = fname_templates
+        self.templates = np.load(fname_templates, mmap_mode='r')
         self.n_units, self.spike_size, self.n_channels = self.templates.shape
 
         # compute ptp
@@ -72,6 +85,11 @@ class TemplateMerge(object):
         self.scales = self.scales[idx_in]
         self.soft_assignment = self.soft_assignment[idx_in]
 
+        # save them in save_dir and memory map them
+        for name in self.shared_arrays:
+            np.save(self.shared_fname(name), getattr(self, name))
+        self.load_shared_arrays()
+
         self.multi_processing = multi_processing
         self.n_processors = n_processors
 
@@ -97,11 +115,48 @@ class TemplateMerge(object):
         self.get_temproal_whitener()
         self.geom = geom
 
+        # waveforms read per unit and lru caches used by
+        # merge_templates_parallel
+        self.get_waveform_windows()
+        self.waveform_cache = OrderedDict()
+        self.whitener_cache = OrderedDict()
+
+    def shared_fname(self, name):
+        return os.path.join(self.save_dir, '{}_merge_in.npy'.format(name))
+
+    def load_shared_arrays(self):
+        """memory map templates, spike train and per spike arrays"""
+        self.templates = np.load(self.fname_templates, mmap_mode='r')
+        for name in self.shared_arrays:
+            setattr(self, name, np.load(self.shared_fname(name),
+                                        mmap_mode='r'))
+
+        # per unit spike indexes
+        self.spike_train_index = SpikeTrain.load(
+            self.shared_fname('spike_train'))
+
+    def __getstate__(self):
+        # worker processes (parmap) memory map the large arrays
+        # again instead of receiving copies of them
+        state = self.__dict__.copy()
+        for name in self.shared_arrays + ['templates', 'spike_train_index']:
+            del state[name]
+
+        # caches are per process
+        state['waveform_cache'] = OrderedDict()
+        state['whitener_cache'] = OrderedDict()
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.load_shared_arrays()
+
     def compute_n_spikes_soft(self):
 
-        n_spikes_soft = np.zeros(self.n_units)
-        for j in range(self.spike_train.shape[0]):
-            n_spikes_soft[self.spike_train[j, 1]] += self.soft_assignment[j]
+        n_spikes_soft = np.bincount(self.spike_train[:, 1],
+                                    weights=self.soft_assignment,
+                                    minlength=self.n_units)
         self.n_spikes_soft = n_spikes_soft.astype('int32')
 
     def get_temproal_whitener(self):
@@ -131,48 +186,43 @@ class TemplateMerge(object):
         # mask out small ptp
         self.ptps[self.ptps < 1] = 0
 
-        # distances of ptps
-        dist_mat = np.square(pairwise_distances(self.ptps))
-
-        # compute distance relative to the norm of ptps
-        norms = np.square(np.linalg.norm(self.ptps, axis=1))
-
-        # exclude comparing to self
-        for i in range(self.n_units):
-            dist_mat[i, i] = np.max(norms)*100
-
-        dist_norm_ratio = dist_mat / np.maximum(
-            norms[np.newaxis], norms[:, np.newaxis])
-        # units need to be close to each other
-        idx1 = dist_norm_ratio < 0.5
-
-        # ptp of both units need to be bigger than 3
-        ptp_max = self.ptps.max(1)
-        smaller_ptps = np.minimum(ptp_max[np.newaxis],
-                                  ptp_max[:, np.newaxis])
-        idx2 = smaller_ptps > 3
-
+        # ptp of both units need to be bigger than 3 and
         # expect to have at least 10 spikes
-        smaller_n_spikes = np.minimum(self.n_spikes_soft[None],
-                                      self.n_spikes_soft[:, None])
-        idx3 = smaller_n_spikes > 10
-
-        units_1, units_2 = np.where(np.logical_and(
-            np.logical_and(idx1, idx2), idx3))
-        
-        # get unique pairs only for comparison
-        unique_pairs = []
-        for x, y in zip(units_1, units_2):
-            if [x, y] not in unique_pairs and [y, x] not in unique_pairs:
-                ratio = self.n_spikes_soft[x]/self.n_spikes_soft[y]
-                # if the ratio is too bad, ignore it because it will
-                # always try to merge
-                if ((ratio > 1/20 and ratio < 20) or 
-                    (ptp_max[x] > 10 and ptp_max[y] > 10)):
-                    unique_pairs.append([x, y])
-
-        self.merge_candidates = unique_pairs
-
+        ptp_max = self.ptps.max(1)
+        units = np.where(np.logical_and(ptp_max > 3,
+                                        self.n_spikes_soft > 10))[0]
+        ptps = self.ptps[units].astype('float64')
+        norms = np.linalg.norm(ptps, axis=1)
+
+        # units need to be close to each other: squared distance less
+        # than half of the larger squared norm, i.e. one of the two is
+        # within sqrt(0.5)*norm of the other
+        tree = cKDTree(ptps)
+        neighbors = tree.query_ball_point(ptps, np.sqrt(0.5)*norms*(1+1e-6))
+        n_neighbors = np.array([len(nn) for nn in neighbors], 'int64')
+        units_1 = np.repeat(np.arange(len(units)), n_neighbors)
+        units_2 = np.hstack([[]] + list(neighbors)).astype('int64')
+
+        # upper triangular pairs, each once
+        pairs = np.unique(np.vstack((np.minimum(units_1, units_2),
+                                     np.maximum(units_1, units_2))), axis=1)
+        pairs = pairs[:, pairs[0] < pairs[1]]
+
+        # exact test on the found pairs
+        dist = np.sum(np.square(ptps[pairs[0]] - ptps[pairs[1]]), 1)
+        dist_norm_ratio = dist / np.square(np.maximum(norms[pairs[0]],
+                                                      norms[pairs[1]]))
+        pairs = units[pairs[:, dist_norm_ratio < 0.5]]
+
+        # if the ratio is too bad, ignore it because it will
+        # always try to merge
+        ratio = (self.n_spikes_soft[pairs[0]] /
+                 self.n_spikes_soft[pairs[1]].astype('float64'))
+        idx_keep = np.logical_or(
+            np.logical_and(ratio > 1/20, ratio < 20),
+            np.logical_and(ptp_max[pairs[0]] > 10, ptp_max[pairs[1]] > 10))
+
+        self.merge_candidates = pairs[:, idx_keep].T
 
     def xcor_notch_test(self, pairs, templates):
 
@@ -263,11 +313,11 @@ class TemplateMerge(object):
 
             if self.multi_processing:
                 # break the list of pairs
-                merge_candidates_partition = []
-                for j in range(self.n_processors):
-                    merge_candidates_partition.append(
-                        self.merge_candidates[
-                            slice(j, len(self.merge_candidates), self.n_processors)])
+                # contiguous blocks of pairs, so that each process
+                # sees few units
+                merge_candidates_partition = np.array_split(
+                    np.asarray(self.merge_candidates, 'int64').reshape(-1, 2),
+                    self.n_processors)
 
                 merge_pairs_ = parmap.map(
                     self.merge_templates_parallel, 
@@ -295,11 +345,16 @@ class TemplateMerge(object):
 
     def merge_templates_parallel(self, pairs):
         """Whether to merge two templates or not.
+
+        pairs are visited by unit and the clean waveforms of a unit are
+        read once and kept in a small lru cache (see clean_waveforms)
         """
-        n_samples = 2000
         p_val_threshold = 0.9
         merge_pairs = []
 
+        pairs = np.asarray(pairs, 'int64').reshape(-1, 2)
+        pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+
         for pair in pairs:
             unit1, unit2 = pair
 
@@ -312,82 +367,28 @@ class TemplateMerge(object):
                     merge_pairs.append(pair)
 
             else:
-                
-                # get spikes times and soft assignment
-                idx1 = self.spike_train[:, 1] == unit1
-                spt1 = self.spike_train[idx1, 0]
-                prob1 = self.soft_assignment[idx1]
-                shift1 = self.shifts[idx1]
-                scale1 = self.scales[idx1]
+
                 n_spikes1 = self.n_spikes_soft[unit1]
-                
-                idx2 = self.spike_train[:, 1] == unit2
-                spt2 = self.spike_train[idx2, 0]
-                prob2 = self.soft_assignment[idx2]
-                shift2 = self.shifts[idx2]
-                scale2 = self.scales[idx2]
                 n_spikes2 = self.n_spikes_soft[unit2]
-                
-                # randomly subsample
-                if n_spikes1 + n_spikes2 > n_samples:
+
+                # subsample by the ratio of soft counts
+                if n_spikes1 + n_spikes2 > self.n_samples:
                     ratio1 = n_spikes1/float(n_spikes1+n_spikes2)
-                    n_samples1 = np.min((int(n_samples*ratio1), n_spikes1))
-                    n_samples2 = n_samples - n_samples1
+                    n_samples1 = np.min((int(self.n_samples*ratio1), n_spikes1))
+                    n_samples2 = self.n_samples - n_samples1
 
                 else:
                     n_samples1 = n_spikes1
                     n_samples2 = n_spikes2
-                idx1_ = np.random.choice(len(spt1), n_samples1, replace=False,
-                                         p=prob1/np.sum(prob1))
-                idx2_ = np.random.choice(len(spt2), n_samples2, replace=False,
-                                         p=prob2/np.sum(prob2))
-                spt1 = spt1[idx1_]
-                spt2 = spt2[idx2_]
-                shift1 = shift1[idx1_]
-                shift2 = shift2[idx2_]
-                scale1 = scale1[idx1_]
-                scale2 = scale2[idx2_]
-
-                ptp_max = self.ptps[[unit1, unit2]].max(0)
-                mc = ptp_max.argmax()
-                vis_chan = np.where(ptp_max > 1)[0]
-
-                # align two units
-                shift_temp = (self.templates[unit2, :, mc].argmin() - 
-                              self.templates[unit1, :, mc].argmin())
-                spt2 += shift_temp
-                
-                # load residuals
-                wfs1, skipped_idx1 = self.reader_residual.read_waveforms(
-                    spt1, self.spike_size, vis_chan)
-                spt1 = np.delete(spt1, skipped_idx1)
-                shift1 = np.delete(shift1, skipped_idx1)
-                scale1 = np.delete(scale1, skipped_idx1)
-                
-                wfs2, skipped_idx2 = self.reader_residual.read_waveforms(
-                    spt2, self.spike_size, vis_chan)
-                spt2 = np.delete(spt2, skipped_idx1)
-                shift2 = np.delete(shift2, skipped_idx2)
-                scale2 = np.delete(scale2, skipped_idx2)
-                
-                # align residuals
-                wfs1 = shift_chans(wfs1, -shift1)
-                wfs2 = shift_chans(wfs2, -shift2)
-
-                # make clean waveforms
-                wfs1 += scale1[:, None, None]*self.templates[[unit1], :, vis_chan].T
-                if shift_temp > 0:
-                    temp_2_shfted = self.templates[[unit2], shift_temp:, vis_chan].T
-                    wfs2[:, :-shift_temp] += scale2[:, None, None]*temp_2_shfted
-                elif shift_temp < 0:
-                    temp_2_shfted = self.templates[[unit2], :shift_temp, vis_chan].T
-                    wfs2[:, -shift_temp:] += scale2[:, None, None]*temp_2_shfted
-                else:
-                    wfs2 += scale2[:, None, None]*self.templates[[unit2],:,vis_chan].T
 
-                
+                vis_chan, shift_temp = self.pair_alignment(unit1, unit2)
+
+                # clean waveforms on vis_chan, unit2 shifted by shift_temp
+                wfs1 = self.clean_waveforms(unit1, vis_chan, 0)[:n_samples1]
+                wfs2 = self.clean_waveforms(unit2, vis_chan, shift_temp)[:n_samples2]
+
                 # compute spatial covariance
-                spatial_whitener = self.get_spatial_whitener(vis_chan)
+                spatial_whitener = self.cached_spatial_whitener(vis_chan)
                 # whiten
                 wfs1_w = np.matmul(wfs1, spatial_whitener)
                 wfs2_w = np.matmul(wfs2, spatial_whitener)
@@ -396,9 +397,7 @@ class TemplateMerge(object):
                 wfs2_w = np.matmul(wfs2_w.transpose(0,2,1),
                                   self.temporal_whitener).transpose(0,2,1)
 
-
                 temp_diff_w = np.mean(wfs1_w, 0) - np.mean(wfs2_w,0)
-                c_w = np.sum(0.5*(np.mean(wfs1_w, 0) + np.mean(wfs2_w,0))*temp_diff_w)
                 dat1_w = np.sum(wfs1_w*temp_diff_w, (1,2))
                 dat2_w = np.sum(wfs2_w*temp_diff_w, (1,2))
                 dat_all = np.hstack((dat1_w, dat2_w))
@@ -410,14 +409,6 @@ class TemplateMerge(object):
                     merge= False
 
                 centers_dist = np.linalg.norm(temp_diff_w)
-
-
-                if p_val > p_val_threshold:
-                    merge = True
-                else:
-                    merge= False
-                    
-                centers_dist = np.linalg.norm(temp_diff_w)
                 np.savez(fname_out,
                          merge=merge,
                          dat1_w=dat1_w,
@@ -430,6 +421,98 @@ class TemplateMerge(object):
 
         return merge_pairs
 
+    def pair_alignment(self, unit1, unit2):
+        """channels to compare two units on and the time shift
+        that aligns unit2 to unit1
+        """
+        ptp_max = self.ptps[[unit1, unit2]].max(0)
+        mc = ptp_max.argmax()
+        vis_chan = np.where(ptp_max > 1)[0]
+
+        shift_temp = (self.templates[unit2, :, mc].argmin() -
+                      self.templates[unit1, :, mc].argmin())
+
+        return vis_chan, shift_temp
+
+    def get_waveform_windows(self):
+        """channels and extra time samples read for each unit, enough to
+        cover all of the merge candidate pairs it is in
+        """
+        self.waveform_chans = {}
+        self.waveform_pads = {}
+        for unit1, unit2 in np.asarray(self.merge_candidates,
+                                       'int64').reshape(-1, 2):
+            vis_chan, shift_temp = self.pair_alignment(unit1, unit2)
+            for unit in (unit1, unit2):
+                self.waveform_chans[unit] = np.union1d(
+                    self.waveform_chans.get(unit, vis_chan), vis_chan)
+            self.waveform_pads[unit1] = self.waveform_pads.get(unit1, 0)
+            self.waveform_pads[unit2] = max(
+                self.waveform_pads.get(unit2, 0), abs(shift_temp))
+
+    def clean_waveforms(self, unit, vis_chan, shift):
+        """sampled clean waveforms (residual + scaled template, aligned
+        by the deconv shifts) of a unit on vis_chan, shifted in time by
+        shift
+
+        n_samples spikes of a unit are drawn by soft assignment with the
+        unit id as seed and read once with a window that covers all of
+        its merge pairs. the most recently used units are kept in memory,
+        up to waveform_cache_bytes. a pair uses the first spikes of each unit, which are
+        themselves a sample without replacement.
+        """
+        if unit in self.waveform_cache:
+            wfs = self.waveform_cache.pop(unit)
+        else:
+            wfs = self.read_clean_waveforms(unit)
+            # evict least recently used units
+            n_bytes = wfs.nbytes + sum(
+                w.nbytes for w in self.waveform_cache.values())
+            while self.waveform_cache and n_bytes > self.waveform_cache_bytes:
+                n_bytes -= self.waveform_cache.popitem(last=False)[1].nbytes
+        self.waveform_cache[unit] = wfs
+
+        pad = self.waveform_pads[unit]
+        chans = np.searchsorted(self.waveform_chans[unit], vis_chan)
+
+        return wfs[:, pad+shift:pad+shift+self.spike_size][:, :, chans]
+
+    def read_clean_waveforms(self, unit):
+
+        chans = self.waveform_chans[unit]
+        pad = self.waveform_pads[unit]
+
+        idx = self.spike_train_index.unit_index(unit)
+        prob = self.soft_assignment[idx]
+        n_samples = np.min((self.n_samples, self.n_spikes_soft[unit]))
+        idx = idx[np.random.RandomState(unit).choice(
+            len(idx), n_samples, replace=False, p=prob/np.sum(prob))]
+
+        # load residuals
+        wfs, skipped_idx = self.reader_residual.read_waveforms(
+            self.spike_train[idx, 0], self.spike_size+2*pad, chans)
+        idx = np.delete(idx, skipped_idx)
+
+        # align residuals and add templates
+        wfs = shift_chans(wfs, -self.shifts[idx])
+        wfs[:, pad:pad+self.spike_size] += (
+            self.scales[idx, None, None]*self.templates[unit][:, chans])
+
+        return wfs
+
+    def cached_spatial_whitener(self, vis_chan):
+
+        key = vis_chan.tobytes()
+        if key in self.whitener_cache:
+            whitener = self.whitener_cache.pop(key)
+        else:
+            whitener = self.get_spatial_whitener(vis_chan)
+            if len(self.whitener_cache) >= self.whitener_cache_size:
+                self.whitener_cache.popitem(last=False)
+        self.whitener_cache[key] = whitener
+
+        return whitener
+
     def merge_templates_parallel_orig(self, pairs):
         """Whether to merge two templates or not.
         """
@@ -489,11 +572,11 @@ class TemplateMerge(object):
 
     def get_l2_features(self, unit1, unit2, n_samples=2000):
 
-        idx1 = self.spike_train[:, 1] == unit1
+        idx1 = self.spike_train_index.unit_index(unit1)
         spt1 = self.spike_train[idx1, 0]
         prob1 = self.soft_assignment[idx1]
 
-        idx2 = self.spike_train[:, 1] == unit2
+        idx2 = self.spike_train_index.unit_index(unit2)
         spt2 = self.spike_train[idx2, 0]
         prob2 = self.soft_assignment[idx2]
 
@@ -3,6 +3,7 @@ import numpy as np
 import networkx as nx
 
 from yass.template import shift_chans, align_get_shifts_with_ref
+from yass.spike_train import SpikeTrain
 
 def partition_input(save_dir,
                     fname_templates,
@@ -98,9 +99,8 @@ def merge_units(fname_templates, fname_spike_train,
         merge_array.append(list(cc))
 
     # get weights for merge
-    weights = np.zeros(n_units)
-    unique_ids, n_spikes = np.unique(spike_train[:,1], return_counts=True)
-    weights[unique_ids] = n_spikes
+    spike_train_index = SpikeTrain(spike_train, n_units)
+    weights = spike_train_index.n_spikes
     
     spike_train_new = np.zeros((0, 2), 'int32')
     templates_new = np.zeros((len(merge_array), n_times, n_channels),
@@ -134,7 +134,7 @@ def merge_units(fname_templates, fname_spike_train,
             for ii in idx_sort_units:
 
                 unit = units[ii]
-                spt_old = spike_train[spike_train[:, 1] == unit, 0]
+                spt_old = spike_train_index.unit_times(unit)
                 spt_old = spt_old + shifts[ii]
 
                 if len(spt_temp) == 0:
@@ -173,7 +173,7 @@ def merge_units(fname_templates, fname_spike_train,
         elif len(units) == 1:
             templates_new[new_id] = templates[units[0]]
 
-            spt_temp = spike_train[spike_train[:, 1] == units[0], 0]
+            spt_temp = spike_train_index.unit_times(units[0])
 
         spike_train_temp = np.vstack(
             (spt_temp, np.repeat(new_id, len(spt_temp)).astype('int32'))).T
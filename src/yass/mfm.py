@@ -74,12 +74,14 @@ class maskData:
                 N x 1 numpy array, where N is the number of spikes.
                 Coresetting group assignments for
                 each spike
+            dtype (optional): str
+                dtype of the masked data, defaults to float64
 
         """
         if len(args) > 0:
-            self.calc_maskedData_mfm(args[0], args[1], args[2])
+            self.calc_maskedData_mfm(*args)
 
-    def calc_maskedData_mfm(self, score, mask, group):
+    def calc_maskedData_mfm(self, score, mask, group, dtype='float64'):
         """
             Calculation of class attributes happen here.
 
@@ -100,7 +102,11 @@ class maskData:
                 N x 1 numpy array, where N is the number of spikes.
                 Coresetting group assignments for
                 each spike
+            dtype (optional): str
+                dtype of the masked data, defaults to float64
         """
+        score = score.astype(dtype, copy=False)
+        mask = mask.astype(dtype, copy=False)
         N, nfeature, nchannel = score.shape
         uniqueGroup = np.unique(group)
         Ngroup = uniqueGroup.size
@@ -117,7 +123,7 @@ class maskData:
             np.transpose(score_temp, [0, 3, 2, 1])).transpose((0, 2, 3, 1))
         z = mask[:, np.newaxis, np.newaxis, :] * scoreSq + \
             (1 - mask)[:, np.newaxis, np.newaxis, :] * \
-            (np.eye(nfeature)[np.newaxis, :, :, np.newaxis])
+            (np.eye(nfeature, dtype=y.dtype)[np.newaxis, :, :, np.newaxis])
         eta = z - ySq
 
         if Ngroup == N:
@@ -125,22 +131,19 @@ class maskData:
             sumYSq = ySq
             sumEta = eta
             groupMask = mask
-            weight = np.ones(N)
+            weight = np.ones(N, dtype=y.dtype)
 
         elif Ngroup < N:
 
-            sumY = np.zeros((Ngroup, nfeature, nchannel))
-            sumYSq = np.zeros((Ngroup, nfeature, nfeature, nchannel))
-            sumEta = np.zeros((Ngroup, nfeature, nfeature, nchannel))
-            groupMask = np.zeros((Ngroup, nchannel))
-            weight = np.zeros(Ngroup)
-            for n in range(N):
-                idx = group[n]
-                sumY[idx] += y[n]
-                sumYSq[idx] += ySq[n]
-                sumEta[idx] += eta[n]
-                groupMask[idx] += mask[n]
-                weight[idx] += 1
+            sumY = np.zeros((Ngroup, nfeature, nchannel), y.dtype)
+            sumYSq = np.zeros((Ngroup, nfeature, nfeature, nchannel), y.dtype)
+            sumEta = np.zeros((Ngroup, nfeature, nfeature, nchannel), y.dtype)
+            groupMask = np.zeros((Ngroup, nchannel), y.dtype)
+            np.add.at(sumY, group, y)
+            np.add.at(sumYSq, group, ySq)
+            np.add.at(sumEta, group, eta)
+            np.add.at(groupMask, group, mask)
+            weight = np.bincount(group, minlength=Ngroup).astype(y.dtype)
 
         else:
             raise ValueError(
@@ -209,19 +212,54 @@ class vbPar:
         Khat = self.ahat.size
         Ngroup, nfeatures, nchannel = maskedData.meanY.shape
 
-
-
         const1 = -nfeatures / 2 * np.log(2 * np.pi)
-        prec = self.Vhat.transpose([2, 3, 0, 1]) * self.nuhat[:, np.newaxis, np.newaxis, np.newaxis]
-        xmu = (maskedData.meanY[:, :, np.newaxis] - self.muhat).transpose([0, 2, 3, 1])
-        maha = -np.squeeze(np.matmul(xmu[:, :, :, np.newaxis], np.matmul(prec, xmu[..., np.newaxis])), axis=(3, 4))/2.0
-        const2 = np.linalg.slogdet(prec)[1] / 2.0
+        maha = -self.squared_mahalanobis(maskedData.meanY)/2.0
+        # log determinant of the precision nuhat*Vhat
+        _, logdetVhat = self.cholesky_Vhat()
+        const2 = (logdetVhat +
+                  nfeatures*np.log(self.nuhat)[:, np.newaxis]) / 2.0
         log_rho = np.sum(maha + const1 + const2, axis=-1)
         log_rho += np.log(pik)
         log_rho = log_rho - np.max(log_rho, axis=1)[:, np.newaxis]
         rho = np.exp(log_rho)
         self.rhat = rho / np.sum(rho, axis=1, keepdims=True)
 
+    def cholesky_Vhat(self):
+        """
+            Cholesky factors (K x nchannel x nfeature x nfeature) and log
+            determinants (K x nchannel) of Vhat. Computed once per Vhat,
+            i.e. until update_global or a move sets a new Vhat
+        """
+        if getattr(self, '_cholVhat_of', None) is not self.Vhat:
+            cholVhat = np.linalg.cholesky(self.Vhat.transpose([2, 3, 0, 1]))
+            logdetVhat = 2 * np.sum(
+                np.log(np.diagonal(cholVhat, axis1=2, axis2=3)), axis=2)
+            self._cholVhat = cholVhat, logdetVhat
+            self._cholVhat_of = self.Vhat
+
+        return self._cholVhat
+
+    def squared_mahalanobis(self, x):
+        """
+            Squared mahalanobis distance of x (N x nfeature x nchannel) to
+            each cluster under the precision nuhat*Vhat. Returns
+            N x K x nchannel
+        """
+        N = x.shape[0]
+        nfeature, Khat, nchannel = self.muhat.shape
+        cholVhat, _ = self.cholesky_Vhat()
+
+        # (x - mu)^T L as one product per channel
+        chol = cholVhat.transpose([1, 2, 0, 3]).reshape(
+            [nchannel, nfeature, Khat * nfeature]).astype(x.dtype)
+        xL = np.matmul(x.transpose([2, 0, 1]), chol).reshape(
+            [nchannel, N, Khat, nfeature])
+        muL = np.einsum('fkc,kcfg->ckg', self.muhat, cholVhat)
+        maha = np.sum(np.square(xL - muL[:, np.newaxis].astype(x.dtype)),
+                      axis=3)
+
+        return maha.transpose([1, 2, 0]) * self.nuhat[:, np.newaxis]
+
     def update_global(self, suffStat, param):
         """
             Updates the global variables muhat, invVhat, Vhat, lambdahat,
@@ -349,8 +387,6 @@ class suffStatistics:
                 vbParam.rhat * maskedData.weight[:, np.newaxis], axis=0)
             self.sumY = np.zeros([nfeature, Khat, nchannel])
             self.sumYSq = np.zeros([nfeature, nfeature, Khat, nchannel])
-            self.sumYSq1BS = np.zeros(
-                [Ngroup, nfeature, nfeature, Khat, nchannel])
             self.sumYSq1 = np.zeros([nfeature, nfeature, Khat, nchannel])
             self.sumYSq2 = np.zeros([nfeature, nfeature, Khat, nchannel])
             self.calc_suffstat(maskedData, vbParam, Ngroup, Khat, nfeature,
@@ -387,69 +423,49 @@ class suffStatistics:
                 Number of channels
         """
 
-        # noMask = maskedData.groupMask > 0
-        # nnoMask = noMask.sum(0)
-        # ind1 = nnoMask == 0
-        # self.sumYSq[:,:,:,ind1] = np.eye(nfeature)[:,:,np.newaxis, np.newaxis] * self.Nhat[np.newaxis,np.newaxis,:, np.newaxis]
-        # ind2 = nnoMask < Ngroup
-        # maskedEta = np.eye(nfeature)
-        # unmaskedY = maskedData.sumY[noMask]
-
-
-        for n in range(nchannel):
-            noMask = maskedData.groupMask[:, n] > 0
-            nnoMask = np.sum(noMask)
-            if nnoMask == 0:
-                for k in range(Khat):
-                    self.sumYSq[:, :, k, n] = np.eye(nfeature) * self.Nhat[k]
-
-            elif nnoMask < Ngroup:
-                maskedEta = np.eye(nfeature)
-                unmaskedY = maskedData.sumY[noMask, :, n]
-                unmaskedsumYSq = maskedData.sumYSq[noMask, :, :, n]
-                unmaskedEta = maskedData.sumEta[noMask, :, :, n]
-                unmaskedWeight = maskedData.weight[noMask]
-
-                rhat = vbParam.rhat[noMask, :]
-                self.sumY[:, :, n] = np.dot(unmaskedY.T, rhat)
-
-                visibleCluster = np.sum(rhat, axis=0) > 1e-10
-                sumMaskedRhat = self.Nhat - \
-                    np.sum(rhat * unmaskedWeight[:, np.newaxis],
-                           axis=0)
-                self.sumYSq2[:, :, :, n] = np.sum(
-                    rhat[:, np.newaxis, np.newaxis, :]
-                    * unmaskedEta[:, :, :, np.newaxis], axis=0) + \
-                    sumMaskedRhat * maskedEta[:, :, np.newaxis]
-                self.sumYSq1[:, :, visibleCluster, n] = np.sum(
-                    rhat[:, np.newaxis, np.newaxis, visibleCluster] *
-                    unmaskedsumYSq[:, :, :, np.newaxis],
-                    axis=0)
-                self.sumYSq[:, :, :, n] = self.sumYSq1[
-                    :, :, :, n] + self.sumYSq2[:, :, :, n]
-
-            elif nnoMask == Ngroup:
-                unmaskedY = maskedData.sumY[:, :, n]
-                unmaskedsumYSq = maskedData.sumYSq[:, :, :, n]
-                unmaskedEta = maskedData.sumEta[:, :, :, n]
-
-                rhat = vbParam.rhat[noMask, :]
-                self.sumY[:, :, n] = np.dot(unmaskedY.T, rhat)
-
-                visibleCluster = np.sum(rhat, axis=0) > 1e-10
-                sumMaskedRhat = self.Nhat - \
-                    np.sum(rhat * maskedData.weight[:, np.newaxis],
-                           axis=0)
-                self.sumYSq2[:, :, :, n] = np.sum(
-                    rhat[:, np.newaxis, np.newaxis, :] *
-                    unmaskedEta[:, :, :, np.newaxis],
-                    axis=0)
-                self.sumYSq1[:, :, visibleCluster, n] = np.sum(
-                    rhat[:, np.newaxis, np.newaxis, visibleCluster] *
-                    unmaskedsumYSq[:, :, :, np.newaxis],
-                    axis=0)
-                self.sumYSq[:, :, :, n] = self.sumYSq1[
-                    :, :, :, n] + self.sumYSq2[:, :, :, n]
+        # groups (rows) visible on each channel, with their rhat:
+        # nchannel x Ngroup x K
+        dtype = maskedData.sumY.dtype
+        noMask = maskedData.groupMask > 0
+        nnoMask = np.sum(noMask, axis=0)
+        rhat = noMask.T[:, :, np.newaxis] * vbParam.rhat.astype(dtype)
+
+        # contract over groups, one product per channel
+        self.sumY[:] = np.matmul(
+            maskedData.sumY.transpose([2, 1, 0]), rhat).transpose([1, 2, 0])
+        self.sumYSq1[:] = self.contract_groups(maskedData.sumYSq, rhat)
+        self.sumYSq2[:] = self.contract_groups(maskedData.sumEta, rhat)
+
+        # clusters without visible groups on a channel
+        visibleCluster = np.sum(rhat, axis=1).T > 1e-10
+        self.sumYSq1 *= visibleCluster
+
+        # masked groups contribute eta = identity
+        partial = np.logical_and(nnoMask > 0, nnoMask < Ngroup)
+        sumMaskedRhat = self.Nhat[:, np.newaxis] - np.sum(
+            rhat * maskedData.weight[:, np.newaxis], axis=1).T
+        self.sumYSq2[:, :, :, partial] += (
+            sumMaskedRhat[:, partial] * np.eye(nfeature)[
+                :, :, np.newaxis, np.newaxis])
+
+        self.sumYSq[:] = self.sumYSq1 + self.sumYSq2
+        self.sumYSq[:, :, :, nnoMask == 0] = (
+            np.eye(nfeature)[:, :, np.newaxis] * self.Nhat)[..., np.newaxis]
+
+    @staticmethod
+    def contract_groups(x, rhat):
+        """
+            sum over groups of x (Ngroup x nfeature x nfeature x nchannel)
+            weighted by rhat (nchannel x Ngroup x K). Returns
+            nfeature x nfeature x K x nchannel
+        """
+        Ngroup, nfeature, _, nchannel = x.shape
+        Khat = rhat.shape[2]
+        out = np.matmul(
+            x.transpose([3, 1, 2, 0]).reshape(
+                [nchannel, nfeature * nfeature, Ngroup]), rhat)
+        return out.reshape(
+            [nchannel, nfeature, nfeature, Khat]).transpose([1, 2, 3, 0])
 
 
 class ELBO_Class:
@@ -531,9 +547,8 @@ class ELBO_Class:
         # entropy_term = np.zeros(Khat)
         rhatp = vbParam.rhat[:, k_ind]
         muhat = np.transpose(vbParam.muhat, [1, 2, 0])
-        Vhat = np.transpose(vbParam.Vhat, [2, 3, 0, 1])
         sumY = np.transpose(suffStat.sumY, [1, 2, 0])
-        logdetVhat = np.sum(np.linalg.slogdet(Vhat)[1], axis=1, keepdims=False)
+        logdetVhat = np.sum(vbParam.cholesky_Vhat()[1], axis=1, keepdims=False)
 
         constants = Khat * np.log(prior.beta) - prior.beta - np.log(np.arange(Khat)+1).sum() - specsci.gammaln(vbParam.ahat.sum()) + specsci.gammaln(prior.a * Khat) - Khat * specsci.gammaln(prior.a) - prior.nu * nfeature * Khat * nchannel/2.0 * np.log(prior.V) - Khat * nchannel * specsci.multigammaln(prior.nu/2.0, nfeature) - nfeature * nchannel * np.log(np.pi) /2.0 * rhatp.sum()
         kvarying = specsci.gammaln(vbParam.ahat) + nfeature * nchannel/2.0 * np.log(prior.lambda0/vbParam.lambdahat) + logdetVhat * vbParam.nuhat/2.0 + nchannel * specsci.multigammaln(vbParam.nuhat/2.0, nfeature)
@@ -568,18 +583,15 @@ def multivariate_normal_logpdf(x, mu, Lam):
 
     p, C = mu.shape
 
+    # Lam = L L^T per channel
+    chol = np.linalg.cholesky(np.transpose(Lam, [2, 0, 1]))
+
     xMinusMu = np.transpose((x - mu), [2, 0, 1])
-    maha = -0.5 * np.sum(
-        np.matmul(xMinusMu, np.transpose(Lam, [2, 0, 1])) * xMinusMu,
-        axis=(0, 2))
+    maha = -0.5 * np.sum(np.square(np.matmul(xMinusMu, chol)), axis=(0, 2))
 
     const = -0.5 * p * C * np.log(2 * math.pi)
 
-    logpart = 0
-
-    for c in range(C):
-        logpart = logpart + logdet(Lam[:, :, c])
-    logpart = logpart * 0.5
+    logpart = np.sum(np.log(np.diagonal(chol, axis1=1, axis2=2)))
 
     return maha + const + logpart
 
@@ -889,16 +901,9 @@ def merge_move(maskedData, vbParam, suffStat, param, L, check_full):
         all_checked = 1
     ctr_merge_move_outer = 0
     while (not all_checked) and (K > 1):
-        prec = np.transpose(
-            vbParam.Vhat * vbParam.nuhat[
-                np.newaxis, np.newaxis, :, np.newaxis],
-            axes=[2, 3, 0, 1])
-        diff_mhat = (vbParam.muhat[:, np.newaxis] -
-                     vbParam.muhat[:, :, np.newaxis]).transpose(1, 2, 3, 0)
-        maha = np.sum(np.matmul(np.matmul(
-            diff_mhat[:, :, :, np.newaxis, :], prec),
-                                diff_mhat[:, :, :, :, np.newaxis]),
-                      (2, 3, 4))
+        # maha[ka, kb]: distance of muhat[ka] to cluster kb
+        maha = np.sum(vbParam.squared_mahalanobis(
+            vbParam.muhat.transpose([1, 0, 2])), axis=2)
 
         maha[np.arange(K), np.arange(K)] = np.Inf
         merged = 0
@@ -982,9 +987,18 @@ def check_merge(maskedData, vbParam, suffStat, ka, kb, param, L, ELBO):
         return vbParamTemp, suffStatTemp, merged, L, ELBO_amerge
 
 
+def mfm_dtype(param):
+    """
+        dtype of the masked data, float32 if cluster.mfm_float32 is set
+    """
+    if param.cluster.mfm_float32:
+        return 'float32'
+    return 'float64'
+
+
 def spikesort(score, mask, group, param):
     
-    maskedData = maskData(score, mask, group)
+    maskedData = maskData(score, mask, group, mfm_dtype(param))
 
     vbParam, elbo = split_merge(maskedData, param)
 
@@ -1039,7 +1053,7 @@ def split_merge(maskedData, param):
 def spikesort_v2(score, mask, group, param):
 
     # initialize dataset
-    maskedData = maskData(score, mask, group)
+    maskedData = maskData(score, mask, group, mfm_dtype(param))
 
     max_k, k_now = 10, 1
 
@@ -1082,7 +1096,7 @@ def fit_with_given_k(maskedData, k, param):
 def spikesort_v3(score, mask, group, param):
 
     # initialize dataset
-    maskedData = maskData(score, mask, group)
+    maskedData = maskData(score, mask, group, mfm_dtype(param))
 
     k_init = 10
 
@@ -1159,18 +1173,7 @@ def get_core_data(vbParam, score, n_max, threshold):
 
 
 def calc_mahalonobis(vbParam, score):
-    prec = np.transpose(
-        vbParam.Vhat * vbParam.nuhat[np.newaxis, np.newaxis, :, np.newaxis],
-        axes=[2, 3, 0, 1])
-    scoremhat = np.transpose(
-        score[:, :, np.newaxis, :] - vbParam.muhat, axes=[0, 2, 3, 1])
-    maha = np.sqrt(
-        np.sum(
-            np.matmul(
-                np.matmul(scoremhat[:, :, :, np.newaxis, :], prec),
-                scoremhat[:, :, :, :, np.newaxis]),
-            axis=(3, 4),
-            keepdims=False))
+    maha = np.sqrt(vbParam.squared_mahalanobis(score))
 
     return maha[:, :, 0]
 
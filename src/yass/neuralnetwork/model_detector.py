@@ -12,7 +12,8 @@ class Detect(nn.Module):
         super(Detect, self).__init__()
         
         #os.environ["CUDA_VISIBLE_DEVICES"] = str(CONFIG.resources.gpu_id)
-        torch.cuda.set_device(CONFIG.resources.gpu_id)
+        if torch.cuda.is_available():
+            torch.cuda.set_device(CONFIG.resources.gpu_id)
 
         self.spike_size = spike_size
         self.channel_index = channel_index
@@ -70,6 +71,60 @@ class Detect(nn.Module):
         
         return x
 
+    def forward_recordings(self, recordings_tensor):
+        """forward_recording on a (n_recordings, T, C) stack of recordings
+        """
+
+        x = recordings_tensor[:, None]
+        x = self.temporal_filter1(x)
+        x = self.temporal_filter2(x)
+
+        zero_buff = torch.zeros(
+            [x.shape[0], x.shape[1], x.shape[2], 1]).to(x.device)
+        x = torch.cat((x, zero_buff), 3)
+        x = x[:, :, :, self.channel_index].permute(0, 2, 3, 1, 4)
+        x = self.out(x.reshape(
+            recordings_tensor.shape[0]*recordings_tensor.shape[1]*
+            recordings_tensor.shape[2], -1))
+        x = x.reshape(recordings_tensor.shape[0],
+                      recordings_tensor.shape[1],
+                      recordings_tensor.shape[2])
+
+        return x
+
+    def get_spike_times_batched(self, recordings_tensor, max_window=5,
+                                threshold=0.5, buffer=None):
+        """get_spike_times on a (n_recordings, T, C) stack of recordings
+        in a single forward pass
+
+        spike_index_torch has three columns: recording, time and channel
+        """
+
+        probs = self.forward_recordings(recordings_tensor)
+
+        maxpool = torch.nn.MaxPool2d(kernel_size=[max_window, 1], stride=1, padding=[(max_window-1)//2, 0])
+        temporal_max = maxpool(probs[:, None])[:, 0] - 1e-8
+
+        spike_index_torch = torch.nonzero(
+            (probs >= temporal_max) & (probs > np.log(threshold / (1 - threshold))))
+
+        # remove edge spikes
+        if buffer is None:
+            buffer = self.spike_size//2
+
+        spike_index_torch = spike_index_torch[
+            (spike_index_torch[:, 1] > buffer) & 
+            (spike_index_torch[:, 1] < recordings_tensor.shape[1] - buffer)]
+
+        wf_t_range = torch.arange(
+            -(self.spike_size//2), self.spike_size//2+1).to(spike_index_torch.device)
+        time_index = spike_index_torch[:, 1][:, None] + wf_t_range
+        wf = recordings_tensor[spike_index_torch[:, 0][:, None],
+                               time_index,
+                               spike_index_torch[:, 2][:, None]]
+
+        return spike_index_torch, wf
+
     def get_spike_times(self, recording_tensor, max_window=5, threshold=0.5, buffer=None):
         
         probs = self.forward_recording(recording_tensor)
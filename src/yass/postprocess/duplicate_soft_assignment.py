@@ -1,5 +1,7 @@
 import numpy as np
 
+from yass.spike_train import spike_train_unit_index
+
 def duplicate_soft_assignment(fname_template_soft_assignment,
                               threshold=0.7, units_in=None):
 
@@ -18,8 +20,10 @@ def duplicate_soft_assignment(fname_template_soft_assignment,
     probs = np.zeros((n_units, n_neigh), 'float32')
     units_neigh = np.zeros((n_units, n_neigh), 'int32')
     no_spikes_units = []
+    spike_order, unit_offsets = spike_train_unit_index(units_all[:, 0],
+                                                       n_units)
     for k in range(n_units):
-        idx_ = np.where(units_all[:, 0] == k)[0]
+        idx_ = spike_order[unit_offsets[k]:unit_offsets[k+1]]
 
         if len(idx_) > 0:
             probs[k] = probs_all[idx_].mean(0)
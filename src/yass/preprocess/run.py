@@ -107,27 +107,45 @@ def run(output_directory):
     order = CONFIG.preprocess.filter.order
     sampling_rate = CONFIG.recordings.sampling_rate
 
-    # estimate std from a small chunk
-    chunk_5sec = 5*CONFIG.recordings.sampling_rate
-    if CONFIG.rec_len < chunk_5sec:
-        chunk_5sec = CONFIG.rec_len
-    small_batch = reader.read_data(
-        data_start=CONFIG.rec_len//2 - chunk_5sec//2,
-        data_end=CONFIG.rec_len//2 + chunk_5sec//2)
-
     fname_mean_sd = os.path.join(
         output_directory, 'mean_and_standard_dev_value.npz')
     if not os.path.exists(fname_mean_sd):
-        get_std(small_batch, sampling_rate,
-                fname_mean_sd, CONFIG.preprocess.apply_filter,
-                low_frequency, high_factor, order)
-    # turn it off
-    small_batch = None
-
-    # Make directory to hold filtered batch files:
-    filtered_location = os.path.join(output_directory, "filtered_files")
-    if not os.path.exists(filtered_location):
-        os.makedirs(filtered_location)
+        if CONFIG.preprocess.streaming_std:
+            # estimate std from short chunks spread over the whole
+            # recording, each one summarized by a mergeable histogram
+            get_std_streaming(reader, fname_mean_sd,
+                              CONFIG.preprocess.std_n_chunks,
+                              CONFIG.preprocess.apply_filter,
+                              low_frequency, high_factor, order,
+                              sampling_rate)
+        else:
+            # estimate std from a small chunk
+            chunk_5sec = 5*CONFIG.recordings.sampling_rate
+            if CONFIG.rec_len < chunk_5sec:
+                chunk_5sec = CONFIG.rec_len
+            small_batch = reader.read_data(
+                data_start=CONFIG.rec_len//2 - chunk_5sec//2,
+                data_end=CONFIG.rec_len//2 + chunk_5sec//2)
+
+            get_std(small_batch, sampling_rate,
+                    fname_mean_sd, CONFIG.preprocess.apply_filter,
+                    low_frequency, high_factor, order)
+            # turn it off
+            small_batch = None
+
+    if CONFIG.preprocess.write_direct:
+        # workers write straight into a preallocated file, which is
+        # renamed to standardized.bin once every batch is done
+        fname_out = standardized_path + '.tmp'
+        allocate_binary_file(fname_out, reader.end - reader.start,
+                             n_channels, CONFIG.preprocess.dtype)
+        filtered_location = None
+    else:
+        # Make directory to hold filtered batch files:
+        fname_out = None
+        filtered_location = os.path.join(output_directory, "filtered_files")
+        if not os.path.exists(filtered_location):
+            os.makedirs(filtered_location)
 
     # read config params
     multi_processing = CONFIG.resources.multi_processing
@@ -145,6 +163,7 @@ def run(output_directory):
             high_factor,
             order,
             sampling_rate,
+            fname_out,
             processes=n_processors,
             pm_pbar=True)
     else:
@@ -158,10 +177,14 @@ def run(output_directory):
                 high_factor,
                 order,
                 sampling_rate,
+                fname_out,
                 )
 
-    # Merge the chunk filtered files and delete the individual chunks
-    merge_filtered_files(filtered_location, output_directory)
+    if CONFIG.preprocess.write_direct:
+        os.rename(fname_out, standardized_path)
+    else:
+        # Merge the chunk filtered files and delete the individual chunks
+        merge_filtered_files(filtered_location, output_directory)
 
     # save yaml file with params
     path_to_yaml = standardized_path.replace('.bin', '.yaml')
@@ -170,3 +193,43 @@ def run(output_directory):
         yaml.dump(standardized_params, f)
 
     return standardized_path, standardized_params['dtype']
+
+
+def get_std_streaming(reader, fname_mean_sd, n_chunks, apply_filter,
+                      low_frequency, high_factor, order, sampling_rate):
+    """Estimate centers and sd from n_chunks one second chunks spread
+    evenly over the recording
+
+    Every chunk is filtered and summarized with a histogram per channel,
+    histograms are added up and the median and MAD are read off the sum,
+    so only the sampled chunks are read
+    """
+    CONFIG = read_config()
+
+    chunk_len = min(sampling_rate, reader.end - reader.start)
+    n_chunks = max(min(n_chunks, (reader.end - reader.start)//chunk_len), 1)
+    chunk_starts = np.linspace(reader.start, reader.end - chunk_len,
+                               n_chunks).astype('int64')
+
+    bin_edges = noise_bin_edges()
+
+    if CONFIG.resources.multi_processing:
+        counts = parmap.starmap(
+            noise_histogram_chunk,
+            [[start, start + chunk_len] for start in chunk_starts],
+            reader,
+            bin_edges,
+            apply_filter,
+            low_frequency,
+            high_factor,
+            order,
+            sampling_rate,
+            processes=CONFIG.resources.n_processors,
+            pm_pbar=True)
+    else:
+        counts = [noise_histogram_chunk(
+            start, start + chunk_len, reader, bin_edges, apply_filter,
+            low_frequency, high_factor, order, sampling_rate)
+            for start in chunk_starts]
+
+    get_std_from_histogram(np.sum(counts, axis=0), bin_edges, fname_mean_sd)
@@ -5,16 +5,36 @@ import logging
 import os
 import numpy as np
 
-from scipy.signal import butter, filtfilt
+from scipy.signal import butter, sosfiltfilt
 
 
-def _butterworth(ts, low_frequency, high_factor, order, sampling_frequency):
+# second-order sections of the butterworth filter, keyed by the
+# filter parameters so the filter is designed once per process
+_SOS_CACHE = {}
+
+
+def _butterworth_sos(low_frequency, order, sampling_frequency):
+    """Second-order sections of the high pass butterworth filter
+    """
+    key = (float(low_frequency), int(order), float(sampling_frequency))
+
+    if key not in _SOS_CACHE:
+        low = float(low_frequency) / sampling_frequency * 2
+        _SOS_CACHE[key] = butter(order, low, btype='high', analog=False,
+                                 output='sos')
+
+    return _SOS_CACHE[key]
+
+
+def _butterworth(ts, low_frequency, high_factor, order, sampling_frequency,
+                 in_place=False):
     """Butterworth filter
 
     Parameters
     ----------
     ts: np.array
-        T  numpy array, where T is the number of time samples
+        T numpy array or (T, C) numpy array, where T is the number of time
+        samples and C the number of channels
     low_frequency: int
         Low pass frequency (Hz)
     high_factor: float
@@ -23,31 +43,29 @@ def _butterworth(ts, low_frequency, high_factor, order, sampling_frequency):
         Order of Butterworth filter
     sampling_frequency: int
         Sampling frequency (Hz)
+    in_place: bool
+        Filter in float32 and write the result back into ts, which must be
+        a float32 array. sosfiltfilt still allocates its output, but in
+        float32 instead of float64
 
     Notes
     -----
-    This function can only be applied to a one dimensional array, to apply
-    it to multiple channels use butterworth
-
-    Raises
-    ------
-    NotImplementedError
-        If a multidmensional array is passed
+    All channels are filtered at once along the time axis
     """
 
-    low = float(low_frequency) / sampling_frequency * 2
-    high = float(high_factor) * 2
-    b, a = butter(order, low, btype='high', analog=False)
+    sos = _butterworth_sos(low_frequency, order, sampling_frequency)
+
+    if in_place:
+        if ts.dtype != np.float32:
+            raise ValueError('In place filtering needs a float32 array, '
+                             'got {}'.format(ts.dtype))
+        ts[:] = sosfiltfilt(sos.astype('float32'), ts, axis=0)
+        return ts
 
     if ts.ndim == 1:
-        return filtfilt(b, a, ts)
+        return sosfiltfilt(sos, ts)
     else:
-        T, C = ts.shape
-        output = np.zeros((T, C), 'float32')
-        for c in range(C):
-            output[:, c] = filtfilt(b, a, ts[:, c])
-
-        return output
+        return sosfiltfilt(sos, ts, axis=0).astype('float32')
 
 
 def _mean_standard_deviation(rec, centered=False):
@@ -116,7 +134,8 @@ def _standardize(rec, sd=None, centers=None):
 def filter_standardize_batch(batch_id, reader, fname_mean_sd,
                              apply_filter, out_dtype, output_directory,
                              low_frequency=None, high_factor=None,
-                             order=None, sampling_frequency=None):
+                             order=None, sampling_frequency=None,
+                             fname_out=None):
     """Butterworth filter for a one dimensional time series
 
     Parameters
@@ -131,6 +150,9 @@ def filter_standardize_batch(batch_id, reader, fname_mean_sd,
         Order of Butterworth filter
     sampling_frequency: int
         Sampling frequency (Hz)
+    fname_out: str
+        If given, the batch is written in place into this (preallocated)
+        binary file instead of its own .npy file in output_directory
 
     Notes
     -----
@@ -162,6 +184,11 @@ def filter_standardize_batch(batch_id, reader, fname_mean_sd,
     ts = _standardize(ts, sd, centers)
     
     # save
+    if fname_out is not None:
+        write_batch(fname_out, ts.astype(out_dtype),
+                    reader.idx_list[batch_id, 0] - reader.start)
+        return
+
     fname = os.path.join(
         output_directory,
         "standardized_{}.npy".format(
@@ -224,6 +251,138 @@ def get_std(ts,
              sd=sd)
 
 
+def allocate_binary_file(fname, n_times, n_channels, dtype):
+    """Create a binary file with room for a (n_times, n_channels) recording
+
+    The file is extended without writing any data, so it is filled in
+    place with write_batch
+    """
+    with open(fname, 'wb') as f:
+        f.truncate(int(n_times)*int(n_channels)*np.dtype(dtype).itemsize)
+
+
+def write_batch(fname, ts, data_start):
+    """Write a (T, n_channels) batch into a binary file, starting at
+    time sample data_start
+    """
+    offset = int(data_start)*ts.shape[1]*ts.dtype.itemsize
+    with open(fname, 'r+b') as f:
+        f.seek(offset, os.SEEK_SET)
+        ts.tofile(f)
+
+
+def noise_bin_edges(n_bins=4000, max_value=1e6):
+    """Bin edges of the noise histograms used by streaming_std
+
+    Bins are evenly spaced in arcsinh(x), so they are fine around zero and
+    have a fixed relative width for large values. This works for any scale
+    of the recording without knowing it in advance
+    """
+    max_asinh = np.arcsinh(max_value)
+    return np.sinh(np.linspace(-max_asinh, max_asinh, n_bins + 1))
+
+
+def noise_histogram(ts, bin_edges):
+    """Per channel histogram of a (T, C) chunk
+
+    Histograms over the same bin_edges are merged by adding them, so
+    chunks can be processed independently and combined at the end
+
+    Returns
+    -------
+    counts: numpy.ndarray (C, n_bins)
+    """
+    T, C = ts.shape
+    n_bins = len(bin_edges) - 1
+
+    # values outside the edges go into the first and last bins
+    idx = np.searchsorted(bin_edges, ts, side='right') - 1
+    idx = np.clip(idx, 0, n_bins - 1)
+    idx += np.arange(C)[None]*n_bins
+
+    return np.bincount(idx.ravel(), minlength=C*n_bins).reshape(C, n_bins)
+
+
+def noise_histogram_chunk(data_start, data_end, reader, bin_edges,
+                          apply_filter=False, low_frequency=None,
+                          high_factor=None, order=None,
+                          sampling_frequency=None):
+    """Filter data_start:data_end and return its noise_histogram
+    """
+    if apply_filter:
+        ts = reader.read_data_padded(data_start - reader.buffer,
+                                     data_end + reader.buffer)
+        ts = _butterworth(ts, low_frequency, high_factor,
+                          order, sampling_frequency)
+        ts = ts[reader.buffer:-reader.buffer]
+    else:
+        ts = reader.read_data(data_start, data_end)
+
+    return noise_histogram(ts, bin_edges)
+
+
+def _histogram_median_mad(counts, bin_edges, n_iter=50):
+    """Median and median absolute deviation of every channel from merged
+    noise histograms, interpolating linearly inside the bins
+    """
+    C = counts.shape[0]
+    medians = np.zeros(C)
+    mads = np.zeros(C)
+    # do not extrapolate past the outer bins
+    bin_edges_in = np.clip(bin_edges, bin_edges[1], bin_edges[-2])
+    for c in range(C):
+        nonempty = np.where(counts[c] > 0)[0]
+        if len(nonempty) == 0:
+            continue
+
+        # constant channel (e.g. dead): all values in one bin
+        if len(nonempty) == 1:
+            medians[c] = bin_edges_in[nonempty[0]]
+            continue
+
+        cdf = np.hstack((0, np.cumsum(counts[c])))/float(counts[c].sum())
+        # both edges of every bin with data, the cdf is flat in between
+        keep = np.zeros(len(bin_edges), 'bool')
+        keep[nonempty] = True
+        keep[nonempty + 1] = True
+        cdf, edges = cdf[keep], bin_edges_in[keep]
+        # drop zero-width steps left by the clipped outer bins
+        keep = np.hstack((np.diff(edges) > 0, True))
+        cdf, edges = cdf[keep], edges[keep]
+
+        median = np.interp(0.5, cdf, edges)
+
+        # MAD solves P(|x - median| <= d) = 0.5, found by bisection
+        lo, hi = 0., edges[-1] - edges[0]
+        for _ in range(n_iter):
+            d = (lo + hi)/2.
+            p = (np.interp(median + d, edges, cdf) -
+                 np.interp(median - d, edges, cdf))
+            if p < 0.5:
+                lo = d
+            else:
+                hi = d
+
+        medians[c] = median
+        mads[c] = (lo + hi)/2.
+
+    return medians, mads
+
+
+def get_std_from_histogram(counts, bin_edges, fname):
+    """Save centers and sd computed from merged noise histograms
+
+    Same output as get_std, but with the median as the center and the
+    median absolute deviation around it as the robust sd
+    """
+    centers, mads = _histogram_median_mad(counts, bin_edges)
+
+    # save
+    np.savez(fname,
+             centers=centers,
+             sd=mads/0.6745)
+
+
 def merge_filtered_files(filtered_location, output_directory):
 
     logger = logging.getLogger(__name__)
@@ -1,10 +1,19 @@
 import os
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 import numpy as np
 
 class READER(object):
 
+    # bytes of recording gathered at once in read_waveforms
+    waveform_block_bytes = 2**26
+
     def __init__(self, bin_file, dtype, CONFIG,
-                 n_sec_chunk=None, buffer=None, chunk_sec=None, offset=0):
+                 n_sec_chunk=None, buffer=None, chunk_sec=None, offset=0,
+                 mmap=None):
 
         # frequently used parameters
         self.n_channels = CONFIG.recordings.n_channels
@@ -62,9 +71,36 @@ class READER(object):
             #print ("   # of batches: ", self.n_batches)
         # spike size
         self.spike_size = CONFIG.spike_size
-       
+
+        # memory-mapped reads: data is returned as views over the
+        # recording instead of being copied with np.fromfile
+        if mmap is None:
+            mmap = CONFIG.resources.reader_mmap
+        self.mmap = mmap
+
+    def memmap_data(self, data_start, data_end):
+        """Memory map data_start:data_end of the recording
+
+        Every call makes a new copy-on-write map, so callers can modify
+        the returned array in place without touching the file on disk or
+        data returned by other calls
+        """
+        n_times = int(data_end - data_start)
+        if n_times <= 0:
+            return np.zeros((0, self.n_channels), dtype=self.dtype)
+
+        return np.memmap(
+            self.bin_file, dtype=self.dtype, mode='c',
+            offset=int((data_start-self.offset)*self.dtype.itemsize*self.n_channels),
+            shape=(n_times, self.n_channels))
 
     def read_data(self, data_start, data_end, channels=None):
+        if self.mmap:
+            data = self.memmap_data(data_start, data_end)
+            if channels is not None:
+                data = data[:, channels]
+            return data
+
         with open(self.bin_file, "rb") as fin:
             # Seek position and read N bytes
             #fin.seek((data_start-self.offset)*self.dtype.itemsize*self.n_channels, os.SEEK_SET)
@@ -80,6 +116,30 @@ class READER(object):
 
         return data
 
+    def read_data_padded(self, data_start, data_end, channels=None):
+        """Read data_start:data_end, zero padding outside of the recording
+
+        Only chunks that actually cross an edge of the recording are
+        copied into a padded array, everything else is returned as is
+        (a view over the recording in mmap mode)
+        """
+        # number of zeros needed on each side
+        left_buffer_size = max(self.offset - data_start, 0)
+        right_buffer_size = max(data_end - self.rec_len - self.offset, 0)
+
+        data = self.read_data(data_start + left_buffer_size,
+                              data_end - right_buffer_size,
+                              channels)
+        if left_buffer_size == 0 and right_buffer_size == 0:
+            return data
+
+        data_padded = np.zeros((data_end - data_start, data.shape[1]),
+                               dtype=self.dtype)
+        data_padded[left_buffer_size:
+                    left_buffer_size + data.shape[0]] = data
+
+        return data_padded
+
     def read_data_batch(self, batch_id, add_buffer=False, channels=None):
 
         # batch start and end
@@ -89,36 +149,8 @@ class READER(object):
             data_start -= self.buffer
             data_end += self.buffer
 
-            # if start is below zero, put it back to 0 and and zeros buffer
-            if data_start < self.offset:
-                left_buffer_size = self.offset - data_start
-                data_start = self.offset
-            else:
-                left_buffer_size = 0
-
-            # if end is above rec_len, put it back to rec_len and and zeros buffer
-            if data_end > self.rec_len + self.offset:
-                right_buffer_size = data_end - self.rec_len - self.offset
-                data_end = self.rec_len + self.offset
-            else:
-                right_buffer_size = 0
-
-        #data_start= int(data_start)
-        #data_end = int(data_end)
-        # read data
-        data = self.read_data(data_start, data_end, channels)
-        # add leftover buffer with zeros if necessary
-        if add_buffer:
-            left_buffer = np.zeros(
-                (left_buffer_size, self.n_channels),
-                dtype=self.dtype)
-            right_buffer = np.zeros(
-                (right_buffer_size, self.n_channels),
-                dtype=self.dtype)
-            if channels is not None:
-                left_buffer = left_buffer[:, channels]
-                right_buffer = right_buffer[:, channels]
-            data = np.concatenate((left_buffer, data, right_buffer), axis=0)
+        # read data, buffer with zeros is added if needed
+        data = self.read_data_padded(data_start, data_end, channels)
 
         return data
 
@@ -127,48 +159,123 @@ class READER(object):
         this is for nn detection using gpu
         get a batch and then make smaller batches
         '''
-        
-        data = self.read_data_batch(batch_id, add_buffer, channels)
-        
-        T, C = data.shape
-        T_mini = int(self.sampling_rate*n_sec_chunk_small)
-        buffer = self.buffer
 
+        # batch start and end
+        data_start, data_end = self.idx_list[batch_id]
+        T = data_end - data_start
+        T_mini = int(self.sampling_rate*n_sec_chunk_small)
         if add_buffer:
-            T = T - 2*buffer
+            buffer = self.buffer
         else:
             buffer = 0
 
-        # # batch sizes
-        # indexes = np.arange(0, T, T_mini)
-        # indexes = np.hstack((indexes, T))
-        # indexes += buffer
-
-
         indexes = np.arange(0, T, T_mini)
         indexes = np.hstack((indexes, indexes[-1]+T_mini))
         indexes += buffer
-       
-       
+
         n_mini_batches = len(indexes) - 1
-        # add addtional buffer if needed
+
+        # read data, buffer with zeros is added if needed
+        data = self.read_data_padded(data_start - buffer,
+                                     data_end + buffer,
+                                     channels)
+
+        # add addtional zeros to fill up the last minibatch if needed
         if n_mini_batches*T_mini > T:
             T_extra = n_mini_batches*T_mini - T
+            data_padded = np.zeros((data.shape[0] + T_extra, data.shape[1]),
+                                   dtype=self.dtype)
+            data_padded[:data.shape[0]] = data
+            data = data_padded
 
-            pad_zeros = np.zeros((T_extra, C),
-                dtype=self.dtype)
-
-            data = np.concatenate((data, pad_zeros), axis=0)
         data_loc = np.zeros((n_mini_batches, 2), 'int32')
-        data_batched = np.zeros((n_mini_batches, T_mini + 2*buffer, C), 'float32')
         for k in range(n_mini_batches):
-            data_batched[k] = data[indexes[k]-buffer:indexes[k+1]+buffer]
             data_loc[k] = [indexes[k], indexes[k+1]]
+
+        # in mmap mode, minibatches are (read only) overlapping views
+        if self.mmap and data.dtype == np.float32:
+            s0, s1 = data.strides
+            data_batched = np.lib.stride_tricks.as_strided(
+                data, shape=(n_mini_batches, T_mini + 2*buffer, data.shape[1]),
+                strides=(T_mini*s0, s0, s1), writeable=False)
+            return data_batched, data_loc
+
+        data_batched = np.zeros((n_mini_batches, T_mini + 2*buffer, data.shape[1]), 'float32')
+        for k in range(n_mini_batches):
+            data_batched[k] = data[indexes[k]-buffer:indexes[k+1]+buffer]
         return data_batched, data_loc
 
+    def prefetch(self, batch_ids, n_prefetch=2, n_sec_chunk_small=None,
+                 add_buffer=False, channels=None):
+        '''
+        iterate over batches while the next n_prefetch batches are read
+        on a background thread
+
+        yields (batch_id, data) where data is the output of read_data_batch
+        or, if n_sec_chunk_small is given, of read_data_batch_batch. in
+        mmap mode the batches are copied into memory on the background
+        thread, as reading a memory map is lazy
+        '''
+
+        batches = queue.Queue(maxsize=max(n_prefetch, 1))
+        stop = threading.Event()
+
+        def put(item):
+            # wait for room in the queue unless the consumer is gone
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def read_batches():
+            try:
+                for batch_id in batch_ids:
+                    if n_sec_chunk_small is None:
+                        data = self.read_data_batch(
+                            batch_id, add_buffer, channels)
+                    else:
+                        data = self.read_data_batch_batch(
+                            batch_id, n_sec_chunk_small, add_buffer, channels)
+                    if self.mmap:
+                        if n_sec_chunk_small is None:
+                            data = np.array(data)
+                        else:
+                            data = (np.array(data[0]), data[1])
+                    if not put((batch_id, data)):
+                        return
+            except Exception as e:
+                # re-raised by the consumer
+                put((None, e))
+            else:
+                put((None, None))
+
+        thread = threading.Thread(target=read_batches)
+        thread.daemon = True
+        thread.start()
+
+        try:
+            while True:
+                batch_id, data = batches.get()
+                if batch_id is None:
+                    if data is not None:
+                        raise data
+                    break
+                yield batch_id, data
+        finally:
+            stop.set()
+            thread.join()
+
     def read_waveforms(self, spike_times, n_times=None, channels=None):
         '''
         read waveforms from recording
+
+        spikes are gathered in time order from a memory map of the
+        recording, reading only the requested channels. spikes whose
+        waveform does not fit in the recording are not read, their
+        indexes are returned in skipped_idx
         '''
 
         if n_times is None:
@@ -178,37 +285,47 @@ class READER(object):
         if n_times % 2 == 0:
             n_times += 1
 
-        # exclude boundary spikes
-        # idx_keep = np.where(np.logical_and(spike_times>n_times//2, 
-                            # spike_times<(self.rec_len-n_times//2)))[0]
-        # spike_times=spike_times[idx_keep]
-
         # read all channels
         if channels is None:
             channels = np.arange(self.n_channels)
+        channels = np.asarray(channels)
+
+        # spike_times are the centers of waveforms
+        spike_times_shifted = (np.asarray(spike_times) -
+                               n_times//2).astype('int64')
+
+        # exclude boundary spikes
+        idx_keep = np.where(np.logical_and(
+            spike_times_shifted >= 0,
+            spike_times_shifted + n_times <= self.rec_len))[0]
+        skipped_idx = np.setdiff1d(np.arange(len(spike_times_shifted)),
+                                   idx_keep)
 
         # ***** LOAD RAW RECORDING *****
-        wfs = np.zeros((len(spike_times), n_times, len(channels)),
+        wfs = np.zeros((len(idx_keep), n_times, len(channels)),
                        'float32')
-
-        skipped_idx = []
-        total_size = n_times*self.n_channels
-        # spike_times are the centers of waveforms
-        spike_times_shifted = spike_times - n_times//2
-        offsets = spike_times_shifted.astype('int64')*self.dtype.itemsize*self.n_channels
-        with open(self.bin_file, "rb") as fin:
-            for ctr, spike in enumerate(spike_times_shifted):
-                try:
-                    fin.seek(offsets[ctr], os.SEEK_SET)
-                    wf = np.fromfile(fin,
-                                     dtype=self.dtype,
-                                     count=total_size)
-                    wfs[ctr] = wf.reshape(
-                        n_times, self.n_channels)[:,channels]
-                except:
-                    skipped_idx.append(ctr)
-        wfs=np.delete(wfs, skipped_idx, axis=0)
-        fin.close()
+        if len(idx_keep) == 0:
+            return wfs, skipped_idx
+
+        recording = np.memmap(self.bin_file, dtype=self.dtype, mode='r',
+                              shape=(self.rec_len, self.n_channels))
+
+        all_channels = np.array_equal(channels, np.arange(self.n_channels))
+
+        # read in time order, a block of spikes at a time
+        idx_sort = np.argsort(spike_times_shifted[idx_keep], kind='mergesort')
+        t_range = np.arange(n_times)
+        block_size = max(1, self.waveform_block_bytes //
+                         (n_times*len(channels)*self.dtype.itemsize))
+        for j in range(0, len(idx_sort), block_size):
+            idx_block = idx_sort[j:j+block_size]
+            time_index = spike_times_shifted[idx_keep[idx_block]][:, None] + t_range
+            if all_channels:
+                wfs[idx_block] = recording[time_index]
+            else:
+                wfs[idx_block] = recording[time_index[:, :, None],
+                                           channels[None, None]]
+        del recording
 
         return wfs, skipped_idx
 
@@ -2,25 +2,39 @@ import os
 import logging
 import numpy as np
 import parmap
+import torch
+
+from yass.deconvolve.match_pursuit_gpu_new import transform_template_parallel
+from yass.deconvolve.match_pursuit_cpu import bspline_basis
+from yass.spike_train import SpikeTrain
+
 
 class RESIDUAL(object):
-    
+
+    # number of spikes subtracted at once
+    spike_batch_size = 512
+
     def __init__(self, 
                  fname_templates,
                  fname_spike_train,
                  reader,
                  fname_out,
-                 dtype_out):
+                 dtype_out,
+                 fname_shifts=None,
+                 fname_scales=None):
         
         """ Initialize by computing residuals
             provide: raw data block, templates, and deconv spike train; 
+            optional sub-sample shifts and scales of each spike
+            (same as RESIDUAL_GPU2)
         """
         #self.logger = logging.getLogger(__name__)
 
         # keep templates and spike train filname
-        # will be loaded during each prallel process
         self.fname_templates = fname_templates
         self.fname_spike_train = fname_spike_train
+        self.fname_shifts = fname_shifts
+        self.fname_scales = fname_scales
 
         self.reader = reader
 
@@ -28,108 +42,185 @@ class RESIDUAL(object):
         self.fname_out = fname_out
         self.dtype_out = dtype_out
 
-    def compute_residual(self, save_dir,
-                         multi_processing=False,
-                         n_processors=1):
+    def compute_residual(self, multi_processing=False, n_processors=1):
         '''
         '''
-        if not os.path.exists(save_dir):
-            os.makedirs(save_dir)
 
-        batch_ids = []
-        fnames_seg = []
-        for batch_id in range(self.reader.n_batches):
-            batch_ids.append(batch_id)
-            fnames_seg.append(
-                os.path.join(save_dir,
-                             'residual_seg{}.npy'.format(batch_id)))
+        # every batch is written straight into its place in a temporary
+        # output file, renamed to fname_out in save_residual
+        root, ext = os.path.splitext(self.fname_out)
+        self.fname_tmp = root + '_tmp' + ext
+        self.out_start = self.reader.idx_list[0, 0]
+        self.out_shape = (self.reader.idx_list[-1, 1] - self.out_start,
+                          self.reader.n_channels)
+        residual = np.memmap(self.fname_tmp, dtype=self.dtype_out,
+                             mode='w+', shape=self.out_shape)
+        del residual
+
+        batch_ids = np.arange(self.reader.n_batches)
+
+        self.load_templates(multi_processing, n_processors)
+        spikes, spike_offsets = self.bucket_spikes()
 
         #self.logger.info("computing residuals")
         if multi_processing:
             batches_in = np.array_split(batch_ids, n_processors)
-            fnames_in = np.array_split(fnames_seg, n_processors)
+            args_in = []
+            for batches in batches_in:
+                if len(batches) == 0:
+                    continue
+                # only pass the spikes of its own batches to each core
+                offsets = spike_offsets[batches]
+                start, end = offsets[0, 0], offsets[-1, 1]
+                args_in.append((batches,
+                                [x[start:end] for x in spikes],
+                                offsets - start))
             parmap.starmap(self.subtract_parallel, 
-                         list(zip(batches_in, fnames_in)),
-                         processes=n_processors,
-                         pm_pbar=True)
+                           args_in,
+                           processes=n_processors,
+                           pm_pbar=True)
 
         else:
-            for ctr in range(len(batch_ids)):
-                self.subtract_parallel(
-                    [batch_ids[ctr]], [fnames_seg[ctr]])
+            self.subtract_parallel(batch_ids, spikes, spike_offsets)
 
-        self.fnames_seg = fnames_seg
+    def load_templates(self, multi_processing=False, n_processors=1):
+        ''' b-spline coefficients of templates on their visible channels,
+            stacked by row: rows of unit k are
+            coef_offsets[k]:coef_offsets[k+1], on channels coef_chans
+        '''
 
+        # n_units x n_channels x n_times
+        templates = np.load(self.fname_templates).transpose(0, 2, 1)
+        self.n_time = templates.shape[2]
+        self.reader.buffer = self.n_time
 
-    def subtract_parallel(self, batch_ids, fnames_out):
+        vis_chans = [np.where(np.any(temp != 0, 1))[0] for temp in templates]
+        templates_vis = [temp[chans] for temp, chans in zip(templates, vis_chans)]
+        if multi_processing:
+            coefficients = parmap.map(transform_template_parallel,
+                                      templates_vis,
+                                      processes=n_processors,
+                                      pm_pbar=False)
+        else:
+            coefficients = [transform_template_parallel(temp)
+                            for temp in templates_vis]
+
+        n_rows = [len(chans) for chans in vis_chans]
+        self.coef_offsets = np.hstack((0, np.cumsum(n_rows))).astype('int64')
+        self.coef_chans = np.hstack(vis_chans).astype('int64')
+        self.coefficients = np.vstack(
+            [coef.reshape(-1, self.n_time+4) for coef in coefficients])
+
+    def bucket_spikes(self):
+        ''' sort spikes by time once and find the spikes that overlap
+            each batch (with buffer)
         '''
+
+        spike_train = SpikeTrain.load(self.fname_spike_train)
+        n_spikes = len(spike_train)
+        if self.fname_shifts is None:
+            shifts = np.zeros(n_spikes, 'float32')
+        else:
+            shifts = np.load(self.fname_shifts)
+        if self.fname_scales is None:
+            scales = np.ones(n_spikes, 'float32')
+        else:
+            scales = np.load(self.fname_scales)
+
+        # shift spike time so that it is aligned at time 0
+        order = spike_train.index[1]
+        spikes = [spike_train.index[2] - self.n_time//2,
+                  spike_train.spike_train[order, 1],
+                  shifts[order], scales[order]]
+
+        # spikes starting within buffer before the batch start up to the
+        # batch end; the ones in the end buffer are done by the next batch
+        starts = self.reader.idx_list[:, 0] - self.reader.buffer
+        ends = self.reader.idx_list[:, 1]
+        spike_offsets = np.vstack((np.searchsorted(spikes[0], starts),
+                                   np.searchsorted(spikes[0], ends))).T
+
+        return spikes, spike_offsets
+
+    def subtract_parallel(self, batch_ids, spikes, spike_offsets):
+        '''
+        spikes: times, units, shifts and scales sorted by time
+        spike_offsets: [n_batches, 2] range of spikes of each batch
         '''
-                
-        templates = None
-        spike_train = None
-
-        for batch_id, fname_out in zip(batch_ids, fnames_out):
-            if os.path.exists(fname_out):
-                continue
-            
-            # load upsampled templates only once per core:
-            if templates is None or spike_train is None:
-                #self.logger.info("loading upsampled templates")
-                templates = np.load(self.fname_templates)
-                spike_train = np.load(self.fname_spike_train)
-
-                # do not read spike train again here
-                #self.spike_train = up_data['spike_train_up']
-                n_time = templates.shape[1]
-                time_idx = np.arange(0, n_time)
-                self.reader.buffer = n_time
-                
-                # shift spike time so that it is aligned at
-                # time 0
-                spike_train[:, 0] -= n_time//2
-
-            # get relevantspike times
-            start, end = self.reader.idx_list[batch_id]
-            start -= self.reader.buffer 
-            idx_in_chunk = np.where(
-                np.logical_and(spike_train[:,0]>=start,
-                               spike_train[:,0]<end))[0]
-            spikes_in_chunk = spike_train[idx_in_chunk]
-            # offset
-            spikes_in_chunk[:,0] -=  start
-
-            #print ("SPIKE train: ", self.spike_train.shape)
-            #print ("templates: ", self.templates.shape)
-            # note only derasterize up to last bit, don't remove spikes from 
-            # buffer_size end because those will be looked at by next chunk
-            # load indexes and then index into original data
-            #print ("batch_id: ", batch_id)
-            data = self.reader.read_data_batch(batch_id, add_buffer=True)
-            #print ("data: ", data.shape)
 
-            #print ("local spike train: ", local_spike_train.shape)
-            #print ("self.n_time: ", self.n_time)
-            #print ("local spiketrain: ", local_spike_train)
-            for j in range(spikes_in_chunk.shape[0]):
-                tt, ii = spikes_in_chunk[j]
-                data[time_idx + tt, :] -= templates[ii]
+        times, units, shifts, scales = spikes
 
-            # remove buffer
-            data = data[self.reader.buffer:-self.reader.buffer]
+        residual = np.memmap(self.fname_tmp, dtype=self.dtype_out,
+                             mode='r+', shape=self.out_shape)
 
-            # save
-            np.save(fname_out, data)
+        for batch_id, (lo, hi) in zip(batch_ids, spike_offsets):
+
+            # note only derasterize up to last bit, don't remove spikes from 
+            # buffer_size end because those will be looked at by next chunk
+            # copy, the reader can return a view over the recording
+            data = np.array(self.reader.read_data_batch(
+                batch_id, add_buffer=True), dtype='float32')
+            start = self.reader.idx_list[batch_id, 0] - self.reader.buffer
+
+            self.subtract_spikes(data, times[lo:hi] - start, units[lo:hi],
+                                 shifts[lo:hi], scales[lo:hi])
+
+            # remove buffer and write at the batch location
+            batch_start, batch_end = (self.reader.idx_list[batch_id] -
+                                      self.out_start)
+            residual[batch_start:batch_end] = data[
+                self.reader.buffer:-self.reader.buffer]
+
+        residual.flush()
+        del residual
+
+    def subtract_spikes(self, data, times, units, shifts, scales):
+        ''' subtract templates shifted by sub-sample shifts and scaled by
+            scales at times (first sample) from data (n_times x n_chans);
+            same b-spline interpolation as deconv.subtract_splines
+        '''
+
+        order = 3
+        n_vals = self.n_time
+        t_range = np.arange(n_vals)
+        data_flat = data.reshape(-1)
+        n_chans = data.shape[1]
+
+        # negative offsets move to the next time step
+        offsets = -shifts.astype('float32')
+        idx_neg = offsets < 0
+        offsets[idx_neg] += 1
+        times = times + idx_neg
+
+        for j in range(0, len(times), self.spike_batch_size):
+            batch = slice(j, j+self.spike_batch_size)
+            units_ = units[batch]
+
+            # one row per spike and visible channel of its template
+            counts = np.diff(self.coef_offsets)[units_]
+            event_ids = np.repeat(np.arange(len(units_)), counts)
+            row_ids = (np.arange(len(event_ids)) -
+                       np.repeat(np.cumsum(counts) - counts, counts) +
+                       self.coef_offsets[units_][event_ids])
+
+            # evaluate shifted splines
+            basis = bspline_basis(
+                torch.from_numpy(offsets[batch]), order).numpy()[event_ids]
+            coefs = self.coefficients[row_ids]
+            vals = coefs[:, :n_vals]*basis[:, :1]
+            for k in range(1, order+1):
+                vals += coefs[:, k:k+n_vals]*basis[:, k:k+1]
+            vals *= scales[batch][event_ids][:, None]
+
+            # drop values that fall outside of the data
+            times_ = times[batch][event_ids][:, None] + t_range
+            valid = (times_ >= 0) & (times_ < data.shape[0])
+            index = (times_*n_chans + self.coef_chans[row_ids][:, None])[valid]
+            # overlapping spikes repeat indexes, add.at accumulates them
+            np.add.at(data_flat, index, -vals[valid].astype(data.dtype))
 
 
     def save_residual(self):
-    
-        f = open(self.fname_out,'wb')
-        for fname in self.fnames_seg:
 
-            res = np.load(fname).astype(self.dtype_out)
-            f.write(res)
-        f.close()
-        
-        # delete residual chunks after successful merging/save
-        for fname in self.fnames_seg:
-            os.remove(fname)
+        # all batches are written, keep the output file
+        os.rename(self.fname_tmp, self.fname_out)
@@ -5,7 +5,11 @@ import time
 from tqdm import tqdm
 import torch
 import sys
-import cudaSpline as deconv
+# not needed by the cpu residual (residual.RESIDUAL)
+try:
+    import cudaSpline as deconv
+except ImportError:
+    deconv = None
 import matplotlib.pyplot as plt
 from scipy.interpolate import splrep, splev, splder, sproot
 import parmap
@@ -242,8 +246,15 @@ class RESIDUAL_GPU2(object):
             n_chunks_update = int(self.template_update_time/self.reader.n_sec_chunk)
             update_chunk = np.arange(0, self.reader.n_batches, n_chunks_update)
 
-        # open residual file for appending on the fly
-        f = open(self.fname_residual, 'wb')
+        # write every chunk at its place in a temporary residual file,
+        # renamed to fname_residual once all chunks are done
+        root, ext = os.path.splitext(self.fname_residual)
+        fname_tmp = root + '_tmp' + ext
+        out_start = self.reader.idx_list[0, 0]
+        residual = np.memmap(
+            fname_tmp, dtype=self.dtype_out, mode='w+',
+            shape=(self.reader.idx_list[-1, 1] - out_start,
+                   self.reader.n_channels))
         for batch_id, chunk in tqdm(enumerate(self.reader.idx_list)):
 
             # updated templates options
@@ -348,13 +359,15 @@ class RESIDUAL_GPU2(object):
             if verbose:
                 print ("subtraction time: ", time.time()-t5)
 
-            temp_out = objective[:,self.reader.buffer:-self.reader.buffer].cpu().data.numpy().copy(order='F')
-            f.write(temp_out.T)
+            temp_out = objective[:,self.reader.buffer:-self.reader.buffer].cpu().data.numpy()
+            residual[chunk_start-out_start:chunk_end-out_start] = temp_out.T
             
             batch_id+=1
             #if batch_id > 3:
             #    break
-        f.close()
+        residual.flush()
+        del residual
+        os.rename(fname_tmp, self.fname_residual)
 
         print ("Total residual time: ", time.time()-t0)
 
@@ -105,7 +105,7 @@ def run(fname_shifts,
         np.save(fname_scales, scales_new)
         
         
-    if CONFIG.deconvolution.deconv_gpu: 
+    if CONFIG.deconvolution.deconv_gpu and torch.cuda.is_available():
         residual_ONgpu(recordings_filename,
                        recording_dtype,
                        CONFIG,
@@ -120,7 +120,9 @@ def run(fname_shifts,
                        run_chunk_sec)
     
     else:
-        residual_ONcpu(fname_templates,
+        residual_ONcpu(fname_shifts,
+                       fname_scales,
+                       fname_templates,
                        fname_spike_train,
                        output_directory,
                        recordings_filename,
@@ -185,7 +187,9 @@ def residual_ONgpu(recordings_filename,
                       update_templates)
                   
     
-def residual_ONcpu(fname_templates,
+def residual_ONcpu(fname_shifts,
+                   fname_scales,
+                   fname_templates,
                    fname_spike_train,
                    output_directory,
                    recordings_filename,
@@ -212,14 +216,14 @@ def residual_ONcpu(fname_templates,
                                fname_spike_train,
                                reader,
                                fname_out,
-                               dtype_out)
+                               dtype_out,
+                               fname_shifts,
+                               fname_scales)
 
 
     # compute residual
-    seg_dir = os.path.join(output_directory, 'segs')
-    residual_object.compute_residual(seg_dir,
-                                     CONFIG.resources.multi_processing,
+    residual_object.compute_residual(CONFIG.resources.multi_processing,
                                      CONFIG.resources.n_processors)
 
-    # concatenate all segments
+    # keep the residual file once all batches are done
     residual_object.save_residual()
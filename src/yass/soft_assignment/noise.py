@@ -2,9 +2,17 @@ import numpy as np
 import torch
 from tqdm import tqdm
 
-import cudaSpline as deconv
+# cuda kernel for shifted templates; without it (or on the cpu)
+# match_pursuit_cpu.shift_splines is used
+try:
+    import cudaSpline as deconv
+except ImportError:
+    deconv = None
 from scipy.interpolate import splrep
 
+from yass.deconvolve.match_pursuit_gpu_new import transform_template_parallel
+from yass.deconvolve.match_pursuit_cpu import shift_splines
+
 def fit_spline(curve, knots=None, prepad=0, postpad=0, order=3):
     if knots is None:
         knots = np.arange(len(curve) + prepad + postpad)
@@ -25,8 +33,15 @@ def transform_template(template, knots=None, prepad=7, postpad=3, order=3):
 
 class SOFTNOISEASSIGNMENT(object):
     def __init__(self, fname_spike_train, fname_templates, fname_shifts, fname_scales,
-                 reader_residual, detector, channel_index, large_unit_threshold):
+                 reader_residual, detector, channel_index, large_unit_threshold,
+                 device=None):
         
+        # gpu if there is one
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(device)
+        self.cuda_splines = self.device.type == 'cuda' and deconv is not None
+
         self.templates = np.load(fname_templates).astype('float32')
         self.spike_train = np.load(fname_spike_train)
         self.shifts = np.load(fname_shifts)
@@ -110,18 +125,24 @@ class SOFTNOISEASSIGNMENT(object):
         self.scales = self.scales[self.idx_included]
 
     def move_to_torch(self):
-        self.templates_aligned = torch.from_numpy(self.templates_aligned).float().cuda()
-        self.spike_train = torch.from_numpy(self.spike_train).long().cuda()
-        self.shifts = torch.from_numpy(self.shifts).float().cuda()
-        self.scales = torch.from_numpy(self.scales).float().cuda()
+        self.templates_aligned = torch.from_numpy(self.templates_aligned).float().to(self.device)
+        self.spike_train = torch.from_numpy(self.spike_train).long().to(self.device)
+        self.shifts = torch.from_numpy(self.shifts).float().to(self.device)
+        self.scales = torch.from_numpy(self.scales).float().to(self.device)
         
-        self.mcs = torch.from_numpy(self.mcs).cuda()
-        self.channel_index = torch.from_numpy(self.channel_index).cuda()
+        self.mcs = torch.from_numpy(self.mcs).to(self.device)
+        self.channel_index = torch.from_numpy(self.channel_index).to(self.device)
         
     def get_bspline_coeffs(self):
 
         n_data, n_times, n_channels = self.templates_aligned.shape
 
+        if not self.cuda_splines:
+            coeffs = np.stack([transform_template_parallel(temp.T)
+                               for temp in self.templates_aligned])
+            self.coeffs = torch.from_numpy(coeffs).to(self.device)
+            return
+
         channels = torch.arange(n_channels).cuda()
         temps_torch = torch.from_numpy(-(self.templates_aligned.transpose(0, 2, 1))).cuda()
 
@@ -130,19 +151,25 @@ class SOFTNOISEASSIGNMENT(object):
 
     def get_shifted_templates(self, temp_ids, shifts, scales):
         
-        temp_ids = torch.from_numpy(temp_ids.cpu().numpy()).long().cuda()
-        shifts = torch.from_numpy(shifts.cpu().numpy()).float().cuda()
-        scales = torch.from_numpy(scales.cpu().numpy()).float().cuda()
+        temp_ids = temp_ids.long().to(self.device)
+        shifts = shifts.float().to(self.device)
+        scales = scales.float().to(self.device)
 
         n_sample_run = 1000
         n_times = self.templates_aligned.shape[1]
 
         idx_run = np.hstack((np.arange(0, len(shifts), n_sample_run), len(shifts)))
 
-        shifted_templates = torch.cuda.FloatTensor(len(shifts), n_times, self.n_neigh_chans).fill_(0)
+        shifted_templates = torch.zeros((len(shifts), n_times, self.n_neigh_chans),
+                                        device=self.device)
         for j in range(len(idx_run)-1):
             ii_start = idx_run[j]
             ii_end = idx_run[j+1]
+            if not self.cuda_splines:
+                shifted_templates[ii_start:ii_end] = shift_splines(
+                    self.coeffs, temp_ids[ii_start:ii_end],
+                    shifts[ii_start:ii_end], scales[ii_start:ii_end])
+                continue
             obj = torch.zeros(self.n_neigh_chans, (ii_end-ii_start)*n_times + 10).cuda()
             times = torch.arange(0, (ii_end-ii_start)*n_times, n_times).long().cuda() + 5
             deconv.subtract_splines(obj,
@@ -158,20 +185,20 @@ class SOFTNOISEASSIGNMENT(object):
 
     def compute_soft_assignment(self):
         
-        probs = torch.zeros(len(self.spike_train)).cuda()
+        probs = torch.zeros(len(self.spike_train), device=self.device)
 
         # batch offsets
         offsets = torch.from_numpy(self.reader_residual.idx_list[:, 0]
-                                   - self.reader_residual.buffer).cuda().long()
+                                   - self.reader_residual.buffer).to(self.device).long()
 
-        t_range = torch.arange(-(self.n_times_nn//2), self.n_times_nn//2+1).cuda()
+        t_range = torch.arange(-(self.n_times_nn//2), self.n_times_nn//2+1).to(self.device)
         with tqdm(total=self.reader_residual.n_batches) as pbar:
 
             for batch_id in range(self.reader_residual.n_batches):
 
                 # load residual data
                 resid_dat = self.reader_residual.read_data_batch(batch_id, add_buffer=True)
-                resid_dat = torch.from_numpy(resid_dat).cuda()
+                resid_dat = torch.from_numpy(np.array(resid_dat, 'float32')).to(self.device)
 
                 # relevant idx
                 idx_in = torch.nonzero(
@@ -188,7 +215,7 @@ class SOFTNOISEASSIGNMENT(object):
                 t_index = spike_train_batch[:, 0][:, None] + t_range
                 c_index = self.channel_index[self.mcs[spike_train_batch[:,1]]].long()
 
-                resid_dat = torch.cat((resid_dat, torch.zeros((resid_dat.shape[0], 1)).cuda()), 1)
+                resid_dat = torch.cat((resid_dat, torch.zeros((resid_dat.shape[0], 1), device=self.device)), 1)
                 resid_snippets = resid_dat[t_index[:,:,None], c_index[:,None]]
 
 
@@ -204,7 +231,7 @@ class SOFTNOISEASSIGNMENT(object):
 
                 idx_list = np.hstack((
                     np.arange(0, clean_wfs.shape[0], n_sample_run), clean_wfs.shape[0]))
-                probs_batch = torch.zeros(len(clean_wfs)).cuda()
+                probs_batch = torch.zeros(len(clean_wfs), device=self.device)
                 for j in range(len(idx_list)-1):
                     probs_batch[idx_list[j]:idx_list[j+1]] = self.detector(
                         clean_wfs[idx_list[j]:idx_list[j+1]])[0][:, 0]
@@ -43,6 +43,9 @@ def run(template_fname,
 
     CONFIG = read_config()
 
+    # runs on the cpu if there is no gpu
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
     #
     fname_noise_soft = os.path.join(
         output_directory, 'noise_soft_assignment.npy')
@@ -75,7 +78,7 @@ def run(template_fname,
                               CONFIG.channel_index,
                               CONFIG)
             detector.load(CONFIG.neuralnetwork.detect.filename)
-            detector = detector.cuda()
+            detector = detector.to(device)
 
             # initialize soft assignment calculator
             threshold = CONFIG.deconvolution.threshold/0.1
@@ -86,7 +89,8 @@ def run(template_fname,
             else:
                 template_fname_ = template_fname
             sna = SOFTNOISEASSIGNMENT(spike_train_fname, template_fname_, shifts_fname, scales_fname,
-                                      reader_resid, detector, CONFIG.channel_index, threshold)
+                                      reader_resid, detector, CONFIG.channel_index, threshold,
+                                      device=device)
 
             # compuate soft assignment
             probs_noise = sna.compute_soft_assignment()
@@ -143,7 +147,8 @@ def run(template_fname,
             lik_window=window_size,
             similar_array=similar_array,
             update_templates=update_templates,
-            template_update_time=CONFIG.deconvolution.template_update_time)
+            template_update_time=CONFIG.deconvolution.template_update_time,
+            device=device)
 
         probs_templates, _, logprobs_outliers, units_assignment = TAO.run()
         #outlier spike times/units
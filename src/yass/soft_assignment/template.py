@@ -11,10 +11,18 @@ import numpy as np
 from tqdm import tqdm
 import scipy.spatial.distance as dist
 import torch
-import cudaSpline as deconv
+# cuda kernel for shifted templates; without it (or on the cpu)
+# match_pursuit_cpu.shift_splines is used
+try:
+    import cudaSpline as deconv
+except ImportError:
+    deconv = None
 from scipy.interpolate import splrep
 from numpy.linalg import inv as inv
 
+from yass.deconvolve.match_pursuit_gpu_new import transform_template_parallel
+from yass.deconvolve.match_pursuit_cpu import shift_splines
+
 def fit_spline(curve, knots=None, prepad=0, postpad=0, order=3):
     if knots is None:
         knots = np.arange(len(curve) + prepad + postpad)
@@ -61,7 +69,14 @@ class TEMPLATE_ASSIGN_OBJECT(object):
                  reader_residual, spat_cov, temp_cov, channel_idx, geom,
                  large_unit_threshold = 5, n_chans = 5, rec_chans = 512,
                  sim_units = 3, similar_array = None, temp_thresh= np.inf, lik_window = 50,
-                 update_templates=False, template_update_time=None):
+                 update_templates=False, template_update_time=None, device=None):
+
+        # gpu if there is one; likelihoods are in half precision on the gpu
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(device)
+        self.cuda_splines = self.device.type == 'cuda' and deconv is not None
+        self.dtype = torch.float16 if self.device.type == 'cuda' else torch.float32
 
         #get the variance of the residual:        
         self.temp_thresh = temp_thresh
@@ -169,7 +184,7 @@ class TEMPLATE_ASSIGN_OBJECT(object):
         self.coeff_list.append(self.get_bspline_coeffs(self.templates_aligned))
 
         self.templates_aligned = [
-            torch.from_numpy(element).float().cuda() 
+            torch.from_numpy(element).float().to(self.device)
             for element in self.aligned_template_list]
         
     def get_residual_variance(self):
@@ -180,17 +195,20 @@ class TEMPLATE_ASSIGN_OBJECT(object):
         self.resid_var = np.mean(var_array)
         
     def get_kronecker(self):
+        ''' inverse covariance of unit k is kron(spat_inv[k], temp_inv),
+            kept as its two factors
+        '''
 
-        self.cov_list = []
-        inv_temp  = inv(self.temp_cov)
+        self.spat_inv = []
         for unit in range(self.n_units):
             chans = self.chans[unit]
             chans = chans[chans < self.rec_chans]
             indices = np.ix_(chans,chans)
-            covar = np.kron(inv(self.spat_cov[indices]), inv_temp)
-            self.cov_list.append(covar)
-        self.cov_list = np.asarray(self.cov_list)
-        self.cov_list = torch.from_numpy(self.cov_list).half().cuda()
+            self.spat_inv.append(inv(self.spat_cov[indices]))
+        self.spat_inv = torch.from_numpy(
+            np.asarray(self.spat_inv)).to(self.device, self.dtype)
+        self.temp_inv = torch.from_numpy(
+            inv(self.temp_cov)).to(self.device, self.dtype)
     
     def compute_units_in(self):
 
@@ -318,8 +336,8 @@ class TEMPLATE_ASSIGN_OBJECT(object):
         #self.idx_included.update(self.idx_included.intersection(idx_in))
     def move_to_torch(self):
         
-        self.spike_train = torch.from_numpy(self.spike_train).long().cuda()
-        self.shifts = torch.from_numpy(self.shifts).float().cuda()
+        self.spike_train = torch.from_numpy(self.spike_train).long().to(self.device)
+        self.shifts = torch.from_numpy(self.shifts).float().to(self.device)
         self.chans = torch.from_numpy(self.chans)
         #self.mcs = torch.from_numpy(self.mcs)
         
@@ -327,6 +345,11 @@ class TEMPLATE_ASSIGN_OBJECT(object):
 
         n_data, n_times, n_channels = template_aligned.shape
 
+        if not self.cuda_splines:
+            coeffs = np.stack([transform_template_parallel(temp.T)
+                               for temp in template_aligned])
+            return torch.from_numpy(coeffs).to(self.device)
+
         channels = torch.arange(n_channels).cuda()
         temps_torch = torch.from_numpy(-(template_aligned.transpose(0, 2, 1))/2).cuda()
 
@@ -335,18 +358,25 @@ class TEMPLATE_ASSIGN_OBJECT(object):
         return coeffs
 
     def get_shifted_templates(self, temp_ids, shifts, iteration):
-        temp_ids = torch.from_numpy(temp_ids.cpu().numpy()).long().cuda()
-        shifts = torch.from_numpy(shifts.cpu().numpy()).float().cuda()
+        temp_ids = temp_ids.long().to(self.device)
+        shifts = shifts.float().to(self.device)
 
         n_sample_run = 1000
         n_times = self.aligned_template_list[iteration].shape[1]
 
         idx_run = np.hstack((np.arange(0, len(shifts), n_sample_run), len(shifts)))
 
-        shifted_templates = torch.cuda.FloatTensor(len(shifts), n_times, self.n_chans).fill_(0)
+        shifted_templates = torch.zeros((len(shifts), n_times, self.n_chans),
+                                        device=self.device)
         for j in range(len(idx_run)-1):
             ii_start = idx_run[j]
             ii_end =idx_run[j+1]
+            if not self.cuda_splines:
+                shifted_templates[ii_start:ii_end] = shift_splines(
+                    self.coeff_list[iteration], temp_ids[ii_start:ii_end],
+                    shifts[ii_start:ii_end],
+                    torch.ones(ii_end - ii_start, device=self.device))
+                continue
             obj = torch.cuda.FloatTensor(self.n_chans, (ii_end-ii_start)*n_times + 10).fill_(0)
             times = torch.arange(0, (ii_end-ii_start)*n_times, n_times).long().cuda() + 5
             deconv.subtract_splines(obj,
@@ -362,17 +392,41 @@ class TEMPLATE_ASSIGN_OBJECT(object):
     
     def get_liklihood(self, unit, snip):
         chans = self.chans[unit]
-        chans = chans < self.rec_chans
-        log_prob = np.ravel(snip[:, chans].T) @ self.cov_list[unit] @ np.ravel(snip[:, chans].T) 
+        chans = chans[chans < self.rec_chans]
+        snip = snip[:, chans].T
+        spat_inv = self.spat_inv[unit].float().cpu().numpy()
+        temp_inv = self.temp_inv.float().cpu().numpy()
+        log_prob = np.sum(snip * (spat_inv @ snip @ temp_inv.T))
         return log_prob
 
+    def bucket_spikes(self):
+        ''' spikes of each batch, sorted by unit: spikes of batch j are
+            spike_order[batch_offsets[j]:batch_offsets[j+1]]
+        '''
+
+        times = self.spike_train[:, 0].cpu().numpy()
+        units = self.spike_train[:, 1].cpu().numpy()
+        idx_list = self.reader_residual.idx_list
+
+        batch_ids = np.searchsorted(idx_list[:, 0], times, side='right') - 1
+        # spikes outside of all batches
+        batch_ids[times >= idx_list[batch_ids, 1]] = -1
+
+        spike_order = np.lexsort((units, batch_ids))
+        batch_offsets = np.searchsorted(batch_ids[spike_order],
+                                        np.arange(len(idx_list)+1))
+
+        return torch.from_numpy(spike_order).to(self.device), batch_offsets
+
     def compute_soft_assignment(self):
         
-        log_probs = torch.zeros((len(self.spike_train), self.sim_units)).half().cuda()
+        log_probs = torch.zeros((len(self.spike_train), self.sim_units),
+                                dtype=self.dtype, device=self.device)
 
         # batch offsets
         offsets = torch.from_numpy(self.reader_residual.idx_list[:, 0]
-                                   - self.reader_residual.buffer).cuda().long()
+                                   - self.reader_residual.buffer).to(self.device).long()
+        spike_order, batch_offsets = self.bucket_spikes()
         with tqdm(total=self.reader_residual.n_batches) as pbar:
             for batch_id in range(self.reader_residual.n_batches):
                 
@@ -384,50 +438,44 @@ class TEMPLATE_ASSIGN_OBJECT(object):
                     self.templates = np.load(fname_templates)
                     self.get_template_data()
 
-                # load residual data
-                resid_dat = self.reader_residual.read_data_batch(
-                    batch_id, add_buffer=True)#/np.sqrt(self.resid_var)
-                resid_dat = torch.from_numpy(resid_dat).cuda()
-
                 # relevant idx
-                idx_in = torch.nonzero(
-                    (self.spike_train[:, 0] >= self.reader_residual.idx_list[batch_id][0]) & 
-                    (self.spike_train[:, 0] < self.reader_residual.idx_list[batch_id][1]))[:,0]
+                idx_in = spike_order[batch_offsets[batch_id]:batch_offsets[batch_id+1]]
 
                 if len(idx_in) == 0:
                     continue
 
+                # load residual data
+                resid_dat = self.reader_residual.read_data_batch(
+                    batch_id, add_buffer=True)#/np.sqrt(self.resid_var)
+                resid_dat = torch.from_numpy(np.array(resid_dat, 'float32')).to(self.device)
+
                 spike_train_batch = self.spike_train[idx_in] 
                 spike_train_batch[:, 0] -= offsets[batch_id]
                 shift_batch = self.shifts[idx_in]
 
                 # get residual snippets
-                t_index = spike_train_batch[:, 0][:, None] + torch.arange(-(self.n_times//2), self.n_times//2+1).cuda()
+                t_index = spike_train_batch[:, 0][:, None] + torch.arange(-(self.n_times//2), self.n_times//2+1).to(self.device)
                 c_index = self.chans[spike_train_batch[:, 1]].long()
-                resid_dat = torch.cat((resid_dat, torch.zeros((resid_dat.shape[0], 1)).cuda()), 1)
+                resid_dat = torch.cat((resid_dat, torch.zeros((resid_dat.shape[0], 1), device=self.device)), 1)
                 resid_snippets = resid_dat[t_index[:,:,None], c_index[:,None]]
 
                 # get shifted templates
                 shifted_templates = [
                     self.get_shifted_templates(
                         spike_train_batch[:,1], shift_batch, i) for i in range(self.sim_units)]
-                shifted_templates = [element for element in shifted_templates]
-
-                clean_wfs = [(resid_snippets + shifted) for shifted in shifted_templates]
-                for i in range(len(clean_wfs)):
-                    #restricted = clean_wfs[i][:, (self.offset):(self.n_times -(self.offset)), :]
-                    restricted = clean_wfs[i][:, self.offset:(self.offset+self.lik_window), :]
-                    restricted = restricted.permute(0, 2, 1).reshape(
-                        restricted.shape[0], restricted.shape[1]*restricted.shape[2])
-                    clean_wfs[i] = restricted.half()
-                clean_wfs = torch.stack(clean_wfs, dim=1)
-
-                logs_batch = torch.cuda.HalfTensor(clean_wfs.shape[0], clean_wfs.shape[1]).fill_(0)
-                unit_idx = spike_train_batch[:, 1]
-                for k in range(self.n_units):
-                    idx_ = unit_idx == k
-                    temp = clean_wfs[idx_]
-                    logs_batch[idx_] = torch.sum(torch.matmul(temp, self.cov_list[k])*temp, 2)
+                shifted_templates = torch.stack(shifted_templates, dim=1)
+
+                # clean wfs: spikes x sim_units x chans x lik_window
+                clean_wfs = resid_snippets[:, None] + shifted_templates
+                clean_wfs = clean_wfs[:, :, self.offset:(self.offset+self.lik_window)]
+                clean_wfs = clean_wfs.transpose(2, 3).to(self.dtype)
+
+                # vec(X)' kron(S, T) vec(X) = sum(X * S X T'), batched over
+                # all spikes with the spatial factor of each spike's unit
+                spat_inv = self.spat_inv[spike_train_batch[:, 1]][:, None]
+                logs_batch = torch.sum(torch.matmul(
+                    torch.matmul(spat_inv, clean_wfs),
+                    self.temp_inv.t())*clean_wfs, (2, 3))
 
                 log_probs[idx_in] = logs_batch
 
@@ -442,7 +490,7 @@ class TEMPLATE_ASSIGN_OBJECT(object):
 
                 # load residual data
                 resid_dat = self.reader_residual.read_data_batch(batch_id, add_buffer=True)
-                resid_dat = torch.from_numpy(resid_dat).cuda()
+                resid_dat = torch.from_numpy(np.array(resid_dat, 'float32')).to(self.device)
 
                 # relevant idx
                 s1 = self.spike_train[spike_idx, 0] >= self.reader_residual.idx_list[batch_id][0]
@@ -458,9 +506,9 @@ class TEMPLATE_ASSIGN_OBJECT(object):
                 shift_batch = shift_batch[idx_in]
                 # get residual snippets
 
-                t_index = spike_train_batch[:, 0][:, None] + torch.arange(-(self.n_times//2), self.n_times//2+1).cuda()
+                t_index = spike_train_batch[:, 0][:, None] + torch.arange(-(self.n_times//2), self.n_times//2+1).to(self.device)
                 c_index = self.chans[spike_train_batch[:, 1]].long()
-                resid_dat = torch.cat((resid_dat, torch.zeros((resid_dat.shape[0], 1)).cuda()), 1)
+                resid_dat = torch.cat((resid_dat, torch.zeros((resid_dat.shape[0], 1), device=self.device)), 1)
                 resid_snippets = resid_dat[t_index[:,:,None], c_index[:,None]]
                 # get shifted templates
 
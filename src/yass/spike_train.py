@@ -0,0 +1,158 @@
+import os
+
+import numpy as np
+
+
+def spike_train_unit_index(units, n_units=None):
+    """Index spikes by unit
+
+    spikes of unit k are spike_order[unit_offsets[k]:unit_offsets[k+1]],
+    in the same order as they appear in the spike train
+    """
+    if n_units is None:
+        n_units = np.max(units) + 1
+
+    spike_order = np.argsort(units, kind='mergesort')
+    unit_offsets = np.zeros(n_units + 1, 'int64')
+    n_spikes = np.bincount(units, minlength=n_units)[:n_units]
+    unit_offsets[1:] = np.cumsum(n_spikes)
+
+    return spike_order, unit_offsets
+
+
+class SpikeTrain(object):
+    """Spike train (n_spikes, 2) indexed by unit and by spike time
+
+    Built once with two argsorts: spikes of a unit are a slice of the unit
+    order and spikes in a time window are a slice of the time order found
+    with a binary search. Use SpikeTrain.load to keep the index next to a
+    spike train file and memory map it.
+
+    Parameters
+    ----------
+    spike_train: numpy.ndarray (n_spikes, 2)
+        spike times in the first column and unit ids in the second
+
+    n_units: int, optional
+        number of units, defaults to the largest unit id + 1
+    """
+
+    def __init__(self, spike_train, n_units=None, index=None,
+                 unit_offsets=None):
+        self.spike_train = spike_train
+        self.fname = None
+
+        if index is None:
+            unit_order, unit_offsets = spike_train_unit_index(
+                spike_train[:, 1], n_units)
+            time_order = np.argsort(spike_train[:, 0], kind='mergesort')
+
+            # unit order, time order and sorted spike times
+            index = np.vstack((unit_order, time_order,
+                               spike_train[time_order, 0])).astype('int64')
+
+        self.index = index
+        self.unit_offsets = unit_offsets
+
+    @classmethod
+    def load(cls, fname_spike_train, mmap=True):
+        """Load a spike train file and its index, the index is made and
+        saved next to the file the first time (or if the spike train
+        changed since)
+        """
+        fname_index, fname_offsets = cls.index_fnames(fname_spike_train)
+
+        mmap_mode = 'r' if mmap else None
+        spike_train = None
+        if (os.path.exists(fname_index) and os.path.exists(fname_offsets) and
+                os.path.getmtime(fname_offsets) >=
+                os.path.getmtime(fname_spike_train)):
+            try:
+                spike_train = cls(
+                    np.load(fname_spike_train, mmap_mode=mmap_mode),
+                    index=np.load(fname_index, mmap_mode=mmap_mode),
+                    unit_offsets=np.load(fname_offsets))
+            except (ValueError, OSError, EOFError):
+                # truncated file
+                spike_train = None
+
+        # mtimes can be equal or copied, check the index too
+        if spike_train is None or not spike_train.index_matches():
+            spike_train = cls(np.load(fname_spike_train))
+            for fname, data in ((fname_index, spike_train.index),
+                                (fname_offsets, spike_train.unit_offsets)):
+                with open(fname + '.tmp', 'wb') as f:
+                    np.save(f, data)
+                os.rename(fname + '.tmp', fname)
+
+            spike_train = cls(np.load(fname_spike_train, mmap_mode=mmap_mode),
+                              index=np.load(fname_index, mmap_mode=mmap_mode),
+                              unit_offsets=np.load(fname_offsets))
+
+        spike_train.fname = fname_spike_train
+
+        return spike_train
+
+    def index_matches(self):
+        """whether the index is one of this spike train (same number of
+        spikes, same sorted spike times and same units)
+        """
+        n_spikes = len(self.spike_train)
+        if not (self.index.ndim == 2 and self.index.shape == (3, n_spikes) and
+                self.unit_offsets[0] == 0 and
+                self.unit_offsets[-1] == n_spikes and
+                np.all(np.diff(self.unit_offsets) >= 0) and
+                np.array_equal(self.spike_train[self.index[1], 0],
+                               self.index[2])):
+            return False
+
+        # spikes of unit k are a slice of the unit order, in spike train
+        # order (so each spike is there once)
+        units = self.spike_train[self.index[0], 1]
+        return (np.array_equal(units, np.repeat(np.arange(self.n_units),
+                                                self.n_spikes)) and
+                np.all((np.diff(self.index[0]) > 0) | (np.diff(units) > 0)))
+
+    @staticmethod
+    def index_fnames(fname_spike_train):
+        root, ext = os.path.splitext(fname_spike_train)
+        return root + '_index' + ext, root + '_unit_offsets' + ext
+
+    @property
+    def n_units(self):
+        return len(self.unit_offsets) - 1
+
+    @property
+    def n_spikes(self):
+        """number of spikes per unit"""
+        return np.diff(self.unit_offsets)
+
+    def __len__(self):
+        return self.spike_train.shape[0]
+
+    def unit_index(self, unit):
+        """indexes of spikes of a unit, in spike train order"""
+        if unit >= self.n_units:
+            return np.zeros(0, 'int64')
+        return self.index[0, self.unit_offsets[unit]:self.unit_offsets[unit+1]]
+
+    def unit_times(self, unit):
+        """spike times of a unit"""
+        return self.spike_train[self.unit_index(unit), 0]
+
+    def time_index(self, t_start, t_end):
+        """indexes of spikes with t_start <= time < t_end, sorted by time"""
+        lo, hi = np.searchsorted(self.index[2], [t_start, t_end])
+        return self.index[1, lo:hi]
+
+    def __getstate__(self):
+        # loaded ones are sent to other processes by file name
+        if self.fname is None:
+            return self.__dict__
+        return {'fname': self.fname}
+
+    def __setstate__(self, state):
+        if 'fname' in state and len(state) == 1:
+            self.__dict__.update(SpikeTrain.load(state['fname']).__dict__)
+        else:
+            self.__dict__.update(state)
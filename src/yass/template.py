@@ -7,11 +7,12 @@ import logging
 import parmap
 
 from scipy.interpolate import interp1d
-from scipy.spatial.distance import pdist, squareform
+from scipy.spatial.distance import pdist, squareform, cdist
 from scipy import signal
 
 from yass import read_config
 from yass.reader import READER
+from yass.spike_train import SpikeTrain
 from yass.util import absolute_path_to_asset
 
 class Geometry(object):
@@ -344,7 +345,9 @@ def run_template_computation(
     #fname_spike_times, n_units = partition_spike_time(
     #    tmp_folder, fname_spike_train)
 
-    n_units = np.max(np.load(fname_spike_train)[:, 1]) + 1
+    # index the spike train by unit once, workers memory map the index
+    spike_train = SpikeTrain.load(fname_spike_train)
+    n_units = spike_train.n_units
 
     if unit_ids is None:
         unit_ids = np.arange(n_units)
@@ -359,23 +362,29 @@ def run_template_computation(
     #
     if spike_size is None:
         spike_size = reader.spike_size
-    
+
     # run computing function
     if multi_processing:
+        # each worker takes a set of units
+        args_in = []
+        for j in range(n_processors):
+            args_in.append([unit_ids[j::n_processors],
+                            fnames_out[j::n_processors]])
+
         parmap.starmap(run_template_computation_parallel,
-                       list(zip(unit_ids, fnames_out)),
-                       fname_spike_train,
+                       args_in,
+                       spike_train,
                        reader,
                        spike_size,
                        processes=n_processors,
                        pm_pbar=True)
     else:
-        for ctr in unit_ids:
-            run_template_computation_parallel(
-                fname_spike_train,
-                fnames_out[ctr],
-                reader,
-                spike_size)
+        run_template_computation_parallel(
+            unit_ids,
+            fnames_out,
+            spike_train,
+            reader,
+            spike_size)
 
     # gather all info
     templates_new = np.zeros((n_units, spike_size, reader.n_channels),
@@ -391,40 +400,69 @@ def run_template_computation(
 
 
 def run_template_computation_parallel(
-    unit_id, fname_out, fname_spike_train, reader, spike_size):
+    unit_ids, fnames_out, spike_train, reader, spike_size,
+    max_block_size=int(1e8)):
 
-    if os.path.exists(fname_out):
+    # skip units already computed
+    todo = [ctr for ctr in range(len(unit_ids))
+            if not os.path.exists(fnames_out[ctr])]
+    if len(todo) == 0:
         return
 
-    # load spike times
-    spike_train = np.load(fname_spike_train)
-    spike_times = spike_train[spike_train[:, 1] == unit_id, 0]
+    # spikes to average for each unit
+    spike_times_list = []
+    for ctr in todo:
+        spike_times = spike_train.unit_times(unit_ids[ctr])
+        spike_times_list.append(
+            select_template_spikes(spike_times, spike_size))
 
-    if len(spike_times) > 0:
-        template = compute_a_template(spike_times,
-                                      reader,
-                                      spike_size)
-    else:
-        template = np.zeros(
-            (spike_size, reader.n_channels), 'float32')
+    # read waveforms of several units at once, up to max_block_size
+    # numbers per read
+    max_spikes = max(max_block_size//(spike_size*reader.n_channels), 1)
+    n_spikes = np.array([len(spt) for spt in spike_times_list])
+    block_id = np.cumsum(n_spikes)//max_spikes
+    for block in np.unique(block_id):
+        idx_block = np.where(block_id == block)[0]
 
-    # save result
-    np.save(fname_out, template)
+        spike_times = np.hstack([spike_times_list[j] for j in idx_block])
+        labels = np.repeat(np.arange(len(idx_block)), n_spikes[idx_block])
+        wf, skipped_idx = reader.read_waveforms(spike_times, spike_size)
+        labels = np.delete(labels, skipped_idx)
 
+        for k, j in enumerate(idx_block):
+            wf_unit = wf[labels == k]
+            if wf_unit.shape[0] > 0:
+                template = np.mean(wf_unit, axis=0).astype('float32')
+            else:
+                template = np.zeros(
+                    (spike_size, reader.n_channels), 'float32')
 
-def compute_a_template(spike_times, reader, spike_size):
+            # save result
+            np.save(fnames_out[todo[j]], template)
+
+
+def select_template_spikes(spike_times, spike_size,
+                           min_spikes=300, max_spikes=1000):
+
+    if len(spike_times) == 0:
+        return spike_times
 
-    min_spikes=300
     spike_times = get_isolated_spikes(
         spike_times, spike_size, min_spikes)[0]
 
-    # subsample upto 1000
-    max_spikes = 1000
+    # subsample upto max_spikes
     if len(spike_times) > max_spikes:
         spike_times = np.random.choice(a=spike_times,
                                        size=max_spikes,
                                        replace=False)
 
+    return spike_times
+
+
+def compute_a_template(spike_times, reader, spike_size):
+
+    spike_times = select_template_spikes(spike_times, spike_size)
+
     # get waveforms
     wf = reader.read_waveforms(spike_times, spike_size)[0]
 
@@ -476,6 +514,9 @@ def run_cleaned_template_computation(
                              dtype_residual_recording,
                              CONFIG)
 
+    # index the spike train by unit once, workers memory map the index
+    spike_train = SpikeTrain.load(fname_spike_train)
+
     # run computing function
     if CONFIG.resources.multi_processing:
         n_processors = CONFIG.resources.n_processors
@@ -488,7 +529,7 @@ def run_cleaned_template_computation(
             run_cleaned_template_computation_parallel,
             unit_ids_partition,
             tmp_folder,
-            fname_spike_train,
+            spike_train,
             fname_templates,
             fname_shifts,
             fname_scales,
@@ -500,7 +541,7 @@ def run_cleaned_template_computation(
         run_cleaned_template_computation_parallel(
             unit_ids,
             tmp_folder,
-            fname_spike_train,
+            spike_train,
             fname_templates,
             fname_shifts,
             fname_scales,
@@ -520,13 +561,12 @@ def run_cleaned_template_computation(
 def run_cleaned_template_computation_parallel(
     unit_ids,
     tmp_folder,
-    fname_spike_train,
+    spike_train,
     fname_templates,
     fname_shifts,
     fname_scales,
     reader_residual):
 
-    spike_train = np.load(fname_spike_train)
     templates = np.load(fname_templates)
     shifts = np.load(fname_shifts)
     scales = np.load(fname_scales)
@@ -542,8 +582,8 @@ def run_cleaned_template_computation_parallel(
             continue
 
         # get necessary data
-        idx_ = np.where(spike_train[:, 1] == unit)[0]
-        spt_ = spike_train[idx_, 0]
+        idx_ = spike_train.unit_index(unit)
+        spt_ = spike_train.spike_train[idx_, 0]
         shift_ = shifts[idx_]
         scale_ = scales[idx_]
 
@@ -790,25 +830,25 @@ def ptp_similarity_matrix(fname_out, fname_templates, CONFIG):
         # if it is with update template, the input is actually the directory with all
         # templates
         templates_dir = fname_templates
-        sim_mat_l2_all = [None]*n_updates
-        sim_mat_max_all = [None]*n_updates
-        sim_mat_l2_normalized_all = [None]*n_updates
-        sim_mat_max_normalized_all = [None]*n_updates
+        sim_mats = None
         for j in range(n_updates):
             templates = np.load(os.path.join(templates_dir, 'templates_{}sec.npy').format(
                 update_time*j)).astype('float32')
             ptps = templates.ptp(1)
             ptps[ptps < ptp_threshold] = 0
 
-            (sim_mat_l2_all[j],
-             sim_mat_max_all[j],
-             sim_mat_l2_normalized_all[j],
-             sim_mat_max_normalized_all[j]) = compute_ptp_similarity(ptps)
+            # keep the running max over batches
+            sim_mats_batch = compute_ptp_similarity(ptps)
+            if sim_mats is None:
+                sim_mats = sim_mats_batch
+            else:
+                for sim_mat, sim_mat_batch in zip(sim_mats, sim_mats_batch):
+                    np.maximum(sim_mat, sim_mat_batch, out=sim_mat)
 
-        sim_mat_l2 = np.stack(sim_mat_l2_all).max(0)
-        sim_mat_max = np.stack(sim_mat_max_all).max(0)
-        sim_mat_l2_normalized = np.stack(sim_mat_l2_normalized_all).max(0)
-        sim_mat_max_normalized = np.stack(sim_mat_max_normalized_all).max(0)
+        (sim_mat_l2,
+         sim_mat_max,
+         sim_mat_l2_normalized,
+         sim_mat_max_normalized) = sim_mats
 
     else:
 
@@ -828,17 +868,34 @@ def ptp_similarity_matrix(fname_out, fname_templates, CONFIG):
             sim_mat_max_normalized=sim_mat_max_normalized)
 
 
-def compute_ptp_similarity(ptps):
+def compute_ptp_similarity(ptps, max_block_size=int(1e7)):
 
     n_units, n_chans = ptps.shape
 
     sim_mat_l2 = np.zeros((n_units, n_units), 'float32')
     sim_mat_max = np.zeros((n_units, n_units), 'float32')
 
-    for k in range(n_units):
-        diff = ptps[k] - ptps
-        sim_mat_l2[k] = np.linalg.norm(diff, axis=1)
-        sim_mat_max[k] = np.max(np.abs(diff), axis=1)
+    # l2 distance from norms and dot products, in float64 to avoid
+    # cancellation between close units
+    ptps_64 = ptps.astype('float64')
+    sq_norms = np.sum(np.square(ptps_64), axis=1)
+
+    # blocks of units against the units after them, up to max_block_size
+    # distances at once
+    block_size = max(max_block_size//max(n_units, 1), 1)
+    for k in range(0, n_units, block_size):
+        block = slice(k, k+block_size)
+
+        dist_sq = (sq_norms[block, np.newaxis] + sq_norms[np.newaxis, k:] -
+                   2*np.matmul(ptps_64[block], ptps_64[k:].T))
+        sim_mat_l2[block, k:] = np.sqrt(np.maximum(dist_sq, 0))
+        sim_mat_max[block, k:] = cdist(ptps[block], ptps[k:], 'chebyshev')
+
+    # fill the lower triangle
+    idx_lower = np.tril_indices(n_units, -1)
+    sim_mat_l2[idx_lower] = sim_mat_l2.T[idx_lower]
+    sim_mat_max[idx_lower] = sim_mat_max.T[idx_lower]
+    np.fill_diagonal(sim_mat_l2, 0)
 
     l2_norms = np.square(np.linalg.norm(ptps, axis=1))
     max_norms = np.max(np.abs(ptps), axis=1)
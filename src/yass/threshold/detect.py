@@ -5,21 +5,55 @@ import os
 import logging
 
 import numpy as np
-from scipy.signal import argrelmin
 
 def voltage_threshold(recording, threshold, order=5):
+    """Find local minima below -threshold on every channel
+
+    A time point is a local minimum if it is strictly smaller than the
+    order samples before and after it (same as scipy.signal.argrelmin),
+    all channels are handled at once with a sliding window minimum along
+    the time axis
+
+    Parameters
+    ----------
+    recording: numpy.ndarray (T, C)
+    threshold: float
+    order: int
+        Number of samples on each side to compare to
+
+    Returns
+    -------
+    spike_index: numpy.ndarray (n_spikes, 2)
+        time and channel of every minimum, sorted by channel and then time
+    energy: numpy.ndarray (n_spikes,)
+        absolute value of the recording at every minimum
+    """
 
     T, C = recording.shape
-    spike_index = np.zeros((0, 2), 'int32')
-    energy = np.zeros(0, 'float32')
-    for c in range(C):
-        single_chan_rec = recording[:, c]
-        index = argrelmin(single_chan_rec, order=order)[0]
-        index = index[single_chan_rec[index] < -threshold]
-        spike_index_temp = np.vstack((index,
-                                      np.ones(len(index), 'int32')*c)).T
-        spike_index = np.concatenate((spike_index, spike_index_temp), axis=0)
-        energy_ = np.abs(single_chan_rec[index])
-        energy = np.hstack((energy, energy_))
-
-    return spike_index, energy
\ No newline at end of file
+
+    # extend the edges with the first and last values like argrelmin does
+    padded = np.concatenate((
+        np.repeat(recording[:1], order, axis=0),
+        recording,
+        np.repeat(recording[-1:], order, axis=0)), axis=0)
+
+    # sliding minimum of the order neighbors before and after each
+    # time point (the time point itself excluded)
+    neighbors_min = np.array(padded[:T])
+    for k in range(1, 2*order + 1):
+        if k != order:
+            np.minimum(neighbors_min, padded[k:k + T], out=neighbors_min)
+
+    is_spike = (recording < neighbors_min) & (recording < -threshold)
+
+    # sorted by channel first, then by time
+    times, channels = np.nonzero(is_spike)
+    idx_sort = np.argsort(channels, kind='mergesort')
+    times, channels = times[idx_sort], channels[idx_sort]
+
+    spike_index = np.empty((len(times), 2), 'int32')
+    spike_index[:, 0] = times
+    spike_index[:, 1] = channels
+    energy = np.abs(recording[times, channels]).astype('float32')
+
+    return spike_index, energy
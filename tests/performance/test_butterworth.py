@@ -0,0 +1,38 @@
+import logging
+import time
+
+import numpy as np
+
+from yass.preprocess.util import _butterworth
+from util import butterworth_channel_loop
+
+
+def test_multichannel_butterworth_timings(data):
+    """Time the butterworth filter on a 384 channel chunk, the size of a
+    neuropixels batch (run with make performance-test)
+    """
+    logger = logging.getLogger(__name__)
+
+    ts = np.tile(data, (1, int(np.ceil(384/data.shape[1]))))[:, :384]
+
+    start = time.time()
+    expected = butterworth_channel_loop(ts, 300, 3, 20000)
+    time_loop = time.time() - start
+
+    start = time.time()
+    filtered = _butterworth(ts, low_frequency=300, high_factor=0.1,
+                            order=3, sampling_frequency=20000)
+    time_vectorized = time.time() - start
+
+    ts = ts.astype('float32')
+    start = time.time()
+    _butterworth(ts, low_frequency=300, high_factor=0.1,
+                 order=3, sampling_frequency=20000, in_place=True)
+    time_in_place = time.time() - start
+
+    logger.info('butterworth on %s: channel loop %.3fs, vectorized %.3fs, '
+                'in place float32 %.3fs', ts.shape, time_loop,
+                time_vectorized, time_in_place)
+
+    np.testing.assert_allclose(filtered, expected, rtol=1e-4, atol=1e-3)
+    np.testing.assert_allclose(ts, expected, rtol=1e-3, atol=1e-2)
@@ -1,6 +1,16 @@
 import os
+import pickle
+
+import numpy as np
+import torch
+from scipy.interpolate import splrep, splev
+
 import yass
 from yass import preprocess, cluster, deconvolve, detect
+from yass.deconvolve.match_pursuit import (MatchPursuit_objectiveUpsample,
+                                          SparsePairwiseConv)
+from yass.deconvolve.match_pursuit_cpu import bspline_basis, deconvCPU
+from yass.deconvolve.match_pursuit_gpu_new import transform_template_parallel
 
 
 def test_deconvolution(patch_triage_network, path_to_config,
@@ -32,3 +42,190 @@ def test_deconvolution(patch_triage_network, path_to_config,
                      'deconv'),
         standardized_path,
         standardized_params['dtype'])
+
+
+def test_cpu_bspline_subtraction_reproduces_templates():
+    t = np.arange(121)
+    temp_temp = np.stack([np.exp(-(t-60-shift)**2/50.)*(1+shift)
+                          for shift in range(3)]).astype('float32')
+    coefficients = transform_template_parallel(temp_temp)
+    n_vals = coefficients.shape[1] - 4
+
+    basis = bspline_basis(torch.tensor([0., 0.3, 0.7]))
+    np.testing.assert_allclose(basis.sum(1).numpy(), 1, rtol=1e-6)
+
+    # no shift gives back the interpolated points
+    vals = sum(coefficients[:, k:k+n_vals]*basis[0, k].item()
+               for k in range(4))
+    np.testing.assert_allclose(vals, temp_temp, atol=1e-3)
+
+
+def make_deconv_cpu(init_dir, n_units=3, n_chan=4, n_times=21, rank=2):
+    """small deconvCPU with random components, without a recording"""
+    d = object.__new__(deconvCPU)
+    d.init_dir = init_dir
+    d.K, d.RANK, d.STIME, d.jitter_diff = n_units, rank, n_times, 0
+    d.fit_height = False
+    d.temps = np.random.randn(n_chan, n_times, n_units).astype('float32')
+    d.spat_comp = np.random.randn(n_units, rank, n_chan).astype('float32')
+    d.temp_comp = np.random.randn(n_units, rank, n_times).astype('float32')
+    d.align_shifts = np.random.randint(0, 4, (n_units, n_chan))
+
+    # temp_temps of each unit with its visible units, zero at the edges
+    vis_units = np.empty(n_units, 'object')
+    vis_units[:] = [np.array([0, 1]), np.array([1]), np.array([0, 1, 2])]
+    np.save(os.path.join(init_dir, 'vis_units.npy'), vis_units)
+    t = np.arange(2*n_times-1)
+    d.temp_temps = [np.stack([np.exp(-(t - n_times + np.random.randn())**2/8.)
+                              * np.random.randn() for _ in units])
+                    for units in vis_units]
+    d.coefficients = [transform_template_parallel(tt.astype('float32'))
+                      for tt in d.temp_temps]
+    d.vis_units = vis_units
+
+    d.data_to_gpu()
+    return d
+
+
+def test_cpu_deconv_subtract_splines_and_refrac_fill(make_tmp_folder):
+    d = make_deconv_cpu(make_tmp_folder)
+    obj_len = 200
+    n_vals = d.temp_temps[0].shape[1]
+
+    # positive and negative shifts, spikes over both edges of the chunk
+    times = np.array([-10, 3, 60, 100, 180, obj_len - 5])
+    shifts = np.array([0.3, -0.4, 0., -0.9, 0.6, -0.2], 'float32')
+    units = np.array([0, 2, 1, 2, 0, 1])
+    scales = np.array([1., 2., 0.5, 1.5, 1., 2.], 'float32')
+
+    d.obj_gpu = torch.zeros((d.K, obj_len))
+    d.subtract_splines(torch.from_numpy(times), torch.from_numpy(shifts),
+                       torch.from_numpy(units), torch.from_numpy(scales))
+
+    # template value at time t is temp_temp(t - shift)
+    expected = np.zeros((d.K, obj_len))
+    t = np.arange(-2, n_vals+2)
+    for time, shift, unit, scale in zip(times, shifts, units, scales):
+        for row, tt in zip(d.vis_units[unit], d.temp_temps[unit]):
+            vals = splev(t - shift, splrep(np.arange(n_vals), tt), ext=1)
+            valid = (time + t >= 0) & (time + t < obj_len)
+            expected[row, (time + t)[valid]] -= scale*vals[valid]
+    np.testing.assert_allclose(d.obj_gpu.numpy(), expected, atol=1e-3)
+
+    d.obj_gpu = torch.zeros((d.K, obj_len))
+    d.refractory, d.subtraction_offset = 3, 5
+    d.refrac_fill(torch.from_numpy(times), torch.from_numpy(units), -10.)
+
+    expected = np.zeros((d.K, obj_len))
+    for time, unit in zip(times, units):
+        for j in range(2*d.refractory + 1):
+            t_fill = time + d.subtraction_offset - 2 - d.refractory + j
+            if 0 <= t_fill < obj_len:
+                expected[unit, t_fill] -= 10.
+    np.testing.assert_array_equal(d.obj_gpu.numpy(), expected)
+
+
+def test_cpu_deconv_objective_matches_dense_shifts(make_tmp_folder):
+    d = make_deconv_cpu(make_tmp_folder)
+    data = np.random.randn(d.temps.shape[0], 150).astype('float32')
+    d.data = torch.from_numpy(data.copy())
+    d.make_objective_shifted_svd()
+
+    # data rows delayed by the reversed align shifts of each unit; as
+    # with rowshift.backward, the last samples of a shifted row are
+    # dropped for the following units
+    n_times = data.shape[1]
+    expected = np.zeros((d.K, n_times + d.STIME - 1))
+    for unit in range(d.K):
+        shifts = d.align_shifts[unit].max() - d.align_shifts[unit]
+        shifted = np.zeros_like(data)
+        for c, s in enumerate(shifts):
+            shifted[c, s:] = data[c, :n_times-s]
+        mm = d.spat_comp[unit].numpy() @ shifted
+        for r in range(d.RANK):
+            expected[unit] += np.correlate(
+                np.pad(mm[r], d.STIME-1), d.temp_comp[unit, r].numpy())
+        for c, s in enumerate(shifts):
+            data[c, n_times-s:] = 0
+    expected = 2*expected - d.norms.numpy()[:, None]
+
+    np.testing.assert_allclose(d.obj_gpu.numpy(), expected,
+                               rtol=1e-4, atol=1e-3)
+
+
+def test_match_pursuit_objective_matches_direct_convolution():
+    n_unit, n_time, n_chan, rank = 4, 21, 5, 3
+    mp = object.__new__(MatchPursuit_objectiveUpsample)
+    mp.n_time, mp.approx_rank, mp.orig_n_unit = n_time, rank, n_unit
+    mp.spatial = np.random.randn(n_unit, rank, n_chan).astype('float32')
+    mp.singular = np.random.rand(n_unit, rank).astype('float32')
+    mp.temporal = np.random.randn(n_unit, n_time, rank).astype('float32')
+    mp.norm = np.random.rand(n_unit, 1).astype('float32')
+
+    # one fft block, and several with a partial last one
+    for data_len in [300, 2500]:
+        mp.data = np.random.randn(data_len, n_chan).astype('float32')
+        mp.data_len = data_len
+        mp.obj_computed = False
+        mp.compute_objective()
+
+        expected = np.zeros((n_unit, data_len + n_time - 1))
+        for r in range(rank):
+            matmul_result = np.matmul(
+                mp.spatial[:, r] * mp.singular[:, [r]], mp.data.T)
+            for unit in range(n_unit):
+                expected[unit] += np.convolve(
+                    matmul_result[unit], mp.temporal[unit, :, r])
+        expected = 2 * expected - mp.norm
+
+        assert mp.obj.shape == expected.shape
+        np.testing.assert_allclose(mp.obj, expected, rtol=1e-4, atol=1e-3)
+
+
+def test_sparse_pairwise_conv_matches_dense_convolutions(make_tmp_folder):
+    n_time, n_chan = 21, 7
+    # units 0 and 1 share channels, unit 2 overlaps with no other unit
+    vis_chans = [[0, 1, 2], [2, 3], [5, 6]]
+    temps = np.zeros((n_time, n_chan, len(vis_chans)), 'float32')
+    for unit, chans in enumerate(vis_chans):
+        temps[:, chans, unit] = 5*np.random.randn(n_time, len(chans))
+
+    mp = object.__new__(MatchPursuit_objectiveUpsample)
+    mp.temps = temps
+    mp.n_time, mp.n_chan, mp.n_unit = temps.shape
+    mp.deconv_dir = make_tmp_folder
+    mp.multi_processing = False
+    mp.up_factor = 1
+    mp.up_up_map = np.arange(mp.n_unit)
+    # full rank, so the svd convolutions are exact
+    mp.approx_rank = n_chan
+    mp.vis_su_threshold = 1e-3
+    mp.visible_chans()
+    mp.template_overlaps()
+    mp.spatially_mask_templates()
+    mp.compress_templates()
+    mp.pairwise_filter_conv()
+
+    conv = SparsePairwiseConv(make_tmp_folder)
+    assert len(conv) == mp.n_unit
+    for unit2 in range(mp.n_unit):
+        overlaps = np.where(mp.unit_overlap[unit2])[0]
+        expected = [
+            sum(np.convolve(temps[:, c, unit2], temps[::-1, c, unit1])
+                for c in vis_chans[unit1])
+            for unit1 in overlaps]
+        assert conv[unit2].shape == (len(overlaps), 2*n_time - 1)
+        np.testing.assert_allclose(conv[unit2], expected,
+                                   rtol=1e-4, atol=1e-3)
+    np.testing.assert_array_equal(np.where(mp.unit_overlap[2])[0], [2])
+    assert len(conv[0]) == 2 and len(conv[2]) == 1
+
+    # pickles the location of the files, not their data
+    pickled = pickle.dumps(conv)
+    assert len(pickled) < conv.data.nbytes
+    conv_loaded = pickle.loads(pickled)
+    assert isinstance(conv_loaded.data, np.memmap)
+    assert conv_loaded.data.filename == conv.data.filename
+    np.testing.assert_array_equal(conv_loaded.offsets, conv.offsets)
+    for unit in range(mp.n_unit):
+        np.testing.assert_array_equal(conv_loaded[unit], conv[unit])
@@ -1,8 +1,58 @@
 import os
 
+import numpy as np
+import torch
+from scipy.signal import argrelmin
+
 import yass
 from yass import preprocess
 from yass import detect
+from yass.threshold.detect import voltage_threshold
+from yass.detect.deduplication import deduplicate, deduplicate_gpu
+from yass.detect.output import gather_result, save_batch_result
+from yass.detect.run import quantize_output_layer
+from yass.geometry import find_channel_neighbors, make_channel_index
+from yass.neuralnetwork import Detect, Denoise
+
+
+def test_voltage_threshold_matches_argrelmin(data):
+    recording = data.astype('float32')/data.std()
+    threshold = 2
+
+    spike_index, energy = voltage_threshold(recording, threshold)
+
+    # per channel reference
+    for c in range(recording.shape[1]):
+        index = argrelmin(recording[:, c], order=5)[0]
+        index = index[recording[index, c] < -threshold]
+
+        np.testing.assert_array_equal(
+            spike_index[spike_index[:, 1] == c, 0], index)
+        np.testing.assert_array_equal(
+            energy[spike_index[:, 1] == c], np.abs(recording[index, c]))
+
+
+def test_sparse_deduplicate_matches_dense_deduplicate():
+    n_channels, n_times = 30, 5000
+    geom = np.vstack((np.zeros(n_channels),
+                      np.arange(n_channels)*20)).T
+    channel_index = make_channel_index(
+        find_channel_neighbors(geom, 40), geom, steps=1)
+
+    # unique spike locations with integer energies to get ties
+    locations = np.random.choice(n_times*n_channels, 3000, replace=False)
+    spike_index = np.vstack((locations // n_channels,
+                             locations % n_channels)).T.astype('int32')
+    energy = np.random.randint(1, 20, len(spike_index)).astype('float32')
+
+    spike_index_dedup = deduplicate(
+        spike_index, energy, (n_times, n_channels), channel_index)
+
+    spike_index_dedup_dense = deduplicate_gpu(
+        torch.from_numpy(spike_index).long(), torch.from_numpy(energy),
+        (n_times, n_channels), channel_index).numpy()
+
+    np.testing.assert_array_equal(spike_index_dedup, spike_index_dedup_dense)
 
 
 # def test_can_detect_with_threshold(path_to_config_threshold,
@@ -18,6 +68,128 @@ from yass import detect
 #                whiten_filter)
 
 
+def test_gather_result_matches_sorted_vstack(make_tmp_folder):
+    batch_files_dir = os.path.join(make_tmp_folder, 'batch')
+    os.mkdir(batch_files_dir)
+
+    # minibatches of consecutive batches overlap in time, some are empty
+    minibatch_locs = [[[0, 1000], [1000, 2000]], [[1500, 2500]], [],
+                      [[2500, 3000], [3000, 3500]], [[2000, 4000]]]
+    n_spikes = [[40, 30], [50], [], [0, 0], [60]]
+
+    expected = [np.zeros((0, 2), 'int32')]
+    for batch_id, (locs, ns) in enumerate(zip(minibatch_locs, n_spikes)):
+        minibatch_loc = np.array(locs, 'int64').reshape(-1, 2)
+        spike_index_list, spike_index_dedup_list = [], []
+        for (t_start, t_end), n in zip(minibatch_loc, ns):
+            # spikes in the minibatch and in its buffer
+            spike_index = np.vstack((
+                np.random.randint(t_start - 100, t_end + 100, n),
+                np.random.randint(0, 10, n))).T
+            spike_index_dedup = spike_index[np.random.rand(n) < 0.7]
+            spike_index_list.append(spike_index)
+            spike_index_dedup_list.append(spike_index_dedup)
+
+            expected.append(spike_index_dedup[
+                (spike_index_dedup[:, 0] >= t_start) &
+                (spike_index_dedup[:, 0] < t_end)])
+
+        fname = os.path.join(batch_files_dir,
+                             'detect_' + str(batch_id).zfill(5) + '.npz')
+        if batch_id == 1:
+            # saved by an older version, rewritten by gather_result
+            spike_index_objects = np.empty(len(spike_index_list), 'object')
+            spike_index_objects[:] = spike_index_list
+            spike_index_dedup_objects = np.empty(
+                len(spike_index_dedup_list), 'object')
+            spike_index_dedup_objects[:] = spike_index_dedup_list
+            np.savez(fname,
+                     spike_index=spike_index_objects,
+                     spike_index_dedup=spike_index_dedup_objects,
+                     minibatch_loc=minibatch_loc)
+        else:
+            save_batch_result(fname, spike_index_list,
+                              spike_index_dedup_list, minibatch_loc)
+
+    expected = np.vstack(expected)
+    expected = expected[np.argsort(expected[:, 0], kind='mergesort')]
+
+    fname_save = os.path.join(make_tmp_folder, 'spike_index.npy')
+    gather_result(fname_save, batch_files_dir)
+    np.testing.assert_array_equal(np.load(fname_save), expected)
+
+
+def _make_detector(CONFIG):
+    torch.manual_seed(0)
+    detector = Detect(CONFIG.neuralnetwork.detect.n_filters,
+                      CONFIG.spike_size_nn, CONFIG.channel_index, CONFIG)
+
+    # no spikes on a flat recording
+    n_channels = CONFIG.channel_index.shape[0]
+    with torch.no_grad():
+        flat = detector.forward_recording(torch.zeros(100, n_channels))
+        detector.out.bias -= flat.max() + 1
+
+    return detector
+
+
+def test_batched_spike_times_match_minibatch_spike_times(path_to_config,
+                                                         make_tmp_folder):
+    CONFIG = yass.set_config(path_to_config, make_tmp_folder)
+    detector = _make_detector(CONFIG)
+
+    # minibatches without spikes, and a last stack with only those
+    n_channels = CONFIG.channel_index.shape[0]
+    recordings = 10*torch.randn(5, 500, n_channels)
+    recordings[[1, 3, 4]] = 0
+    n_stacked = 2
+
+    n_spikes = 0
+    for j in range(0, recordings.shape[0], n_stacked):
+        with torch.no_grad():
+            spike_index, wfs = detector.get_spike_times_batched(
+                recordings[j:j+n_stacked])
+
+        for k in range(recordings[j:j+n_stacked].shape[0]):
+            with torch.no_grad():
+                spike_index_k, wfs_k = detector.get_spike_times(
+                    recordings[j+k])
+            idx_minibatch = spike_index[:, 0] == k
+            np.testing.assert_array_equal(
+                spike_index[idx_minibatch][:, 1:].numpy(),
+                spike_index_k.numpy())
+            np.testing.assert_array_equal(wfs[idx_minibatch].numpy(),
+                                          wfs_k.numpy())
+            n_spikes += len(spike_index_k)
+
+            if j + k in [1, 3, 4]:
+                assert len(spike_index_k) == 0
+    assert n_spikes > 0
+
+
+def test_quantized_output_layer_is_close_to_float(path_to_config,
+                                                  make_tmp_folder):
+    CONFIG = yass.set_config(path_to_config, make_tmp_folder)
+    detector = _make_detector(CONFIG)
+    torch.manual_seed(0)
+    denoiser = Denoise(CONFIG.neuralnetwork.denoise.n_filters,
+                       CONFIG.neuralnetwork.denoise.filter_sizes,
+                       CONFIG.spike_size_nn, CONFIG)
+
+    n_channels = CONFIG.channel_index.shape[0]
+    recordings = 10*torch.randn(2, 500, n_channels)
+    wfs = 10*torch.randn(100, CONFIG.spike_size_nn)
+    with torch.no_grad():
+        for model, run in [
+                (detector, lambda m: m.forward_recordings(recordings)),
+                (denoiser, lambda m: m(wfs)[0])]:
+            expected = run(model).numpy()
+            quantized = quantize_output_layer(model)
+            assert quantized.out is not model.out
+            np.testing.assert_allclose(run(quantized).numpy(), expected,
+                                       atol=2e-2*np.abs(expected).max())
+
+
 def test_can_detect_with_nnet(path_to_config, make_tmp_folder):
     yass.set_config(path_to_config, make_tmp_folder)
 
@@ -0,0 +1,117 @@
+import os
+
+import numpy as np
+
+import yass
+from yass.reader import READER
+from yass.template import shift_chans
+from yass.merge.merge import TemplateMerge
+
+
+def per_pair_waveforms(tm, unit1, unit2):
+    """clean waveforms of a pair, read on the channels of the pair only
+    (same spikes as TemplateMerge.clean_waveforms)
+    """
+    n_spikes1, n_spikes2 = tm.n_spikes_soft[[unit1, unit2]]
+    if n_spikes1 + n_spikes2 > tm.n_samples:
+        ratio1 = n_spikes1/float(n_spikes1+n_spikes2)
+        n_samples1 = np.min((int(tm.n_samples*ratio1), n_spikes1))
+        n_samples2 = tm.n_samples - n_samples1
+    else:
+        n_samples1, n_samples2 = n_spikes1, n_spikes2
+
+    ptp_max = tm.ptps[[unit1, unit2]].max(0)
+    mc = ptp_max.argmax()
+    vis_chan = np.where(ptp_max > 1)[0]
+    shift_temp = (tm.templates[unit2, :, mc].argmin() -
+                  tm.templates[unit1, :, mc].argmin())
+
+    wfs_pair = []
+    for unit, n_samples, shift in [(unit1, n_samples1, 0),
+                                   (unit2, n_samples2, shift_temp)]:
+        idx = tm.spike_train_index.unit_index(unit)
+        prob = tm.soft_assignment[idx]
+        idx = idx[np.random.RandomState(unit).choice(
+            len(idx), np.min((tm.n_samples, tm.n_spikes_soft[unit])),
+            replace=False, p=prob/np.sum(prob))][:n_samples]
+
+        wfs, skipped_idx = tm.reader_residual.read_waveforms(
+            tm.spike_train[idx, 0] + shift, tm.spike_size, vis_chan)
+        assert len(skipped_idx) == 0
+        wfs = shift_chans(wfs, -tm.shifts[idx])
+
+        template = np.zeros((tm.spike_size, len(vis_chan)), 'float32')
+        if shift >= 0:
+            template[:tm.spike_size-shift] = tm.templates[unit, shift:][:, vis_chan]
+        else:
+            template[-shift:] = tm.templates[unit, :shift][:, vis_chan]
+        wfs += tm.scales[idx, None, None]*template
+        wfs_pair.append(wfs)
+
+    return wfs_pair, vis_chan, shift_temp
+
+
+def test_merge_pairs_match_per_pair_waveforms(path_to_config, path_to_data,
+                                              data_info, make_tmp_folder):
+    CONFIG = yass.set_config(path_to_config, make_tmp_folder)
+    dtype = data_info['recordings']['dtype']
+    reader = READER(path_to_data, dtype, CONFIG, 1)
+    n_channels = reader.n_channels
+    n_times = CONFIG.spike_size
+
+    # three close units, shifted in time
+    t = np.arange(n_times) - n_times//2
+    spatial = np.random.uniform(1, 5, n_channels)
+    templates = np.stack([-np.exp(-(t[:, None] - s)**2/4.)*spatial*a
+                          for s, a in [(0, 2), (2, 2.2), (-1, 1.8)]])
+    templates = templates.astype('float32')
+
+    n_spikes = 600
+    spike_train = np.vstack((
+        np.random.randint(3*n_times, reader.rec_len - 3*n_times, n_spikes),
+        np.random.randint(0, 3, n_spikes))).T
+
+    fnames = {}
+    for name, data in [
+            ('templates', templates),
+            ('spike_train', spike_train),
+            ('shifts', np.random.uniform(-0.5, 0.5, n_spikes)),
+            ('scales', np.random.uniform(0.8, 1.2, n_spikes)),
+            ('soft_assignment', np.random.uniform(0.5, 1, n_spikes)),
+            ('spatial_cov', np.array([[1, 0]])),
+            ('temporal_cov', np.eye(n_times))]:
+        fnames[name] = os.path.join(make_tmp_folder, name + '.npy')
+        np.save(fnames[name], data)
+
+    tm = TemplateMerge(os.path.join(make_tmp_folder, 'merge'), reader,
+                       fnames['templates'], fnames['spike_train'],
+                       fnames['shifts'], fnames['scales'],
+                       fnames['soft_assignment'], fnames['spatial_cov'],
+                       fnames['temporal_cov'], CONFIG.geom)
+    assert len(tm.merge_candidates) == 3
+
+    # one unit in the cache at a time
+    tm.waveform_cache_bytes = 1
+    tm.merge_templates_parallel(tm.merge_candidates)
+    assert len(tm.waveform_cache) == 1
+
+    for unit1, unit2 in tm.merge_candidates:
+        wfs_pair, vis_chan, shift_temp = per_pair_waveforms(tm, unit1, unit2)
+
+        # same waveforms, except for the edge samples shift_chans rolls in
+        for unit, shift, wfs in zip([unit1, unit2], [0, shift_temp],
+                                    wfs_pair):
+            np.testing.assert_allclose(
+                tm.clean_waveforms(unit, vis_chan, shift)[:len(wfs), 1:-1],
+                wfs[:, 1:-1], atol=1e-4)
+
+        # and the same test statistics
+        wfs_w = [np.matmul(np.matmul(wfs, tm.get_spatial_whitener(vis_chan))
+                           .transpose(0, 2, 1), tm.temporal_whitener)
+                 .transpose(0, 2, 1) for wfs in wfs_pair]
+        temp_diff_w = np.mean(wfs_w[0], 0) - np.mean(wfs_w[1], 0)
+        result = np.load(os.path.join(
+            tm.save_dir, 'unit_{}_{}.npz'.format(unit1, unit2)))
+        for key, wfs in zip(['dat1_w', 'dat2_w'], wfs_w):
+            np.testing.assert_allclose(
+                result[key], np.sum(wfs*temp_diff_w, (1, 2)), rtol=1e-2)
@@ -0,0 +1,30 @@
+import numpy as np
+
+from yass import mfm
+
+
+def test_suffstat_matches_per_group_sums():
+    N, nfeature, nchannel, K = 200, 3, 3, 4
+    score = np.random.randn(N, nfeature, nchannel)
+    mask = (np.random.rand(N, nchannel) > 0.5).astype('float64')
+    mask[:, 1] = 1
+    mask[:, 2] = 0
+    rhat = np.random.dirichlet(np.ones(K), size=N)
+
+    maskedData = mfm.maskData(score, mask, np.arange(N))
+    suffStat = mfm.suffStatistics(maskedData, mfm.vbPar(rhat))
+
+    eye = np.eye(nfeature)
+    for c in range(nchannel):
+        seen = mask[:, c] > 0
+        for k in range(K):
+            sumY = np.sum(rhat[seen, k, None] *
+                          maskedData.sumY[seen, :, c], 0)
+            sumYSq = np.sum(
+                rhat[seen, k, None, None] *
+                (maskedData.sumYSq + maskedData.sumEta)[seen, :, :, c], 0)
+            sumYSq += np.sum(rhat[~seen, k])*eye
+            np.testing.assert_allclose(suffStat.sumY[:, k, c], sumY,
+                                       atol=1e-10)
+            np.testing.assert_allclose(suffStat.sumYSq[:, :, k, c], sumYSq,
+                                       atol=1e-10)
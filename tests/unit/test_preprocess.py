@@ -1,12 +1,15 @@
 import os
 
+import numpy as np
 try:
     from pathlib2 import Path
 except ImportError:
     from pathlib import Path
 
-from yass.preprocess.util import _butterworth
+from yass.preprocess.util import (_butterworth, _histogram_median_mad,
+                                  noise_bin_edges, noise_histogram)
 from yass.util import load_yaml
+from util import butterworth_channel_loop
 
 import yass
 from yass import preprocess
@@ -17,6 +20,20 @@ def test_can_apply_butterworth_filter(data):
                  order=3, sampling_frequency=20000)
 
 
+def test_multichannel_butterworth_matches_channel_loop(data):
+    expected = butterworth_channel_loop(data, 300, 3, 20000)
+
+    filtered = _butterworth(data, low_frequency=300, high_factor=0.1,
+                            order=3, sampling_frequency=20000)
+    np.testing.assert_allclose(filtered, expected, rtol=1e-4, atol=1e-3)
+
+    filtered_in_place = data.astype('float32')
+    _butterworth(filtered_in_place, low_frequency=300, high_factor=0.1,
+                 order=3, sampling_frequency=20000, in_place=True)
+    np.testing.assert_allclose(filtered_in_place, expected,
+                               rtol=1e-3, atol=1e-2)
+
+
 def test_can_preprocess(path_to_config, make_tmp_folder):
     yass.set_config(path_to_config, make_tmp_folder)
     (standardized_path,
@@ -80,3 +97,46 @@ def test_can_preprocess_without_filtering(path_to_config,
     (standardized_path,
      standardized_params) = preprocess.run(
         os.path.join(make_tmp_folder, 'preprocess'))
+
+
+def test_preprocess_write_direct_matches_merged_files(path_to_config,
+                                                     make_tmp_folder):
+    CONFIG = load_yaml(path_to_config)
+    yass.set_config(CONFIG, make_tmp_folder)
+    (standardized_path,
+     standardized_dtype) = preprocess.run(
+        os.path.join(make_tmp_folder, 'preprocess'))
+
+    CONFIG['preprocess']['write_direct'] = True
+    yass.set_config(CONFIG, make_tmp_folder)
+    (standardized_path_direct,
+     _) = preprocess.run(
+        os.path.join(make_tmp_folder, 'preprocess_direct'))
+
+    np.testing.assert_array_equal(
+        np.fromfile(standardized_path, dtype=standardized_dtype),
+        np.fromfile(standardized_path_direct, dtype=standardized_dtype))
+
+
+def test_merged_noise_histograms_match_median_and_mad(data):
+    bin_edges = noise_bin_edges()
+    ts = _butterworth(data, low_frequency=300, high_factor=0.1,
+                      order=3, sampling_frequency=20000)
+    # add a dead channel and a quantized one
+    ts = np.hstack((ts, np.zeros((ts.shape[0], 1)),
+                    np.round(3*ts[:, :1]/np.std(ts[:, 0]))))
+
+    # histograms of two halves are merged by adding them
+    half = ts.shape[0]//2
+    counts = (noise_histogram(ts[:half], bin_edges) +
+              noise_histogram(ts[half:], bin_edges))
+    np.testing.assert_array_equal(counts, noise_histogram(ts, bin_edges))
+
+    medians, mads = _histogram_median_mad(counts, bin_edges)
+
+    expected_medians = np.median(ts, 0)
+    expected_mads = np.median(np.abs(ts - expected_medians), 0)
+    np.testing.assert_allclose(medians, expected_medians,
+                               atol=1e-2*expected_mads.max())
+    np.testing.assert_allclose(mads, expected_mads, rtol=1e-2)
+    assert medians[-2] == 0 and mads[-2] == 0
@@ -0,0 +1,125 @@
+import numpy as np
+
+import yass
+from yass.reader import READER
+
+
+def _make_readers(path_to_config, path_to_data, data_info, make_tmp_folder,
+                  **kwargs):
+    CONFIG = yass.set_config(path_to_config, make_tmp_folder)
+    dtype = data_info['recordings']['dtype']
+
+    reader = READER(path_to_data, dtype, CONFIG, 1, mmap=False, **kwargs)
+    reader_mmap = READER(path_to_data, dtype, CONFIG, 1, mmap=True, **kwargs)
+
+    return reader, reader_mmap
+
+
+def test_mmap_read_data_batch_matches_file_read(path_to_config, path_to_data,
+                                                data_info, make_tmp_folder):
+    reader, reader_mmap = _make_readers(path_to_config, path_to_data,
+                                        data_info, make_tmp_folder)
+
+    # first and last batch need zero padding
+    for batch_id in [0, reader.n_batches - 1]:
+        for add_buffer in [False, True]:
+            np.testing.assert_array_equal(
+                reader.read_data_batch(batch_id, add_buffer),
+                reader_mmap.read_data_batch(batch_id, add_buffer))
+            np.testing.assert_array_equal(
+                reader.read_data_batch(batch_id, add_buffer, channels=[0, 2]),
+                reader_mmap.read_data_batch(batch_id, add_buffer,
+                                            channels=[0, 2]))
+
+
+def test_mmap_read_data_batch_batch_matches_file_read(path_to_config,
+                                                      path_to_data,
+                                                      data_info,
+                                                      make_tmp_folder):
+    reader, reader_mmap = _make_readers(path_to_config, path_to_data,
+                                        data_info, make_tmp_folder)
+
+    for batch_id in range(reader.n_batches):
+        data, loc = reader.read_data_batch_batch(batch_id, 0.3, True)
+        data_mmap, loc_mmap = reader_mmap.read_data_batch_batch(
+            batch_id, 0.3, True)
+
+        np.testing.assert_array_equal(data, data_mmap)
+        np.testing.assert_array_equal(loc, loc_mmap)
+
+
+def test_prefetch_yields_batches_in_order(path_to_config, path_to_data,
+                                          data_info, make_tmp_folder):
+    reader, _ = _make_readers(path_to_config, path_to_data,
+                              data_info, make_tmp_folder)
+
+    batch_ids = list(range(reader.n_batches))[::-1]
+    batches = list(reader.prefetch(batch_ids, n_prefetch=2,
+                                   add_buffer=True))
+
+    assert [batch_id for batch_id, _ in batches] == batch_ids
+    for batch_id, data in batches:
+        np.testing.assert_array_equal(
+            data, reader.read_data_batch(batch_id, add_buffer=True))
+
+
+def test_mmap_prefetch_reads_batches_into_memory(path_to_config,
+                                                 path_to_data, data_info,
+                                                 make_tmp_folder):
+    reader, reader_mmap = _make_readers(path_to_config, path_to_data,
+                                        data_info, make_tmp_folder)
+
+    batch_ids = list(range(reader.n_batches))
+    for batch_id, data in reader_mmap.prefetch(batch_ids, add_buffer=True):
+        assert not isinstance(data, np.memmap)
+        np.testing.assert_array_equal(
+            data, reader.read_data_batch(batch_id, add_buffer=True))
+
+    for batch_id, (data, loc) in reader_mmap.prefetch(
+            batch_ids, n_sec_chunk_small=0.3, add_buffer=True):
+        assert not isinstance(data, np.memmap) and data.base is None
+        expected, expected_loc = reader.read_data_batch_batch(
+            batch_id, 0.3, True)
+        np.testing.assert_array_equal(data, expected)
+        np.testing.assert_array_equal(loc, expected_loc)
+
+
+def test_read_waveforms_skips_boundary_spikes(path_to_config, path_to_data,
+                                              data_info, make_tmp_folder):
+    reader, _ = _make_readers(path_to_config, path_to_data,
+                              data_info, make_tmp_folder)
+    data = reader.read_data(0, reader.rec_len)
+
+    n_times = reader.spike_size
+    spike_times = np.array([reader.rec_len - 1, 100, n_times//2 - 1,
+                            reader.rec_len//2, n_times//2])
+    channels = [2, 0]
+    wfs, skipped_idx = reader.read_waveforms(spike_times, channels=channels)
+
+    np.testing.assert_array_equal(skipped_idx, [0, 2])
+    for wf, t in zip(wfs, np.delete(spike_times, skipped_idx)):
+        start = t - n_times//2
+        np.testing.assert_array_equal(
+            wf, data[start:start+n_times][:, channels])
+
+
+def test_read_waveforms_in_blocks_of_the_byte_budget(path_to_config,
+                                                     path_to_data, data_info,
+                                                     make_tmp_folder):
+    reader, _ = _make_readers(path_to_config, path_to_data,
+                              data_info, make_tmp_folder)
+
+    n_times = reader.spike_size
+    spike_times = np.random.randint(n_times, reader.rec_len - n_times, 50)
+    for channels in [None, [2, 0]]:
+        expected, _ = reader.read_waveforms(spike_times, channels=channels)
+
+        # one spike, then three spikes per block
+        n_chans = reader.n_channels if channels is None else len(channels)
+        for block_bytes in [1, 3*n_times*n_chans*reader.dtype.itemsize]:
+            reader.waveform_block_bytes = block_bytes
+            wfs, skipped_idx = reader.read_waveforms(spike_times,
+                                                     channels=channels)
+            assert len(skipped_idx) == 0
+            np.testing.assert_array_equal(wfs, expected)
+        del reader.waveform_block_bytes
@@ -0,0 +1,40 @@
+import os
+
+import numpy as np
+
+import yass
+from yass.reader import READER
+from yass.residual.residual import RESIDUAL
+
+
+def test_cpu_residual_subtracts_templates(path_to_config, path_to_data,
+                                          data_info, make_tmp_folder):
+    CONFIG = yass.set_config(path_to_config, make_tmp_folder)
+    dtype = data_info['recordings']['dtype']
+    reader = READER(path_to_data, dtype, CONFIG, 1)
+    n_channels = reader.n_channels
+
+    t = np.arange(31) - 15
+    templates = (np.exp(-t[None, :, None]**2/20.) *
+                 np.random.randn(3, 1, n_channels)).astype('float32')
+    templates[:, :, ::2] = 0
+    spike_train = np.array([[100, 0], [110, 1], [reader.rec_len - 5, 2],
+                            [CONFIG.recordings.sampling_rate + 3, 1]])
+
+    fname_templates = os.path.join(make_tmp_folder, 'templates.npy')
+    fname_spike_train = os.path.join(make_tmp_folder, 'spike_train.npy')
+    fname_out = os.path.join(make_tmp_folder, 'residual.bin')
+    np.save(fname_templates, templates)
+    np.save(fname_spike_train, spike_train)
+
+    residual = RESIDUAL(fname_templates, fname_spike_train, reader,
+                        fname_out, 'float32')
+    residual.compute_residual()
+    residual.save_residual()
+
+    expected = np.pad(reader.read_data(0, reader.rec_len).astype('float32'),
+                      ((0, 31), (0, 0)))
+    for time, unit in spike_train:
+        expected[time-15:time+16] -= templates[unit]
+    result = np.fromfile(fname_out, 'float32').reshape(-1, n_channels)
+    np.testing.assert_allclose(result, expected[:reader.rec_len], atol=1e-3)
@@ -0,0 +1,171 @@
+import os
+
+import numpy as np
+import torch
+from scipy.interpolate import splrep, splev
+
+import yass
+from yass.reader import READER
+from yass.deconvolve.match_pursuit_cpu import shift_splines
+from yass.deconvolve.match_pursuit_gpu_new import transform_template_parallel
+from yass.neuralnetwork.model_detector import Detect
+from yass.soft_assignment.noise import SOFTNOISEASSIGNMENT
+from yass.soft_assignment.template import TEMPLATE_ASSIGN_OBJECT
+
+
+def spline_shift(temp, shift, prepad=7, postpad=3):
+    """temp[t - shift] from the same (symmetrically padded) cubic spline
+    transform_template_parallel fits, evaluated by scipy
+    """
+    tck = splrep(np.arange(len(temp) + prepad + postpad),
+                 np.pad(temp, (prepad, postpad), mode='symmetric'))
+    return splev(np.arange(len(temp)) + prepad - shift, tck)
+
+
+def test_shift_splines_matches_scipy_splines():
+    n_units, n_chans, n_times = 3, 4, 31
+    t = np.arange(n_times) - n_times//2
+    templates = (5*np.exp(-t[None, None]**2/10.) *
+                 np.random.randn(n_units, n_chans, 1)).astype('float32')
+    coefficients = torch.from_numpy(
+        np.stack([transform_template_parallel(temp) for temp in templates]))
+
+    n_spikes = 50
+    temp_ids = np.random.randint(0, n_units, n_spikes)
+    shifts = np.random.uniform(-1, 1, n_spikes).astype('float32')
+    shifts[:2] = [-0.5, 0.5]
+    scales = np.random.uniform(0.5, 1.5, n_spikes).astype('float32')
+
+    shifted = shift_splines(coefficients, torch.from_numpy(temp_ids),
+                            torch.from_numpy(shifts),
+                            torch.from_numpy(scales)).numpy()
+    assert shifted.shape == (n_spikes, n_times, n_chans)
+
+    expected = np.stack([
+        scales[j]*np.stack([spline_shift(temp, shifts[j])
+                            for temp in templates[temp_ids[j]]], 1)
+        for j in range(n_spikes)])
+
+    # the first sample of a negative offset is left at zero
+    np.testing.assert_allclose(shifted[:, 1:], expected[:, 1:], atol=1e-4)
+
+
+def test_cpu_template_soft_assignment_matches_reference(path_to_config,
+                                                        path_to_data,
+                                                        data_info,
+                                                        make_tmp_folder):
+    CONFIG = yass.set_config(path_to_config, make_tmp_folder)
+    dtype = data_info['recordings']['dtype']
+    reader = READER(path_to_data, dtype, CONFIG, 1)
+    n_channels = reader.n_channels
+    n_times = CONFIG.spike_size
+
+    t = np.arange(n_times) - n_times//2
+    templates = (5*np.exp(-t[None, :, None]**2/10.) *
+                 np.random.randn(4, 1, n_channels)).astype('float32')
+    n_spikes = 200
+    spike_train = np.vstack((
+        np.random.randint(n_times, reader.rec_len - n_times, n_spikes),
+        np.random.randint(0, 4, n_spikes))).T
+    shifts = np.random.uniform(-0.5, 0.5, n_spikes).astype('float32')
+
+    fname_templates = os.path.join(make_tmp_folder, 'templates.npy')
+    fname_spike_train = os.path.join(make_tmp_folder, 'spike_train.npy')
+    fname_shifts = os.path.join(make_tmp_folder, 'shifts.npy')
+    np.save(fname_templates, templates)
+    np.save(fname_spike_train, spike_train)
+    np.save(fname_shifts, shifts)
+
+    tao = TEMPLATE_ASSIGN_OBJECT(
+        fname_spike_train, fname_templates, fname_shifts, reader,
+        np.array([[1, 0]]), np.eye(n_times), CONFIG.channel_index,
+        CONFIG.geom, large_unit_threshold=100000, n_chans=3,
+        rec_chans=n_channels, sim_units=2, temp_thresh=np.inf,
+        lik_window=n_times-10, device='cpu')
+    log_probs = tao.compute_soft_assignment()
+
+    # clean waveforms with templates shifted by scipy splines
+    recording = reader.read_data(0, reader.rec_len).astype('float32')
+    spike_train = tao.spike_train.numpy()
+    chans = tao.chans.numpy()
+    temp_inv = tao.temp_inv.numpy()
+    window = slice(tao.offset, tao.offset + tao.lik_window)
+    expected = np.zeros_like(log_probs)
+    for j, (time, unit) in enumerate(spike_train):
+        snippet = recording[time+t][:, chans[unit]]
+        for i in range(2):
+            temp = tao.aligned_template_list[i][unit]
+            shifted = np.stack([
+                splev(t - tao.shifts[j].item(), splrep(t, temp[:, c]))
+                for c in range(temp.shape[1])], 1)
+            wf = (snippet + shifted)[window].T.ravel()
+            cov = np.kron(tao.spat_inv[unit].numpy(), temp_inv)
+            expected[j, i] = wf @ cov @ wf
+
+    np.testing.assert_allclose(log_probs, expected,
+                               rtol=1e-3, atol=1e-3*np.abs(expected).max())
+
+
+def test_cpu_noise_soft_assignment_matches_reference(path_to_config,
+                                                     path_to_data,
+                                                     data_info,
+                                                     make_tmp_folder):
+    CONFIG = yass.set_config(path_to_config, make_tmp_folder)
+    dtype = data_info['recordings']['dtype']
+    reader = READER(path_to_data, dtype, CONFIG, 1)
+    n_channels = reader.n_channels
+    n_times = CONFIG.spike_size
+
+    t = np.arange(n_times) - n_times//2
+    templates = np.stack([
+        -np.exp(-(t[:, None] - s)**2/10.)*np.random.uniform(1, 5, n_channels)
+        for s in [0, 2, -1, 1]]).astype('float32')
+
+    # spikes away from the batch edges
+    batch_size = reader.idx_list[0, 1] - reader.idx_list[0, 0]
+    n_spikes = 200
+    times = np.random.randint(n_times, batch_size - n_times, n_spikes)
+    times += batch_size*np.random.randint(0, reader.n_batches, n_spikes)
+    spike_train = np.vstack((times, np.random.randint(0, 4, n_spikes))).T
+
+    fnames = {}
+    for name, data in [
+            ('templates', templates),
+            ('spike_train', spike_train),
+            ('shifts', np.random.uniform(-0.5, 0.5, n_spikes)),
+            ('scales', np.random.uniform(0.5, 1.5, n_spikes))]:
+        fnames[name] = os.path.join(make_tmp_folder, name + '.npy')
+        np.save(fnames[name], data)
+
+    torch.manual_seed(0)
+    detector = Detect(CONFIG.neuralnetwork.detect.n_filters,
+                      CONFIG.spike_size_nn, CONFIG.channel_index, CONFIG)
+    sna = SOFTNOISEASSIGNMENT(
+        fnames['spike_train'], fnames['templates'], fnames['shifts'],
+        fnames['scales'], reader, detector, CONFIG.channel_index,
+        np.inf, device='cpu')
+    probs = sna.compute_soft_assignment()
+
+    # clean waveforms with templates shifted by scipy splines
+    recording = reader.read_data(0, reader.rec_len).astype('float32')
+    recording = np.concatenate(
+        (recording, np.zeros((len(recording), 1), 'float32')), 1)
+    spike_train = sna.spike_train.numpy()
+    shifts = sna.shifts.numpy()
+    scales = sna.scales.numpy()
+    templates_aligned = sna.templates_aligned.numpy()
+    n_times_nn = sna.n_times_nn
+    t_range = np.arange(n_times_nn) - n_times_nn//2
+    trim = slice(sna.n_times_extra, -sna.n_times_extra)
+
+    clean_wfs = np.zeros((n_spikes, n_times_nn, sna.n_neigh_chans), 'float32')
+    for j, (time, unit) in enumerate(spike_train):
+        chans = CONFIG.channel_index[sna.mcs[unit].item()]
+        shifted = np.stack([spline_shift(temp, shifts[j])
+                            for temp in templates_aligned[unit].T], 1)
+        clean_wfs[j] = (recording[time + t_range][:, chans] +
+                        scales[j]*shifted[trim])
+    with torch.no_grad():
+        logits = detector(torch.from_numpy(clean_wfs))[1][:, 0].numpy()
+
+    np.testing.assert_allclose(np.log(probs/(1 - probs)), logits, atol=1e-3)
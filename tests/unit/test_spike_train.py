@@ -0,0 +1,85 @@
+import os
+
+import numpy as np
+
+from yass.spike_train import SpikeTrain, spike_train_unit_index
+
+
+def test_spike_train_unit_index_groups_spikes_by_unit():
+    units = np.random.randint(0, 10, size=1000)
+    units[units == 3] = 4
+
+    spike_order, unit_offsets = spike_train_unit_index(units, n_units=12)
+
+    assert len(unit_offsets) == 13
+    for unit in range(12):
+        idx = spike_order[unit_offsets[unit]:unit_offsets[unit+1]]
+        np.testing.assert_array_equal(idx, np.where(units == unit)[0])
+
+
+def test_spike_train_index_matches_masks(make_tmp_folder):
+    spike_train = np.vstack((np.random.randint(0, 10000, size=1000),
+                             np.random.randint(0, 10, size=1000))).T
+    fname_spike_train = os.path.join(make_tmp_folder, 'spike_train.npy')
+    np.save(fname_spike_train, spike_train)
+
+    # once to make the index, once to load it
+    for _ in range(2):
+        index = SpikeTrain.load(fname_spike_train)
+
+        for unit in range(12):
+            np.testing.assert_array_equal(
+                index.unit_times(unit),
+                spike_train[spike_train[:, 1] == unit, 0])
+
+        idx = index.time_index(2000, 3000)
+        np.testing.assert_array_equal(
+            np.sort(idx), np.where((spike_train[:, 0] >= 2000) &
+                                   (spike_train[:, 0] < 3000))[0])
+
+
+def test_spike_train_index_rebuilt_for_new_spike_train(make_tmp_folder):
+    fname_spike_train = os.path.join(make_tmp_folder, 'spike_train.npy')
+    fname_index, fname_offsets = SpikeTrain.index_fnames(fname_spike_train)
+
+    for n_spikes in [1000, 1500, 1500]:
+        spike_train = np.vstack((
+            np.random.randint(0, 10000, size=n_spikes),
+            np.random.randint(0, 10, size=n_spikes))).T
+        np.save(fname_spike_train, spike_train)
+        # index files look newer than the spike train
+        os.utime(fname_spike_train, (0, 0))
+
+        index = SpikeTrain.load(fname_spike_train)
+        for unit in range(10):
+            np.testing.assert_array_equal(
+                index.unit_times(unit),
+                spike_train[spike_train[:, 1] == unit, 0])
+
+    # truncated offsets file
+    with open(fname_offsets, 'wb') as f:
+        f.write(b'')
+    index = SpikeTrain.load(fname_spike_train)
+    np.testing.assert_array_equal(index.n_spikes,
+                                  np.bincount(spike_train[:, 1]))
+
+
+def test_spike_train_index_rebuilt_for_relabeled_units(make_tmp_folder):
+    fname_spike_train = os.path.join(make_tmp_folder, 'spike_train.npy')
+
+    spike_train = np.vstack((
+        np.random.randint(0, 10000, size=1000),
+        np.random.randint(0, 10, size=1000))).T
+    for relabel in [np.arange(10), np.random.permutation(10),
+                    np.roll(np.arange(10), 1)]:
+        # same spike times, other units
+        spike_train[:, 1] = relabel[spike_train[:, 1]]
+        np.save(fname_spike_train, spike_train)
+        # index files look newer than the spike train
+        os.utime(fname_spike_train, (0, 0))
+
+        index = SpikeTrain.load(fname_spike_train)
+        for unit in range(10):
+            np.testing.assert_array_equal(
+                index.unit_index(unit),
+                np.where(spike_train[:, 1] == unit)[0])
@@ -0,0 +1,16 @@
+import numpy as np
+
+from yass.template import compute_ptp_similarity
+
+
+def test_ptp_similarity_matches_pairwise_distances():
+    ptps = np.random.rand(50, 20).astype('float32')*10
+    ptps[ptps < 5] = 0
+
+    sim_mat_l2, sim_mat_max, _, _ = compute_ptp_similarity(
+        ptps, max_block_size=200)
+
+    diff = ptps[:, np.newaxis] - ptps[np.newaxis]
+    np.testing.assert_allclose(sim_mat_l2, np.linalg.norm(diff, axis=2),
+                               atol=1e-4)
+    np.testing.assert_array_equal(sim_mat_max, np.abs(diff).max(2))
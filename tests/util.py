@@ -5,6 +5,7 @@ try:
 except ImportError:
     from pathlib import Path
 import numpy as np
+from scipy.signal import butter, filtfilt
 from six import with_metaclass
 
 PATH_TO_TESTS = os.path.dirname(os.path.realpath(__file__))
@@ -65,3 +66,16 @@ def dummy_predict_with_threshold(self, x, threshold, **kwargs):
     ones = np.ones(n + r).astype(bool)
     zeros = np.zeros(n).astype(bool)
     return np.concatenate((ones, zeros))
+
+
+def butterworth_channel_loop(ts, low_frequency, order, sampling_frequency):
+    # previous implementation: design the filter and filter channel by channel
+    low = float(low_frequency) / sampling_frequency * 2
+    b, a = butter(order, low, btype='high', analog=False)
+
+    T, C = ts.shape
+    output = np.zeros((T, C), 'float32')
+    for c in range(C):
+        output[:, c] = filtfilt(b, a, ts[:, c])
+
+    return output